@@ -0,0 +1,126 @@
+import argparse
+import importlib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.join(ROOT, 'parsers', 'stackoverflow')
+T5_DIR = os.path.join(ROOT, 'hpc_scripts', 't5')
+GPT2_DIR = os.path.join(ROOT, 'hpc_scripts', 'gpt2')
+
+
+def load(directory: str, name: str):
+    # The parser and the training scripts are flat directories of modules
+    # and each has its own `const`, so only the directory of the command
+    # being run goes on the path, and only when the command runs.
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+    return importlib.import_module(name)
+
+
+def crawl(arguments: argparse.Namespace):
+    load(PARSER_DIR, 'main').main()
+
+
+def export(arguments: argparse.Namespace):
+    # The options are export.py's own, parsed once the command runs so its
+    # defaults come from the parser's `const`.
+    export_module = load(PARSER_DIR, 'export')
+    export_parser = argparse.ArgumentParser(
+        prog=f'{os.path.basename(sys.argv[0])} export',
+        description='Export the stored questions')
+    export_module.add_export_arguments(export_parser)
+    export_module.export_from_arguments(export_parser.parse_args(arguments.rest))
+
+
+def tokenize(arguments: argparse.Namespace):
+    load(T5_DIR, 'main').tokenize(
+        arguments.train_data, arguments.val_data,
+        arguments.tokenizer, arguments.num_proc, arguments.output)
+
+
+def tokenized_dataset(t5, arguments: argparse.Namespace):
+    if arguments.tokenized is not None:
+        return t5.load_tokenized(arguments.tokenized)
+
+    return t5.tokenize(
+        arguments.train_data, arguments.val_data,
+        arguments.tokenizer, arguments.num_proc)
+
+
+def train(arguments: argparse.Namespace):
+    if arguments.model == 'gpt2':
+        gpt2 = load(GPT2_DIR, 'main')
+        gpt2.train(
+            arguments.data if arguments.data is not None else gpt2.DATA_PATH,
+            arguments.model_path if arguments.model_path is not None else gpt2.MODEL_PATH,
+            arguments.output if arguments.output is not None else gpt2.OUTPUT_DIR)
+        return
+
+    t5 = load(T5_DIR, 'main')
+    t5.train(
+        tokenized_dataset(t5, arguments),
+        arguments.model_path if arguments.model_path is not None else t5.MODEL_PATH,
+        arguments.tokenizer,
+        arguments.output if arguments.output is not None else t5.OUTPUT_DIR)
+
+
+def evaluate(arguments: argparse.Namespace):
+    t5 = load(T5_DIR, 'main')
+    t5.evaluate(tokenized_dataset(t5, arguments), arguments.model_path, arguments.tokenizer)
+
+
+def add_dataset_arguments(argument_parser: argparse.ArgumentParser):
+    # Defaults of hpc_scripts/t5/main.py, kept here so `--help` doesn't
+    # import it.
+    argument_parser.add_argument('--train-data', default='./dataset/github_train.csv')
+    argument_parser.add_argument('--val-data', default='./dataset/github_val.csv')
+    argument_parser.add_argument('--tokenizer', default='./t5_small_tokenizer')
+    argument_parser.add_argument('--num-proc', type=int, default=8)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Crawl the corpus, export it and fine-tune models on it')
+    commands = argument_parser.add_subparsers(dest='command', required=True)
+
+    crawl_parser = commands.add_parser('crawl', help='crawl stackoverflow into the corpus')
+    crawl_parser.set_defaults(run=crawl)
+
+    export_parser = commands.add_parser(
+        'export', help='export the stored questions', add_help=False)
+    export_parser.set_defaults(run=export)
+
+    tokenize_parser = commands.add_parser('tokenize', help='tokenize the t5 dataset')
+    add_dataset_arguments(tokenize_parser)
+    tokenize_parser.add_argument('--output', required=True)
+    tokenize_parser.set_defaults(run=tokenize)
+
+    train_parser = commands.add_parser('train', help='fine-tune a model')
+    train_parser.add_argument('--model', choices=['t5', 'gpt2'], default='t5')
+    train_parser.add_argument('--model-path', default=None)
+    train_parser.add_argument('--output', default=None)
+    train_parser.add_argument('--tokenized', default=None,
+                              help='t5 dataset saved by `tokenize`')
+    train_parser.add_argument('--data', default=None,
+                              help='gpt2 data path with a {} for the split file name')
+    add_dataset_arguments(train_parser)
+    train_parser.set_defaults(run=train)
+
+    eval_parser = commands.add_parser('eval', help='evaluate a fine-tuned t5 model')
+    eval_parser.add_argument('--model-path', default='./t5_small_result_fine_tuned')
+    eval_parser.add_argument('--tokenized', default=None,
+                             help='t5 dataset saved by `tokenize`')
+    add_dataset_arguments(eval_parser)
+    eval_parser.set_defaults(run=evaluate)
+
+    arguments, rest = argument_parser.parse_known_args()
+    if rest and arguments.run is not export:
+        argument_parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    arguments.rest = rest
+    arguments.run(arguments)
+
+
+if __name__ == '__main__':
+    main()
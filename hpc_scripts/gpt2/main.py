@@ -1,36 +1,43 @@
-from transformers import TextDataset, DataCollatorForLanguageModeling
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
-from transformers import Trainer, TrainingArguments
-import torch
-
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
 DATA_PATH = './data/{}'
 MODEL_PATH = './base'
 OUTPUT_DIR = './fine_tuned/'
 
-if __name__ == '__main__':
-    print("device: ", DEVICE)
+
+def get_device():
+    import torch
+
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def train(data_path: str = DATA_PATH, model_path: str = MODEL_PATH,
+          output_dir: str = OUTPUT_DIR):
+    # transformers and torch only load once training starts.
+    from transformers import TextDataset, DataCollatorForLanguageModeling
+    from transformers import GPT2Tokenizer, GPT2LMHeadModel
+    from transformers import Trainer, TrainingArguments
+
+    device = get_device()
+    print("device: ", device)
     print("preparing tokenized and model")
-    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_PATH)
+    tokenizer = GPT2Tokenizer.from_pretrained(model_path)
     print("tokenizer: ", tokenizer)
-    model = GPT2LMHeadModel.from_pretrained(MODEL_PATH).to(DEVICE)
+    model = GPT2LMHeadModel.from_pretrained(model_path).to(device)
     print("model: ", model)
     print("loading data...")
     train_dataset = TextDataset(
         tokenizer=tokenizer,
-        file_path=DATA_PATH.format('code_instructions_train.txt'),
+        file_path=data_path.format('code_instructions_train.txt'),
         block_size=128,
     )
     print("train dataset loaded...")
     validation_dataset = TextDataset(
         tokenizer=tokenizer,
-        file_path=DATA_PATH.format('code_instructions_validation.txt'),
+        file_path=data_path.format('code_instructions_validation.txt'),
         block_size=128,
     )
     print("validation dataset loaded...")
     training_args = TrainingArguments(
-        output_dir=OUTPUT_DIR,
+        output_dir=output_dir,
         overwrite_output_dir=True,
         per_device_train_batch_size=12,
         num_train_epochs=5,
@@ -54,3 +61,7 @@ if __name__ == '__main__':
     print("model fine-tuned successfully...")
     trainer.save_model()
     print("model saved successfully...")
+
+
+if __name__ == '__main__':
+    train()
@@ -1,21 +1,44 @@
 import const
 
-import datasets
-from transformers import TrainingArguments
-from transformers import Trainer
-from transformers import AutoTokenizer
-from transformers import T5ForConditionalGeneration
-from transformers import DataCollatorForSeq2Seq
-import torch
+import functools
 
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# torch, transformers and datasets are imported by the functions that use
+# them: `datasets.map` workers and `--help` don't pay for a model load.
+TOKENIZER_PATH = './t5_small_tokenizer'
+MODEL_PATH = './t5_small'
+TRAIN_DATA = './dataset/github_train.csv'
+VAL_DATA = './dataset/github_val.csv'
+OUTPUT_DIR = './t5_small_result_fine_tuned'
+NUM_PROC = 8
 
-tokenizer = AutoTokenizer.from_pretrained('./t5_small_tokenizer')
-model = T5ForConditionalGeneration.from_pretrained('./t5_small', torch_dtype=torch.float16).to(DEVICE)
 
+def get_device():
+    import torch
 
-def preprocess_function(data_point):
-    prompt = f"""You are a helpful, precise, detailed, and concise artificial intelligence
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(path: str = TOKENIZER_PATH):
+    # Cached, so every `datasets.map` worker loads it once.
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(path)
+
+
+def load_model(path: str = MODEL_PATH):
+    import torch
+    from transformers import T5ForConditionalGeneration
+
+    return T5ForConditionalGeneration.from_pretrained(
+        path, torch_dtype=torch.float16).to(get_device())
+
+
+def preprocess_function(batch, tokenizer_path: str = TOKENIZER_PATH):
+    # `datasets` reads an empty csv field as None.
+    tokenizer = load_tokenizer(tokenizer_path)
+    prompts = [
+        f"""You are a helpful, precise, detailed, and concise artificial intelligence
         assistant with a deep expertise in Python programming language.
 
         In this task, you are asked to read the problem description and return
@@ -26,41 +49,62 @@ def preprocess_function(data_point):
         The generated answer is the cleanest and most efficient implementation.
 
         ### Problem:
-        {data_point["instruction"]}
+        {instruction}
 
         ### Seed:
-        {data_point["input"]}
+        {input_ or ''}
 
         ### Solution:
-        {data_point["output"]}{tokenizer.eos_token}"""
+        {output}{tokenizer.eos_token}"""
+        for instruction, input_, output in zip(
+            batch["instruction"], batch["input"], batch["output"])
+    ]
 
     inputs = tokenizer(
-        prompt,
+        prompts,
         truncation=True,
         max_length=const.MAX_LENGTH,
         padding=False,
         return_tensors=None,
     )
-    inputs["labels"] = inputs["input_ids"].copy()
+    inputs["labels"] = [input_ids.copy() for input_ids in inputs["input_ids"]]
 
     return inputs
 
 
-if __name__ == '__main__':
-    print("Started")
-    print("device: ", DEVICE)
-    print("model: ", model)
-    print("tokenizer: ", tokenizer)
-    TRAIN_DATA = './dataset/github_train.csv'
-    VAL_DATA = './dataset/github_val.csv'
+def tokenize(train_data: str = TRAIN_DATA, val_data: str = VAL_DATA,
+             tokenizer_path: str = TOKENIZER_PATH, num_proc: int = NUM_PROC,
+             output=None):
+    # Workers get the tokenizer path, not the tokenizer, and load it once.
+    import datasets
+
     dataset = datasets.load_dataset('csv', data_files={
-        'train': TRAIN_DATA, 'validation': VAL_DATA}, num_proc=8)
+        'train': train_data, 'validation': val_data}, num_proc=num_proc)
     print("Dataset loaded")
-    tokenized_dataset = dataset.map(preprocess_function, num_proc=8)
+    tokenized_dataset = dataset.map(
+        preprocess_function, batched=True, num_proc=num_proc,
+        fn_kwargs={'tokenizer_path': tokenizer_path})
     print("Dataset tokenized")
+    if output is not None:
+        tokenized_dataset.save_to_disk(output)
+        print("Tokenized dataset saved to", output)
+
+    return tokenized_dataset
+
+
+def load_tokenized(path: str):
+    import datasets
+
+    return datasets.load_from_disk(path)
+
+
+def make_trainer(model, tokenizer, tokenized_dataset, output_dir: str = 't5_small_finetuned'):
+    from transformers import DataCollatorForSeq2Seq
+    from transformers import Trainer
+    from transformers import TrainingArguments
 
     training_args = TrainingArguments(
-        f't5_small_finetuned',
+        output_dir,
         num_train_epochs=3,
         learning_rate=3e-4,
         per_device_train_batch_size=const.BATCH_SIZE,
@@ -81,7 +125,7 @@ if __name__ == '__main__':
         group_by_length=True,
     )
 
-    trainer = Trainer(
+    return Trainer(
         model=model,
         args=training_args,
         data_collator=DataCollatorForSeq2Seq(
@@ -91,9 +135,37 @@ if __name__ == '__main__':
         eval_dataset=tokenized_dataset["validation"],
     )
 
+
+def train(tokenized_dataset, model_path: str = MODEL_PATH,
+          tokenizer_path: str = TOKENIZER_PATH, output_dir: str = OUTPUT_DIR):
+    model = load_model(model_path)
+    tokenizer = load_tokenizer(tokenizer_path)
+    print("device: ", get_device())
+    trainer = make_trainer(model, tokenizer, tokenized_dataset)
+
     print("Starting fine-tuning...")
     trainer.train()
     print("Model successfully fine-tuned")
     print("Saving fine-tuned-model")
-    trainer.save_model('./t5_small_result_fine_tuned')
+    trainer.save_model(output_dir)
     print("Model saved successfully")
+
+
+def evaluate(tokenized_dataset, model_path: str = OUTPUT_DIR,
+             tokenizer_path: str = TOKENIZER_PATH) -> dict:
+    trainer = make_trainer(
+        load_model(model_path), load_tokenizer(tokenizer_path), tokenized_dataset)
+    metrics = trainer.evaluate()
+    print(metrics)
+
+    return metrics
+
+
+def main():
+    print("Started")
+    tokenized_dataset = tokenize()
+    train(tokenized_dataset)
+
+
+if __name__ == '__main__':
+    main()
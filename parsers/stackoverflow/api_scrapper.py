@@ -0,0 +1,269 @@
+import const
+from exceptions import FetchFailedException
+from exceptions import SkipQuestionException
+from logger import logger
+from metrics import metrics
+import models
+from scrapper import StackOverflowScrapper
+from scrapper import get_until
+from scrapper import put_until
+import utils
+
+import collections
+import html
+import json
+import queue
+import threading
+import time
+import typing
+import urllib.parse
+
+
+def question_rejection_reason(
+        item: dict, config: models.StackOverflowParserConfig) -> typing.Optional[str]:
+    # The API counterpart of `utils.source_rejection_reason`, checked before
+    # the answers of a question are requested at all.
+    if item.get('answer_count', 0) == 0:
+        return 'no_answers'
+    if config.only_accepted_answers and 'accepted_answer_id' not in item:
+        return 'no_accepted_answer'
+
+    return None
+
+
+def format_api_answers(
+        answer_items: typing.List[dict],
+        config: models.StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+) -> typing.List[models.StackOverflowAnswer]:
+    answers = []
+
+    for item in answer_items:
+        if len(answers) >= config.answers_limit:
+            break
+
+        answer = models.StackOverflowAnswer()
+        answer.id = str(item['answer_id'])
+        answer.score = item['score']
+        answer.has_accepted = item.get('is_accepted', False)
+        if not utils.is_answer_fits_config(answer, config):
+            continue
+
+        try:
+            answer.body = utils.format_body_html(item['body'], config, backend)
+        except SkipQuestionException:
+            continue
+        answers.append(answer)
+
+    return answers
+
+
+def format_api_question(
+        item: dict, config: models.StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+) -> typing.Optional[models.StackOverflowQuestion]:
+    # Everything but the answers, which are requested only for questions
+    # that get through here.
+    question = models.StackOverflowQuestion()
+    question.id = str(item['question_id'])
+    question.title = html.unescape(item['title'])
+    question.score = item['score']
+    question.answers_count = item['answer_count']
+    question.answers = []
+
+    try:
+        question.body = utils.format_body_html(item['body'], config, backend)
+    except SkipQuestionException:
+        metrics.inc('rejected_total', reason='drop_policy')
+        return None
+
+    return question
+
+
+# Fetches questions through the Stack Exchange API instead of their pages:
+# ids found on the listing pages are grouped into batches of up to
+# `batch_size`, and a batch costs one `/questions/{ids}` call plus one
+# `/questions/{ids}/answers` call per 100 answers. Listing pages, filters,
+# dedup and checkpoints are the ones of `StackOverflowScrapper`.
+class ApiStackOverflowScrapper(StackOverflowScrapper):
+    def __init__(
+            self, filter_: models.StackOverflowParserFilter,
+            config: models.StackOverflowParserConfig = (
+                    models.StackOverflowParserConfig()
+            ),
+            delay: int = 0,
+            seen_ids: typing.Optional[typing.Container] = None,
+            api_url: str = const.STACKEXCHANGE_API_URL,
+            api_key: typing.Optional[str] = const.STACKEXCHANGE_API_KEY,
+            site: str = const.STACKEXCHANGE_API_SITE,
+            body_filter: str = const.STACKEXCHANGE_API_FILTER,
+            batch_size: int = const.STACKEXCHANGE_API_BATCH_SIZE,
+            batch_wait: float = const.STACKEXCHANGE_API_BATCH_WAIT,
+            fetch_workers: int = const.STACKEXCHANGE_API_FETCH_WORKERS,
+            **kwargs,
+    ):
+        # The rest of the arguments go to `StackOverflowScrapper` as they are.
+        super().__init__(filter_, config, delay, seen_ids,
+                         fetch_workers=fetch_workers, **kwargs)
+        if not 0 < batch_size <= 100:
+            raise Exception('The API takes 1 to 100 ids per call')
+
+        self.api_url = api_url.rstrip('/')
+        self.api_key = api_key
+        self.site = site
+        self.body_filter = body_filter
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.api_lock = threading.Lock()
+        self.api_backoff_until = 0.0
+        self.quota_remaining: typing.Optional[int] = None
+
+    def __get_api_url__(self, path: str, params: dict) -> str:
+        params = {'site': self.site, 'filter': self.body_filter, **params}
+        if self.api_key is not None:
+            params['key'] = self.api_key
+
+        return f'{self.api_url}{path}?{urllib.parse.urlencode(params)}'
+
+    def __wait_api_backoff__(self):
+        # The API asks to leave a method alone for `backoff` seconds,
+        # ignoring that gets the key or IP banned for a while.
+        with self.api_lock:
+            wait = self.api_backoff_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def __classify_response__(
+            self, status_code: int, challenge: bool) -> typing.Optional[str]:
+        # The API answers a bad filter, invalid ids or a throttle violation
+        # with a 4xx and an `error_id` body. Another proxy gets the same
+        # answer, so it goes to `__get_api_page__` instead of being retried.
+        if 400 <= status_code < 500 \
+                and status_code not in const.PROXY_ERROR_STATUS_CODES \
+                and status_code not in const.THROTTLE_STATUS_CODES:
+            return None
+
+        return super().__classify_response__(status_code, challenge)
+
+    def __get_api_page__(self, path: str, params: dict) -> dict:
+        self.__wait_api_backoff__()
+        url = self.__get_api_url__(path, params)
+        try:
+            data = json.loads(self.__get_source_code__(url, raw=True))
+        except ValueError as e:
+            raise FetchFailedException(url, f'not an API response: {e}')
+        endpoint = 'answers' if path.endswith('/answers') else 'questions'
+        metrics.inc('api_requests_total', endpoint=endpoint)
+
+        with self.api_lock:
+            if 'backoff' in data:
+                self.api_backoff_until = max(
+                    self.api_backoff_until, time.monotonic() + data['backoff'])
+            if 'quota_remaining' in data:
+                self.quota_remaining = data['quota_remaining']
+
+        if 'error_id' in data:
+            raise FetchFailedException(
+                url, f"{data.get('error_name')}: {data.get('error_message')}")
+
+        return data
+
+    def __get_api_items__(self, path: str, params: dict) -> typing.List[dict]:
+        items = []
+        page = 1
+        while True:
+            data = self.__get_api_page__(
+                path, {**params, 'page': page, 'pagesize': 100})
+            items.extend(data.get('items', []))
+            if not data.get('has_more'):
+                return items
+            page += 1
+
+    def __fetch_batch__(
+            self, question_ids: typing.List[str],
+    ) -> typing.List[typing.Tuple[str, typing.Optional[models.StackOverflowQuestion],
+                                  typing.Optional[Exception]]]:
+        ids = ';'.join(question_ids)
+        try:
+            with metrics.timer('api_batch'):
+                question_items = self.__get_api_items__(f'/questions/{ids}', {})
+
+                questions = {}
+                for item in question_items:
+                    reason = question_rejection_reason(item, self.config)
+                    if reason is not None:
+                        metrics.inc('rejected_total', reason=reason)
+                        continue
+                    question = format_api_question(item, self.config, self.parser_backend)
+                    if question is not None:
+                        questions[question.id] = question
+
+                answer_items = collections.defaultdict(list)
+                if questions:
+                    for item in self.__get_api_items__(
+                            f"/questions/{';'.join(questions)}/answers",
+                            {'sort': 'votes', 'order': 'desc'}):
+                        answer_items[str(item['question_id'])].append(item)
+        except Exception as exc:
+            return [(question_id, None, exc) for question_id in question_ids]
+
+        results = []
+        for question_id in question_ids:
+            # Ids missing from the response belong to deleted questions.
+            question = questions.get(question_id)
+            if question is not None:
+                question.answers = format_api_answers(
+                    answer_items[question_id], self.config, self.parser_backend)
+                if not question.answers:
+                    metrics.inc('rejected_total', reason='no_suitable_answers')
+                    question = None
+            results.append((question_id, question, None))
+
+        return results
+
+    def get_question(
+            self, question_id: str) -> typing.Optional[models.StackOverflowQuestion]:
+        _, question, error = self.__fetch_batch__([question_id])[0]
+        if error is not None:
+            raise error
+
+        return question
+
+    def __question_worker__(
+            self, ids_queue: queue.Queue, results: queue.Queue,
+            stop: threading.Event):
+        while True:
+            question_id = get_until(ids_queue, stop)
+            if question_id is None:
+                put_until(results, None, stop)
+                return
+
+            # A batch is sent once it is full or `batch_wait` passed since
+            # its first id, so a slow listing doesn't hold questions back.
+            batch = [question_id]
+            finished = False
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size and not stop.is_set():
+                try:
+                    question_id = ids_queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if question_id is None:
+                    finished = True
+                    break
+                batch.append(question_id)
+
+            for result in self.__fetch_batch__(batch):
+                if not put_until(results, result, stop):
+                    return
+
+            if finished:
+                put_until(results, None, stop)
+                return
+
+    def iter_questions(
+            self, count: int, page_limit: int = 100, skip_ids=None, last_page=1,
+    ) -> typing.Iterator[models.StackOverflowQuestion]:
+        yield from super().iter_questions(count, page_limit, skip_ids, last_page)
+        logger.info(f'API quota remaining: {self.quota_remaining}')
@@ -0,0 +1,435 @@
+from cache import ResponseCache
+from checkpoint import CrawlCheckpoint
+import const
+from exceptions import FetchFailedException
+from hedging import HedgeAttempt, HedgePolicy
+from logger import logger
+from metrics import metrics
+import models
+import parsing
+from proxy_pool import ProxyPool
+from rate_limit import AdaptiveRateController, Backoff
+from scrapper import StackOverflowScrapper
+
+import aiohttp
+import asyncio
+import bs4
+import collections
+import itertools
+import time
+import typing
+import urllib.parse
+
+
+class AsyncStackOverflowScrapper(StackOverflowScrapper):
+    def __init__(
+            self, filter_: models.StackOverflowParserFilter,
+            config: models.StackOverflowParserConfig = (
+                    models.StackOverflowParserConfig()
+            ),
+            delay: int = 0,
+            seen_ids: typing.Optional[typing.Container] = None,
+            concurrency: int = const.ASYNC_CONCURRENCY,
+            per_host_concurrency: int = const.ASYNC_PER_HOST_CONCURRENCY,
+            per_proxy_concurrency: int = const.ASYNC_PER_PROXY_CONCURRENCY,
+            prefetch_pages: int = const.PREFETCH_PAGES,
+            queue_size: int = const.QUESTION_QUEUE_SIZE,
+            stream_window: int = const.STREAM_WINDOW,
+            parser_backend: str = const.PARSER_BACKEND,
+            targeted_parsing: bool = const.PARSER_TARGETED,
+            parse_workers: int = const.PARSE_WORKERS,
+            checkpoint: typing.Optional[CrawlCheckpoint] = None,
+            proxy_pool: typing.Optional[ProxyPool] = None,
+            rate_controller: typing.Optional[AdaptiveRateController] = None,
+            backoff: typing.Optional[Backoff] = None,
+            cache: typing.Optional[ResponseCache] = None,
+            base_url: str = const.STACKOVERFLOW_BASE_URL,
+            hedge: typing.Optional[HedgePolicy] = None,
+    ):
+        if proxy_pool is None:
+            proxy_pool = ProxyPool(
+                const.PAID_PROXY, max_in_flight=per_proxy_concurrency)
+
+        super().__init__(filter_, config, delay, seen_ids,
+                         prefetch_pages=prefetch_pages, queue_size=queue_size,
+                         stream_window=stream_window,
+                         parser_backend=parser_backend,
+                         targeted_parsing=targeted_parsing,
+                         parse_workers=parse_workers,
+                         proxy_pool=proxy_pool,
+                         rate_controller=rate_controller,
+                         backoff=backoff,
+                         cache=cache,
+                         checkpoint=checkpoint,
+                         base_url=base_url,
+                         hedge=hedge)
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.per_proxy_concurrency = per_proxy_concurrency
+
+        self.host_semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+        self.client_session: typing.Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self.client_session is not None:
+            await self.client_session.close()
+            self.client_session = None
+        super().close()
+
+    def __client_session__(self) -> aiohttp.ClientSession:
+        # One session for every request, the connector keeps connections
+        # to each proxy alive and reuses them between fetches.
+        if self.client_session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.per_host_concurrency,
+                keepalive_timeout=const.ASYNC_KEEPALIVE_TIMEOUT,
+                ssl=False,
+            )
+            self.client_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=const.ASYNC_REQUEST_TIMEOUT),
+                trust_env=False,
+            )
+
+        return self.client_session
+
+    def __host_semaphore__(self, url: str) -> asyncio.Semaphore:
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.per_host_concurrency)
+
+        return self.host_semaphores[host]
+
+    async def __make_async_request__(
+            self, url: str,
+            exclude: typing.Container = (),
+            attempt: typing.Optional[HedgeAttempt] = None,
+    ) -> typing.Tuple[str, typing.Optional[bytes], typing.Optional[str]]:
+        with metrics.timer('rate_wait', profile=False):
+            await self.rate_controller.acquire_async()
+        async with self.__host_semaphore__(url):
+            with metrics.timer('proxy_wait', profile=False):
+                proxy = await self.proxy_pool.acquire_async(exclude)
+            if attempt is not None:
+                attempt.send(proxy)
+            started = time.monotonic()
+            try:
+                async with self.__client_session__().get(
+                        url, proxy=f'http://{proxy}') as response:
+                    source_code = await response.read()
+                    status_code = response.status
+            except asyncio.CancelledError:
+                # The losing copy of a hedged request.
+                self.proxy_pool.cancel(proxy)
+                raise
+            except Exception as e:
+                logger.error('Error during request via %s: %s', proxy, e)
+                self.__release_proxy__(
+                    proxy, started, 'error',
+                    timed_out=isinstance(e, asyncio.TimeoutError))
+                return proxy, None, 'error'
+
+        failure = self.__classify_response__(
+            status_code, b'Just a moment...' in source_code)
+        self.__release_proxy__(proxy, started, failure)
+
+        return proxy, source_code, failure
+
+    async def __make_async_hedged_request__(
+            self, url: str,
+            exclude: typing.Container = (),
+    ) -> typing.Tuple[str, typing.Optional[bytes], typing.Optional[str]]:
+        # Same as `__make_hedged_request__`, except that a task can be
+        # cancelled for real: the losing copy is aborted wherever it is.
+        self.hedge.on_request()
+        delay = self.hedge.delay()
+        if delay is None:
+            return await self.__make_async_request__(url, exclude)
+
+        primary, hedge = HedgeAttempt(), HedgeAttempt()
+        primary_task = asyncio.ensure_future(
+            self.__make_async_request__(url, exclude, primary))
+        tasks = {primary_task: primary}
+
+        # The delay counts from the moment the primary copy is sent.
+        while not primary_task.done():
+            timeout = delay if primary.sent_at is None \
+                else primary.sent_at + delay - time.monotonic()
+            if timeout <= 0:
+                break
+            await asyncio.wait({primary_task}, timeout=timeout)
+
+        hedged = False
+        if not primary_task.done() and self.hedge.try_hedge():
+            metrics.inc('hedges_total', outcome='sent')
+            tasks[asyncio.ensure_future(self.__make_async_request__(
+                url, (*exclude, primary.proxy), hedge))] = hedge
+            hedged = True
+
+        result = None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((
+                    task for task in done
+                    if task.result()[2] in (None, 'gone')), None)
+                for task in done:
+                    tasks.pop(task)
+                    result = task.result()
+                if winner is None:
+                    continue
+
+                result = winner.result()
+                if hedged:
+                    metrics.inc('hedges_total',
+                                outcome='lost' if winner is primary_task else 'won')
+                break
+        finally:
+            # The other copy, or both when the fetch itself is cancelled.
+            for task in tasks:
+                task.cancel()
+
+        return result
+
+    async def __get_async_source_code__(self, url: str) -> bytes:
+        # cProfile follows a thread, not a coroutine, so async stages are
+        # only timed.
+        make_request = self.__make_async_hedged_request__ if self.hedge is not None \
+            else self.__make_async_request__
+        with metrics.timer('fetch', profile=False):
+            proxy, source_code, failure = await make_request(url)
+            attempt = 0
+            while failure is not None:
+                if failure == 'gone':
+                    raise FetchFailedException(url, failure)
+                if attempt >= self.backoff.max_retries:
+                    raise FetchFailedException(
+                        url, f'{failure} after {attempt + 1} attempts')
+
+                delay = self.backoff.delay(attempt)
+                logger.warning('No answer from stackoverflow (%s). Retrying in %.1f sec...',
+                               failure, delay)
+                metrics.inc('retries_total', reason=failure)
+                await asyncio.sleep(delay)
+                attempt += 1
+                proxy, source_code, failure = await make_request(url, exclude=(proxy,))
+
+        return source_code
+
+    async def __get_async_question_source__(self, question_id: str) -> bytes:
+        url = self.__get_question_url_encoded__(question_id)
+        if self.cache is not None:
+            source_code = await asyncio.to_thread(self.cache.get, url)
+            if source_code is not None:
+                return source_code
+
+        source_code = await self.__get_async_source_code__(url)
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, url, source_code)
+
+        return source_code
+
+    async def __parse__(self, function, *args, executor=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, function, *args)
+
+    async def __async_page_soup__(self, page: int = 0) -> bs4.BeautifulSoup:
+        source_code = await self.__get_async_source_code__(
+            self.__get_page_url_encoded__(page))
+
+        with metrics.timer('listing_parse', profile=False):
+            return await self.__parse__(
+                parsing.listing_soup, source_code,
+                self.parser_backend, self.targeted_parsing)
+
+    def __format_question_source__(
+            self, question_id: str,
+            source_code: bytes) -> typing.Optional[models.StackOverflowQuestion]:
+        return parsing.parse_question(
+            question_id, source_code, self.config,
+            self.parser_backend, self.targeted_parsing)
+
+    async def get_question(
+            self, question_id: str) -> typing.Optional[models.StackOverflowQuestion]:
+        source_code = await self.__get_async_question_source__(question_id)
+
+        if self.parse_workers > 0:
+            with metrics.timer('parse_task', profile=False):
+                record, drained = await self.__parse__(
+                    parsing.parse_question_record, question_id, source_code,
+                    self.config, self.parser_backend, self.targeted_parsing,
+                    executor=self.__get_parse_pool__())
+            metrics.merge(drained)
+            return None if record is None \
+                else models.StackOverflowQuestion.from_dict(record)
+
+        return await self.__parse__(
+            self.__format_question_source__, question_id, source_code)
+
+    async def __iter_async_page_question_ids__(
+            self, page_limit,
+            skip_ids: typing.Optional[typing.Container] = None,
+            last_page: int = 1,
+    ) -> typing.AsyncIterator[typing.Tuple[int, typing.Optional[typing.List[str]]]]:
+        pages = iter(range(last_page, page_limit))
+        prefetched = collections.deque()
+        for page_number in itertools.islice(pages, max(self.prefetch_pages, 1)):
+            prefetched.append((page_number, asyncio.ensure_future(
+                self.__async_page_soup__(page_number - 1))))
+
+        try:
+            while prefetched:
+                page_number, task = prefetched.popleft()
+                next_page_number = next(pages, None)
+                if next_page_number is not None:
+                    prefetched.append((next_page_number, asyncio.ensure_future(
+                        self.__async_page_soup__(next_page_number - 1))))
+
+                logger.debug('Moving to page %s', page_number)
+                try:
+                    soup = await task
+                except FetchFailedException as e:
+                    logger.error('Listing page %s skipped: %s', page_number, e)
+                    yield page_number, None
+                    continue
+
+                yield page_number, self.__page_question_ids__(soup, skip_ids)
+        finally:
+            for _, pending in prefetched:
+                pending.cancel()
+
+    async def __produce_async_question_ids__(
+            self, ids_queue: asyncio.Queue, count, page_limit,
+            skip_ids: typing.Optional[typing.Container] = None,
+            last_page: int = 1,
+    ) -> int:
+        produced = 0
+        queued = set()
+        self.failed_pages.clear()
+        logger.info("Starting scrapping ids")
+
+        for question_id in self.__resumed_question_ids__(skip_ids)[:count]:
+            await ids_queue.put(question_id)
+            queued.add(question_id)
+            produced += 1
+
+        last_page = self.__resume_page__(last_page)
+        new_last_page = last_page
+        if produced >= count:
+            return new_last_page
+
+        page_question_ids_iterator = self.__iter_async_page_question_ids__(
+            page_limit, skip_ids, last_page)
+        try:
+            async for page_number, page_question_ids in page_question_ids_iterator:
+                new_last_page = self.__record_page__(page_number, page_question_ids)
+                for question_id in page_question_ids or ():
+                    if produced >= count:
+                        break
+                    if question_id in queued:
+                        continue
+                    await ids_queue.put(question_id)
+                    queued.add(question_id)
+                    produced += 1
+
+                if produced >= count:
+                    logger.info(f"Scrapper found {count} questions "
+                                f"in first {page_number} pages. "
+                                f"Stopping scrapping ids")
+                    break
+            else:
+                if produced < count:
+                    logger.info(f"Pages limit reached. "
+                                f"Found {produced} in {page_limit} pages")
+        finally:
+            await page_question_ids_iterator.aclose()
+
+        return new_last_page
+
+    async def __async_question_worker__(
+            self, ids_queue: asyncio.Queue, results: asyncio.Queue):
+        while True:
+            question_id = await ids_queue.get()
+            if question_id is None:
+                await results.put(None)
+                return
+
+            result, error = None, None
+            try:
+                result = await self.get_question(question_id)
+            except Exception as exc:
+                error = exc
+
+            await results.put((question_id, result, error))
+
+    async def iter_questions(
+            self, count: int, page_limit: int = 100, skip_ids=None, last_page=1,
+    ) -> typing.AsyncIterator[models.StackOverflowQuestion]:
+        ids_queue = asyncio.Queue(maxsize=self.queue_size)
+        results = asyncio.Queue(maxsize=self.stream_window)
+        workers_count = max(min(self.concurrency, count), 1)
+        self.last_page = last_page
+
+        async def produce():
+            try:
+                self.last_page = await self.__produce_async_question_ids__(
+                    ids_queue, count, page_limit, skip_ids, last_page)
+            finally:
+                for _ in range(workers_count):
+                    await ids_queue.put(None)
+
+        questions_count = 0
+        answers_quantity = 0
+
+        metrics.gauge('queue_depth', ids_queue.qsize, queue='ids')
+        metrics.gauge('queue_depth', results.qsize, queue='results')
+        producer = asyncio.ensure_future(produce())
+        workers = [
+            asyncio.ensure_future(self.__async_question_worker__(ids_queue, results))
+            for _ in range(workers_count)
+        ]
+        try:
+            finished = 0
+            while finished < workers_count:
+                item = await results.get()
+                if item is None:
+                    finished += 1
+                    continue
+
+                question = self.__resolve_result__(*item)
+                if question is not None:
+                    questions_count += 1
+                    answers_quantity += len(question.answers)
+                    yield question
+
+            await producer
+        finally:
+            # Wait for the cancelled tasks, otherwise they keep running into
+            # the session close of an early `aclose()`.
+            tasks = [producer, *workers]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            metrics.remove_gauge('queue_depth', queue='ids')
+            metrics.remove_gauge('queue_depth', queue='results')
+
+        logger.info(f'Scrapping finished with total of {questions_count} questions and {answers_quantity} answers for them')
+        logger.info(f'Proxies: {self.proxy_pool.summary()}, '
+                    f'rate {self.rate_controller.rate:.1f} req/sec, '
+                    f'{len(self.failed_question_ids)} failed questions')
+        if self.cache is not None:
+            logger.info(f'Cache: {self.cache.summary()}')
+
+    async def get_questions(self, count: int, page_limit: int = 100, skip_ids=None, last_page=1):
+        questions = [
+            question async for question in
+            self.iter_questions(count, page_limit, skip_ids, last_page)
+        ]
+        return questions, self.last_page
@@ -0,0 +1,64 @@
+from models import StackOverflowParserConfig
+from models import StackOverflowParserPolicy
+import parsing
+import utils
+
+import argparse
+import bs4
+import timeit
+
+BACKENDS = ['html.parser', 'lxml', 'html5lib']
+
+
+def bench_listing(source_code: bytes, backend: str, targeted: bool) -> int:
+    soup = parsing.listing_soup(source_code, backend, targeted)
+    questions = soup.find('div', {'id': 'questions'})
+    blocks = [block for block in questions.children if block.name is not None]
+    for block in blocks:
+        utils.prepare_block(block)
+
+    return len(blocks)
+
+
+def bench_question(source_code: bytes, backend: str, targeted: bool,
+                   config: StackOverflowParserConfig) -> int:
+    soup = parsing.question_soup(source_code, backend, targeted)
+    question = utils.format_question('0', soup, config)
+
+    return 0 if question is None else len(question.answers)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Per-page parse cost of the listing and question pages')
+    argument_parser.add_argument('--listing', action='append', default=[])
+    argument_parser.add_argument('--question', action='append', default=[])
+    argument_parser.add_argument('-n', '--number', type=int, default=20)
+    arguments = argument_parser.parse_args()
+
+    config = StackOverflowParserConfig(
+        answers_limit=3, code_policy=StackOverflowParserPolicy.embed)
+    pages = [('listing', path) for path in arguments.listing] + \
+            [('question', path) for path in arguments.question]
+
+    for kind, path in pages:
+        with open(path, 'rb') as file:
+            source_code = file.read()
+
+        print(f'{kind} {path} ({len(source_code) // 1024} KiB)')
+        for backend in BACKENDS:
+            if bs4.builder.builder_registry.lookup(backend) is None:
+                continue
+            for targeted in (False, True):
+                if kind == 'listing':
+                    run = lambda: bench_listing(source_code, backend, targeted)
+                else:
+                    run = lambda: bench_question(source_code, backend, targeted, config)
+
+                seconds = timeit.timeit(run, number=arguments.number)
+                print(f'  {backend:12} targeted={targeted!s:5} '
+                      f'{seconds / arguments.number * 1000:8.2f} ms/page')
+
+
+if __name__ == '__main__':
+    main()
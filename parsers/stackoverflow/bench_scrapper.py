@@ -0,0 +1,305 @@
+from api_scrapper import ApiStackOverflowScrapper
+from async_scrapper import AsyncStackOverflowScrapper
+import bench_server
+from bench_server import ReplayServer
+import const
+from hedging import HedgePolicy
+from logger import logger
+from models import StackOverflowParserConfig
+from models import StackOverflowParserFilter
+from models import StackOverflowParserPolicy
+from models import StackOverflowParserTag
+import parsing
+from proxy_pool import ProxyPool
+from rate_limit import AdaptiveRateController
+from scrapper import StackOverflowScrapper
+import utils
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+import typing
+
+RESULTS_DIR = 'bench_results'
+
+
+def percentiles(samples: typing.List[float]) -> dict:
+    if len(samples) < 2:
+        value = samples[0] if samples else None
+        return {'p50': value, 'p99': value}
+
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p99': cuts[98]}
+
+
+def format_ms(seconds: typing.Optional[float]) -> str:
+    # A run that fetched nothing has no latencies.
+    return 'n/a' if seconds is None else f'{seconds * 1000:.1f} ms'
+
+
+class TimedScrapper(StackOverflowScrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fetch_latencies: typing.List[float] = []
+        self.fetch_latencies_lock = threading.Lock()
+
+    def __get_source_code__(self, url, raw: bool = False):
+        started = time.perf_counter()
+        try:
+            return super().__get_source_code__(url, raw)
+        finally:
+            with self.fetch_latencies_lock:
+                self.fetch_latencies.append(time.perf_counter() - started)
+
+
+class TimedApiScrapper(ApiStackOverflowScrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fetch_latencies: typing.List[float] = []
+        self.fetch_latencies_lock = threading.Lock()
+
+    def __get_source_code__(self, url, raw: bool = False):
+        started = time.perf_counter()
+        try:
+            return super().__get_source_code__(url, raw)
+        finally:
+            with self.fetch_latencies_lock:
+                self.fetch_latencies.append(time.perf_counter() - started)
+
+
+class TimedAsyncScrapper(AsyncStackOverflowScrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fetch_latencies: typing.List[float] = []
+
+    async def __get_async_source_code__(self, url: str) -> bytes:
+        started = time.perf_counter()
+        try:
+            return await super().__get_async_source_code__(url)
+        finally:
+            self.fetch_latencies.append(time.perf_counter() - started)
+
+
+def bench_config() -> StackOverflowParserConfig:
+    return StackOverflowParserConfig(
+        answers_limit=3,
+        tables_policy=StackOverflowParserPolicy.parse,
+        code_policy=StackOverflowParserPolicy.embed)
+
+
+def bench_parse_cost(
+        fixtures: bench_server.Fixtures, config: StackOverflowParserConfig,
+        number: int, backend: str) -> dict:
+    # Median cost of building the tree and of `utils.format_question` for
+    # every question fixture, plus the listing page.
+    def measure(run) -> float:
+        samples = []
+        for _ in range(number):
+            started = time.perf_counter()
+            run()
+            samples.append(time.perf_counter() - started)
+        return statistics.median(samples) * 1000
+
+    pages = {}
+    for index, source_code in enumerate(fixtures.questions):
+        soup = parsing.question_soup(source_code, backend)
+        pages[f'question_{index}'] = {
+            'size_kib': round(len(source_code) / 1024, 1),
+            'parse_ms': measure(lambda: parsing.question_soup(source_code, backend)),
+            'format_ms': measure(lambda: utils.format_question('0', soup, config)),
+        }
+
+    listing = fixtures.listing_page(0)
+    pages['listing'] = {
+        'size_kib': round(len(listing) / 1024, 1),
+        'parse_ms': measure(lambda: parsing.listing_soup(listing, backend)),
+    }
+
+    return {
+        'backend': backend,
+        'pages': pages,
+        'question_parse_ms': statistics.mean(
+            page['parse_ms'] for name, page in pages.items() if name != 'listing'),
+        'question_format_ms': statistics.mean(
+            page['format_ms'] for name, page in pages.items() if name != 'listing'),
+    }
+
+
+def end_to_end_result(
+        questions: int, answers: int, elapsed: float,
+        fetch_latencies: typing.List[float], server: ReplayServer) -> dict:
+    return {
+        'questions': questions,
+        'answers': answers,
+        'seconds': elapsed,
+        'questions_per_second': questions / elapsed if elapsed else None,
+        'requests': server.requests,
+        'fetches': len(fetch_latencies),
+        'fetch_latency': percentiles(fetch_latencies),
+    }
+
+
+def bench_threaded(arguments: argparse.Namespace, server: ReplayServer,
+                   filter_: StackOverflowParserFilter,
+                   config: StackOverflowParserConfig) -> dict:
+    options = dict(
+        fetch_workers=arguments.fetch_workers,
+        parser_backend=arguments.backend,
+        proxy_pool=ProxyPool(
+            [server.address], rate=arguments.rate, max_rate=arguments.rate,
+            max_in_flight=arguments.fetch_workers + arguments.prefetch_pages),
+        rate_controller=AdaptiveRateController(
+            initial_rate=arguments.rate, max_rate=arguments.rate,
+            burst=arguments.fetch_workers),
+        prefetch_pages=arguments.prefetch_pages,
+        base_url=server.url,
+        hedge=HedgePolicy() if arguments.hedge else None)
+    if arguments.engine == 'api':
+        scrapper = TimedApiScrapper(
+            filter_, config, api_url=server.url + bench_server.API_PREFIX, **options)
+    else:
+        scrapper = TimedScrapper(
+            filter_, config, parse_workers=arguments.parse_workers, **options)
+
+    questions, answers = 0, 0
+    started = time.perf_counter()
+    try:
+        for question in scrapper.iter_questions(arguments.questions, 100000):
+            questions += 1
+            answers += len(question.answers)
+    finally:
+        scrapper.close()
+    elapsed = time.perf_counter() - started
+
+    return end_to_end_result(questions, answers, elapsed, scrapper.fetch_latencies, server)
+
+
+async def bench_async(arguments: argparse.Namespace, server: ReplayServer,
+                      filter_: StackOverflowParserFilter,
+                      config: StackOverflowParserConfig) -> dict:
+    # aiohttp sends every request through the proxy, the replay server
+    # doubles as one.
+    async with TimedAsyncScrapper(
+            filter_, config,
+            concurrency=arguments.fetch_workers,
+            per_proxy_concurrency=arguments.fetch_workers,
+            parse_workers=arguments.parse_workers,
+            parser_backend=arguments.backend,
+            proxy_pool=ProxyPool(
+                [server.address], rate=arguments.rate, max_rate=arguments.rate,
+                max_in_flight=arguments.fetch_workers + arguments.prefetch_pages),
+            rate_controller=AdaptiveRateController(
+                initial_rate=arguments.rate, max_rate=arguments.rate,
+                burst=arguments.fetch_workers),
+            prefetch_pages=arguments.prefetch_pages,
+            base_url=server.url,
+            hedge=HedgePolicy() if arguments.hedge else None) as scrapper:
+        questions, answers = 0, 0
+        started = time.perf_counter()
+        async for question in scrapper.iter_questions(arguments.questions, 100000):
+            questions += 1
+            answers += len(question.answers)
+        elapsed = time.perf_counter() - started
+
+    return end_to_end_result(questions, answers, elapsed, scrapper.fetch_latencies, server)
+
+
+def flatten(result: dict, prefix: str = '') -> typing.Dict[str, float]:
+    values = {}
+    for key, value in result.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+
+    return values
+
+
+def compare(previous: dict, current: dict):
+    before = flatten(previous['results'])
+    after = flatten(current['results'])
+    print(f"Compared with {previous['time']}:")
+    for name, value in after.items():
+        if name not in before or not before[name]:
+            continue
+        change = (value - before[name]) / before[name] * 100
+        print(f'  {name:48} {before[name]:12.4f} -> {value:12.4f} ({change:+.1f}%)')
+
+
+def save(result: dict, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"bench-{result['time'].replace(':', '')}.json")
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+
+    return path
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Offline scrapper benchmark against the local replay server')
+    bench_server.add_server_arguments(argument_parser)
+    argument_parser.add_argument('--questions', type=int, default=500)
+    argument_parser.add_argument('--engine', choices=['threaded', 'async', 'api'], default='threaded')
+    argument_parser.add_argument('--fetch-workers', type=int, default=None,
+                                 help='defaults to the engine default')
+    argument_parser.add_argument('--parse-workers', type=int, default=const.PARSE_WORKERS)
+    argument_parser.add_argument('--prefetch-pages', type=int, default=const.PREFETCH_PAGES)
+    argument_parser.add_argument('--rate', type=float, default=10000.0,
+                                 help='request rate cap, high by default to measure the scrapper itself')
+    argument_parser.add_argument('--backend', default=const.PARSER_BACKEND)
+    argument_parser.add_argument('--hedge', action='store_true',
+                                 help='hedge requests slower than the recent ones')
+    argument_parser.add_argument('-n', '--number', type=int, default=20,
+                                 help='repetitions of every parse measurement')
+    argument_parser.add_argument('--output', default=RESULTS_DIR)
+    argument_parser.add_argument('--compare', default=None,
+                                 help='earlier result file to compare with')
+    arguments = argument_parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    if arguments.fetch_workers is None:
+        arguments.fetch_workers = const.STACKEXCHANGE_API_FETCH_WORKERS \
+            if arguments.engine == 'api' else const.FETCH_WORKERS
+    backend = parsing.resolve_backend(arguments.backend)
+    arguments.backend = backend
+    config = bench_config()
+    filter_ = StackOverflowParserFilter([StackOverflowParserTag.python])
+
+    with bench_server.server_from_arguments(arguments) as server:
+        results = {'parse': bench_parse_cost(
+            server.fixtures, config, arguments.number, backend)}
+        if arguments.engine == 'async':
+            results['end_to_end'] = asyncio.run(
+                bench_async(arguments, server, filter_, config))
+        else:
+            results['end_to_end'] = bench_threaded(arguments, server, filter_, config)
+
+    result = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'arguments': vars(arguments),
+        'results': results,
+    }
+    end_to_end = results['end_to_end']
+    print(f"{end_to_end['questions']} questions in {end_to_end['seconds']:.2f} sec, "
+          f"{end_to_end['questions_per_second']:.1f} q/s, "
+          f"fetch p50 {format_ms(end_to_end['fetch_latency']['p50'])}, "
+          f"p99 {format_ms(end_to_end['fetch_latency']['p99'])}")
+    print(f"Question parse {results['parse']['question_parse_ms']:.2f} ms, "
+          f"format_question {results['parse']['question_format_ms']:.2f} ms ({backend})")
+    print(f'Saved to {save(result, arguments.output)}')
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as file:
+            compare(json.load(file), result)
+
+
+if __name__ == '__main__':
+    main()
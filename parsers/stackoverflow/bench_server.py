@@ -0,0 +1,336 @@
+import cache
+import const
+from logger import logger
+import parsing
+import utils
+
+import argparse
+import html
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures')
+LISTING_FIXTURE = 'listing.html'
+CHALLENGE_FIXTURE = 'challenge.html'
+QUESTION_FIXTURE_PREFIX = 'question_'
+
+SUMMARY_ID = re.compile(rb'question-summary-(\d+)')
+LISTING_PAGE = re.compile(r'[?&]page=(\d+)')
+QUESTION_PATH = re.compile(
+    re.escape(const.STACKOVERFLOW_QUESTION_PATH.partition('{}')[0]) + r'(\d+)')
+# Stack Exchange API routes, served under `API_PREFIX` of the same server.
+API_PREFIX = '/api/2.3'
+API_PATH = re.compile(re.escape(API_PREFIX) + r'/questions/([\d;]+)(/answers)?$')
+API_QUOTA_MAX = 10000
+
+
+def prose_html(tag) -> str:
+    return tag.find('div', {'class': 's-prose'}).decode_contents()
+
+
+def api_items(question_id: int, source_code: bytes) -> typing.Tuple[dict, typing.List[dict]]:
+    # The question page turned into what the API returns for it with the
+    # `withbody` filter, answers are numbered after the question.
+    soup = parsing.question_soup(source_code)
+    question_tag = soup.find('div', {'class': 'question'})
+    answers_tag = soup.find('div', {'id': 'answers'})
+
+    answers = []
+    for index, answer_tag in enumerate(answers_tag.find_all('div', {'class': 'answer'})):
+        answer = utils.prepare_answer(answer_tag)
+        answers.append({
+            'answer_id': question_id * 100 + index,
+            'question_id': question_id,
+            'score': answer.score,
+            'is_accepted': answer.has_accepted,
+            'body': prose_html(answer_tag),
+        })
+    answers.sort(key=lambda item: item['score'], reverse=True)
+
+    question = {
+        'question_id': question_id,
+        'title': html.escape(utils.format_question_title(soup)),
+        'score': utils.format_question_score(question_tag),
+        'answer_count': utils.format_answers_count(answers_tag),
+        'body': prose_html(question_tag),
+    }
+    accepted = [item['answer_id'] for item in answers if item['is_accepted']]
+    if accepted:
+        question['accepted_answer_id'] = accepted[0]
+
+    return question, answers
+
+
+class Fixtures:
+    def __init__(self, listing: bytes, questions: typing.List[bytes], challenge: bytes):
+        if not questions:
+            raise Exception('Fixtures need at least one question page')
+
+        self.listing = listing
+        self.questions = questions
+        self.challenge = challenge
+        self.listing_size = len(SUMMARY_ID.findall(listing))
+        self.api_templates: typing.Dict[int, typing.Tuple[dict, typing.List[dict]]] = {}
+        self.api_templates_lock = threading.Lock()
+
+    def listing_page(self, page: int) -> bytes:
+        # The recorded listing is replayed for every page with its question
+        # ids renumbered, so every page lists questions not seen before.
+        counter = iter(range(self.listing_size))
+        return SUMMARY_ID.sub(
+            lambda _: b'question-summary-%d' % (
+                (page + 1) * self.listing_size + next(counter)),
+            self.listing)
+
+    def question_page(self, question_id: int) -> bytes:
+        return self.questions[question_id % len(self.questions)]
+
+    def api_question(self, question_id: int) -> typing.Tuple[dict, typing.List[dict]]:
+        # Every fixture is parsed once, with question id 0, and renumbered.
+        index = question_id % len(self.questions)
+        with self.api_templates_lock:
+            if index not in self.api_templates:
+                self.api_templates[index] = api_items(0, self.questions[index])
+            question, answers = self.api_templates[index]
+
+        question = {**question, 'question_id': question_id}
+        if 'accepted_answer_id' in question:
+            question['accepted_answer_id'] += question_id * 100
+        answers = [
+            {**item, 'answer_id': item['answer_id'] + question_id * 100,
+             'question_id': question_id}
+            for item in answers
+        ]
+
+        return question, answers
+
+
+def read_fixture(directory: str, name: str) -> bytes:
+    with open(os.path.join(directory, name), 'rb') as file:
+        return file.read()
+
+
+def load_fixtures(directory: str = FIXTURES_DIR) -> Fixtures:
+    questions = [
+        read_fixture(directory, name) for name in sorted(os.listdir(directory))
+        if name.startswith(QUESTION_FIXTURE_PREFIX)
+    ]
+
+    return Fixtures(
+        read_fixture(directory, LISTING_FIXTURE), questions,
+        read_fixture(directory, CHALLENGE_FIXTURE))
+
+
+def load_cache_fixtures(
+        cache_directory: str, limit: int = 1000,
+        directory: str = FIXTURES_DIR) -> Fixtures:
+    # Question pages recorded by a real crawl in the response cache,
+    # the listing and challenge pages still come from the fixtures.
+    questions = []
+    for subdirectory in cache.cache_subdirectories(cache_directory):
+        for path in cache.iter_entry_paths(cache_directory, subdirectory):
+            url, source_code, _ = cache.read_entry(path)
+            if QUESTION_PATH.search(urllib.parse.urlparse(url).path):
+                questions.append(source_code)
+            if len(questions) >= limit:
+                break
+        if len(questions) >= limit:
+            break
+
+    logger.info(f'Loaded {len(questions)} recorded question pages from {cache_directory}')
+    return Fixtures(
+        read_fixture(directory, LISTING_FIXTURE), questions,
+        read_fixture(directory, CHALLENGE_FIXTURE))
+
+
+# Stand-in for stackoverflow.com and its API that replays the fixtures. Requests are
+# answered after `latency` (+ up to `jitter`) seconds, a share of them with
+# a 429 or with the challenge page, and `slow_rate` of them `slow_latency`
+# later, the way a congested proxy would. The server also accepts requests in
+# proxy form (absolute URL), so it can be given to the scrapper as a proxy.
+class ReplayServer:
+    def __init__(
+            self, fixtures: Fixtures,
+            latency: float = 0.0, jitter: float = 0.0,
+            error_rate: float = 0.0, challenge_rate: float = 0.0,
+            host: str = '127.0.0.1', port: int = 0,
+            seed: typing.Optional[int] = None,
+            slow_rate: float = 0.0, slow_latency: float = 0.0,
+    ):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.challenge_rate = challenge_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.__handle__(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        http.server.ThreadingHTTPServer.request_queue_size = 1024
+        self.http_server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.http_server.daemon_threads = True
+        self.thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        host, port = self.http_server.server_address[:2]
+        return f'{host}:{port}'
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.address}'
+
+    def __draw__(self) -> typing.Tuple[float, float]:
+        with self.random_lock:
+            self.requests += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.slow_rate:
+                delay += self.slow_latency
+            return self.random.random(), delay
+
+    def __respond__(self, handler: http.server.BaseHTTPRequestHandler,
+                    status: int, body: bytes, content_type: str = 'text/html'):
+        handler.send_response(status)
+        handler.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def __handle__(self, handler: http.server.BaseHTTPRequestHandler):
+        outcome, delay = self.__draw__()
+        time.sleep(delay)
+
+        if outcome < self.error_rate:
+            self.__respond__(handler, 429, b'')
+            return
+        if outcome < self.error_rate + self.challenge_rate:
+            self.__respond__(handler, 403, self.fixtures.challenge)
+            return
+
+        path = urllib.parse.urlsplit(handler.path)
+        api = API_PATH.match(path.path)
+        if api is not None:
+            self.__respond_api__(handler, api, urllib.parse.parse_qs(path.query))
+            return
+
+        target = path.path + ('?' + path.query if path.query else '')
+        page = LISTING_PAGE.search(target)
+        if page is not None:
+            self.__respond__(handler, 200, self.fixtures.listing_page(int(page.group(1))))
+            return
+
+        question = QUESTION_PATH.match(path.path)
+        if question is not None:
+            self.__respond__(handler, 200, self.fixtures.question_page(int(question.group(1))))
+            return
+
+        self.__respond__(handler, 404, b'')
+
+    def __respond_api__(self, handler: http.server.BaseHTTPRequestHandler,
+                        route: re.Match, query: dict):
+        question_ids = [int(question_id) for question_id in route.group(1).split(';')]
+        if len(question_ids) > 100:
+            body = {
+                'error_id': 400,
+                'error_name': 'bad_parameter',
+                'error_message': 'ids can contain up to 100 values',
+            }
+            self.__respond__(handler, 400, json.dumps(body).encode('utf-8'), 'application/json')
+            return
+
+        items = []
+        for question_id in question_ids:
+            question, answers = self.fixtures.api_question(question_id)
+            if route.group(2):
+                items.extend(answers)
+            else:
+                items.append(question)
+
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('pagesize', ['30'])[0])
+        start = (page - 1) * page_size
+        with self.random_lock:
+            quota_remaining = API_QUOTA_MAX - self.requests
+        body = {
+            'items': items[start:start + page_size],
+            'has_more': start + page_size < len(items),
+            'quota_max': API_QUOTA_MAX,
+            'quota_remaining': quota_remaining,
+        }
+        self.__respond__(handler, 200, json.dumps(body).encode('utf-8'), 'application/json')
+
+    def start(self) -> 'ReplayServer':
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def __enter__(self) -> 'ReplayServer':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def add_server_arguments(argument_parser: argparse.ArgumentParser):
+    argument_parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    argument_parser.add_argument('--from-cache', default=None,
+                                 help='replay question pages from a response cache')
+    argument_parser.add_argument('--latency', type=float, default=0.05)
+    argument_parser.add_argument('--jitter', type=float, default=0.02)
+    argument_parser.add_argument('--error-rate', type=float, default=0.0)
+    argument_parser.add_argument('--challenge-rate', type=float, default=0.0)
+    argument_parser.add_argument('--slow-rate', type=float, default=0.0)
+    argument_parser.add_argument('--slow-latency', type=float, default=1.0)
+    argument_parser.add_argument('--seed', type=int, default=0)
+
+
+def server_from_arguments(
+        arguments: argparse.Namespace, port: int = 0) -> ReplayServer:
+    if arguments.from_cache is not None:
+        fixtures = load_cache_fixtures(arguments.from_cache, directory=arguments.fixtures)
+    else:
+        fixtures = load_fixtures(arguments.fixtures)
+
+    return ReplayServer(
+        fixtures, arguments.latency, arguments.jitter,
+        arguments.error_rate, arguments.challenge_rate,
+        port=port, seed=arguments.seed,
+        slow_rate=arguments.slow_rate, slow_latency=arguments.slow_latency)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Serve the benchmark fixtures as a local stackoverflow.com')
+    argument_parser.add_argument('--port', type=int, default=8000)
+    add_server_arguments(argument_parser)
+    arguments = argument_parser.parse_args()
+
+    server = server_from_arguments(arguments, arguments.port)
+    logger.info(f'Replaying fixtures on {server.url}')
+    server.http_server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
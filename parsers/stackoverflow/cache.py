@@ -0,0 +1,187 @@
+import const
+from logger import logger
+
+import collections
+import functools
+import hashlib
+import os
+import struct
+import threading
+import time
+import typing
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENTRY_HEADER = struct.Struct('<4sd')
+ZSTD_CODEC = b'zst1'
+ZLIB_CODEC = b'zlb1'
+
+
+@functools.lru_cache(maxsize=None)
+def warn_zlib_fallback():
+    # Once per process, every entry after the first falls back the same way.
+    logger.warning('zstandard is not installed, the response cache falls back to zlib')
+
+
+def compress(data: bytes, level: int) -> typing.Tuple[bytes, bytes]:
+    if zstandard is not None:
+        return ZSTD_CODEC, zstandard.ZstdCompressor(level=level).compress(data)
+
+    warn_zlib_fallback()
+    return ZLIB_CODEC, zlib.compress(data, min(level, 9))
+
+
+def decompress(codec: bytes, data: bytes) -> bytes:
+    if codec == ZSTD_CODEC:
+        if zstandard is None:
+            raise Exception('zstandard is required to read this cache entry')
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == ZLIB_CODEC:
+        return zlib.decompress(data)
+
+    raise Exception(f"Unknown cache codec '{codec}'")
+
+
+def cache_subdirectories(directory: str) -> typing.List[str]:
+    return sorted(
+        name for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name)))
+
+
+def iter_entry_paths(directory: str, subdirectory: str) -> typing.Iterator[str]:
+    for entry in os.scandir(os.path.join(directory, subdirectory)):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            yield entry.path
+
+
+def read_entry(path: str) -> typing.Tuple[str, bytes, float]:
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    codec, created_at = ENTRY_HEADER.unpack_from(data, 0)
+    payload = decompress(codec, data[ENTRY_HEADER.size:])
+    url, _, body = payload.partition(b'\n')
+
+    return url.decode('utf-8'), body, created_at
+
+
+# Raw responses keyed by the sha256 of their URL. An entry file holds the
+# codec, its creation time and the compressed `url\nbody`. The file mtime is
+# bumped on every hit and is what the LRU eviction goes by.
+class ResponseCache:
+    def __init__(
+            self, directory: str = const.CACHE_DIR,
+            max_size: int = const.CACHE_MAX_SIZE,
+            ttl: typing.Optional[float] = const.CACHE_TTL,
+            level: int = const.CACHE_COMPRESSION_LEVEL,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.level = level
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.entries: typing.OrderedDict[str, int] = collections.OrderedDict()
+        self.size = 0
+        self.__load_index__()
+
+    def __load_index__(self):
+        entries = []
+        for path in self.iter_paths():
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(entries):
+            self.entries[path] = size
+            self.size += size
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __path__(self, url: str) -> str:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def iter_paths(self) -> typing.Iterator[str]:
+        for subdirectory in cache_subdirectories(self.directory):
+            yield from iter_entry_paths(self.directory, subdirectory)
+
+    def __forget__(self, path: str):
+        size = self.entries.pop(path, None)
+        if size is not None:
+            self.size -= size
+
+    def __remove__(self, path: str):
+        self.__forget__(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, url: str) -> typing.Optional[bytes]:
+        path = self.__path__(url)
+        with self.lock:
+            if path not in self.entries:
+                self.misses += 1
+                return None
+
+        try:
+            cached_url, body, created_at = read_entry(path)
+        except Exception as e:
+            logger.error("Broken cache entry for '%s': %s", url, e)
+            with self.lock:
+                self.__remove__(path)
+                self.misses += 1
+            return None
+
+        with self.lock:
+            if cached_url != url or (
+                    self.ttl is not None and time.time() - created_at > self.ttl):
+                self.__remove__(path)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return body
+
+    def put(self, url: str, body: bytes):
+        codec, data = compress(url.encode('utf-8') + b'\n' + body, self.level)
+        data = ENTRY_HEADER.pack(codec, time.time()) + data
+
+        path = self.__path__(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.__forget__(path)
+            self.entries[path] = len(data)
+            self.size += len(data)
+            self.__evict__()
+
+    def __evict__(self):
+        while self.size > self.max_size and len(self.entries) > 1:
+            path = next(iter(self.entries))
+            self.__remove__(path)
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f'{len(self.entries)} cached responses, '
+                    f'{self.size / 2 ** 20:.1f} MiB, '
+                    f'{self.hits} hits, {self.misses} misses')
@@ -0,0 +1,148 @@
+import const
+from logger import logger
+
+import json
+import os
+import threading
+import typing
+
+
+# Append-only journal of the crawl. Every event is flushed right away so a
+# killed process loses nothing; page events are also fsync'd, and once the
+# journal grows past `compact_after` events it is replaced by a snapshot.
+class CrawlCheckpoint:
+    def __init__(
+            self, path: str = const.CHECKPOINT_PATH,
+            compact_after: int = const.CHECKPOINT_COMPACT_AFTER,
+    ):
+        self.path = path
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+
+        self.cursors: typing.Dict[str, int] = {}
+        self.pending: typing.Dict[str, str] = {}
+        self.failed: typing.Dict[str, int] = {}
+        # Filter key a failed id was listed under, retries resume with it.
+        self.failed_filters: typing.Dict[str, str] = {}
+        self.completed = 0
+        self.events = 0
+
+        if os.path.exists(path):
+            self.__replay__()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __replay__(self):
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line of a crashed write.
+                    logger.warning("Skipping broken checkpoint line in '%s'", self.path)
+                    continue
+                self.__apply__(event)
+                self.events += 1
+
+        logger.info(f'Checkpoint restored: {len(self.pending)} pending, '
+                    f'{len(self.failed)} failed, {self.completed} completed')
+
+    def __apply__(self, event: dict):
+        kind = event['event']
+        if kind == 'snapshot':
+            self.cursors = event['cursors']
+            self.pending = event['pending']
+            self.failed = event['failed']
+            self.failed_filters = event.get('failed_filters', {})
+            self.completed = event['completed']
+        elif kind == 'page':
+            self.cursors[event['filter']] = max(
+                event['page'], self.cursors.get(event['filter'], 0))
+            for question_id in event['ids']:
+                self.pending.setdefault(question_id, event['filter'])
+        elif kind == 'done':
+            self.pending.pop(event['id'], None)
+            self.failed.pop(event['id'], None)
+            self.failed_filters.pop(event['id'], None)
+            self.completed += 1
+        elif kind == 'failed':
+            filter_key = self.pending.pop(event['id'], event.get('filter'))
+            if filter_key is not None:
+                self.failed_filters[event['id']] = filter_key
+            self.failed[event['id']] = self.failed.get(event['id'], 0) + 1
+        else:
+            raise Exception(f"Unknown checkpoint event '{kind}'")
+
+    def __write__(self, event: dict, sync: bool = False):
+        with self.lock:
+            self.__apply__(event)
+            self.file.write(json.dumps(event) + '\n')
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+            self.events += 1
+            if self.events >= self.compact_after:
+                self.__compact__()
+
+    def __compact__(self):
+        snapshot = {
+            'event': 'snapshot',
+            'cursors': self.cursors,
+            'pending': self.pending,
+            'failed': self.failed,
+            'failed_filters': self.failed_filters,
+            'completed': self.completed,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(snapshot) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.events = 1
+
+    def cursor(self, filter_key: str) -> int:
+        with self.lock:
+            return self.cursors.get(filter_key, 0)
+
+    def page_scanned(self, filter_key: str, page: int, question_ids: typing.List[str]):
+        self.__write__(
+            {'event': 'page', 'filter': filter_key, 'page': page, 'ids': question_ids},
+            sync=True)
+
+    def question_done(self, question_id: str):
+        self.__write__({'event': 'done', 'id': question_id})
+
+    def question_failed(self, question_id: str):
+        # The filter goes to the journal as well, a retried id is no longer
+        # pending by the time it fails again.
+        with self.lock:
+            filter_key = self.pending.get(
+                question_id, self.failed_filters.get(question_id))
+        self.__write__({'event': 'failed', 'id': question_id, 'filter': filter_key})
+
+    def resumable_ids(
+            self, filter_key: typing.Optional[str] = None,
+            max_retries: int = const.CHECKPOINT_MAX_RETRIES,
+    ) -> typing.List[str]:
+        with self.lock:
+            pending = [
+                question_id for question_id, key in self.pending.items()
+                if filter_key is None or key == filter_key
+            ]
+            retried = [
+                question_id for question_id, retries in self.failed.items()
+                if retries < max_retries and (
+                    filter_key is None or self.failed_filters.get(question_id) == filter_key)
+            ]
+
+        return pending + retried
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
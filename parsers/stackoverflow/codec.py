@@ -0,0 +1,189 @@
+from logger import logger
+import models
+
+import collections.abc
+import functools
+import json
+import struct
+import typing
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Version of the positional record layout, see `StackOverflowQuestion.row()`.
+# Version 2 added `filters` and version 3 `revision`, older rows are read
+# with their defaults.
+SCHEMA_VERSION = 3
+
+MSGPACK_CODEC = 'msgpack'
+JSON_CODEC = 'json'
+
+# Payload length and question id length, the id is stored in front of the
+# payload so it can be read without decoding the record.
+FRAME_HEADER = struct.Struct('<IH')
+
+QuestionLike = typing.Union[models.StackOverflowQuestion, typing.Mapping]
+
+
+@functools.lru_cache(maxsize=None)
+def warn_json_fallback():
+    logger.warning('msgpack is not installed, the corpus falls back to the JSON codec')
+
+
+def default_codec() -> str:
+    if msgpack is None:
+        warn_json_fallback()
+        return JSON_CODEC
+
+    return MSGPACK_CODEC
+
+
+def resolve_codec(codec: str) -> str:
+    if codec == 'auto':
+        return default_codec()
+    if codec == MSGPACK_CODEC and msgpack is None:
+        raise Exception('msgpack is required for the msgpack corpus codec')
+    if codec not in (MSGPACK_CODEC, JSON_CODEC):
+        raise Exception(f"Unknown corpus codec '{codec}'")
+
+    return codec
+
+
+def pack(row: list, codec: str) -> bytes:
+    if codec == MSGPACK_CODEC:
+        return msgpack.packb(row, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(row)
+
+    return json.dumps(row, separators=(',', ':')).encode('utf-8')
+
+
+def unpack(data: bytes, codec: str) -> list:
+    if codec == MSGPACK_CODEC:
+        if msgpack is None:
+            raise Exception('msgpack is required to read this corpus shard')
+        return msgpack.unpackb(data, raw=False)
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def question_row(question: QuestionLike) -> list:
+    if isinstance(question, models.StackOverflowQuestion):
+        return question.row()
+    if isinstance(question, LazyQuestionRecord):
+        return question.row()
+
+    return [
+        question['id'], question['title'], question['score'],
+        question['answers_count'], question['body'],
+        [
+            [answer['id'], answer['score'], answer['has_accepted'], answer['body']]
+            for answer in question['answers']
+        ],
+        question.get('filters', []),
+        question.get('revision', 0),
+    ]
+
+
+def upgrade_row(row: list, schema: int) -> list:
+    if schema == 1:
+        return row + [[], 0]
+    if schema == 2:
+        return row + [0]
+    if schema != SCHEMA_VERSION:
+        raise Exception(f'Unsupported corpus schema version {schema}')
+
+    return row
+
+
+def row_dict(row: list) -> dict:
+    question_id, title, score, answers_count, body, answers, filters, revision = row
+    return {
+        'id': question_id,
+        'title': title,
+        'score': score,
+        'answers_count': answers_count,
+        'body': body,
+        'answers': [
+            {
+                'id': answer_id,
+                'score': answer_score,
+                'has_accepted': has_accepted,
+                'body': answer_body,
+            }
+            for answer_id, answer_score, has_accepted, answer_body in answers
+        ],
+        'filters': filters,
+        'revision': revision,
+    }
+
+
+def encode_frame(question: QuestionLike, codec: str) -> bytes:
+    row = question_row(question)
+    question_id = str(row[0]).encode('utf-8')
+    payload = pack(row, codec)
+
+    return FRAME_HEADER.pack(len(payload), len(question_id)) + question_id + payload
+
+
+def read_frames(file: typing.BinaryIO) -> typing.Iterator[typing.Tuple[str, bytes]]:
+    while True:
+        header = file.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+
+        payload_size, id_size = FRAME_HEADER.unpack(header)
+        question_id = file.read(id_size).decode('utf-8')
+        payload = file.read(payload_size)
+        if len(payload) < payload_size:
+            raise Exception(f'Truncated corpus frame of question {question_id}')
+
+        yield question_id, payload
+
+
+# A stored question that keeps its encoded payload and is only decoded when
+# one of its fields other than the id is read. It reads like the record dict
+# the store used to return, `question()` gives the model object.
+class LazyQuestionRecord(collections.abc.Mapping):
+    __slots__ = ('id', 'payload', 'codec', 'schema', 'decoded')
+
+    def __init__(self, question_id: str, payload: bytes, codec: str,
+                 schema: int = SCHEMA_VERSION):
+        self.id = question_id
+        self.payload = payload
+        self.codec = codec
+        self.schema = schema
+        self.decoded: typing.Optional[dict] = None
+
+    def row(self) -> list:
+        return upgrade_row(unpack(self.payload, self.codec), self.schema)
+
+    def dict(self) -> dict:
+        if self.decoded is None:
+            self.decoded = row_dict(self.row())
+
+        return self.decoded
+
+    def question(self) -> models.StackOverflowQuestion:
+        return models.StackOverflowQuestion.from_row(self.row())
+
+    def __getitem__(self, key: str):
+        if key == 'id':
+            return self.id
+
+        return self.dict()[key]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self.dict())
+
+    def __len__(self) -> int:
+        return len(self.dict())
@@ -1,11 +1,24 @@
+import functools
 import logging
+import os
 import sys
 
-STACKOVERFLOW_URL = 'https://stackoverflow.com/questions/tagged/{}?sort={}&page={}'
+STACKOVERFLOW_BASE_URL = 'https://stackoverflow.com'
+STACKOVERFLOW_LISTING_PATH = '/questions/tagged/{}?sort={}&page={}'
+STACKOVERFLOW_QUESTION_PATH = '/questions/{}'
+STACKOVERFLOW_URL = STACKOVERFLOW_BASE_URL + STACKOVERFLOW_LISTING_PATH
 STACK_OVERFLOW_URL_Q = 'https://stackoverflow.com/search?q='
-STACKOVERFLOW_QUESTION_URL = 'https://stackoverflow.com/questions/{}'
-LOGGING_LEVEL = logging.DEBUG
+STACKOVERFLOW_QUESTION_URL = STACKOVERFLOW_BASE_URL + STACKOVERFLOW_QUESTION_PATH
+STACKEXCHANGE_API_URL = 'https://api.stackexchange.com/2.3'
+STACKEXCHANGE_API_SITE = 'stackoverflow'
+STACKEXCHANGE_API_FILTER = 'withbody'
+STACKEXCHANGE_API_KEY = None
+LOGGING_LEVEL = logging.INFO
 LOGGING_HANDLERS = [logging.StreamHandler(sys.stdout)]
+LOGGING_JSON = True
+LOGGING_SAMPLE_RATE = 10.0
+LOGGING_SAMPLE_BURST = 100.0
+LOGGING_SAMPLE_MAX_EVENTS = 10000
 
 PROXIES_COUNTRIES = [
     'MO',
@@ -30,11 +43,126 @@ PROXIES_COUNTRIES = [
     'JP'
 ]
 
-f = open('proxy_list.txt', "r")
-PAID_PROXY = f.read().split('\n')
+PROXY_LIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy_list.txt')
 
 
 PROXY_USERNAME = 'oyjEHM'
 PROXY_PASSWORD = 'zEBuDW'
 
 PROXY_TIMEOUT = 1
+PROXY_RATE = 1.0
+PROXY_MAX_RATE = 5.0
+PROXY_MAX_IN_FLIGHT = 4
+PROXY_EJECT_AFTER = 3
+PROXY_COOLDOWN = 30
+PROXY_MAX_COOLDOWN = 600
+PROXY_STATS_SMOOTHING = 0.2
+
+CORPUS_DIR = 'corpus'
+CORPUS_MANIFEST = 'manifest.json'
+CORPUS_SHARD_SIZE = 50000
+CORPUS_COMPRESS = True
+# 'msgpack', 'json' (orjson when installed) or 'auto' for msgpack if installed.
+CORPUS_CODEC = 'auto'
+CORPUS_COMPRESSION_LEVEL = 6
+
+# Training text exports, see export.py. Questions go to validation by a
+# hash of their id, the salt picks another split of the same corpus.
+EXPORT_VALIDATION_RATIO = 0.1
+EXPORT_SPLIT_SALT = ''
+EXPORT_T5_CONST_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'hpc_scripts', 't5', 'const.py')
+
+METRICS_DUMP_PATH = 'metrics.json'
+METRICS_DUMP_INTERVAL = 60
+# Port of the Prometheus text endpoint, None keeps it off.
+METRICS_PORT = None
+# Stages run under cProfile, e.g. ('parse', 'format'), dumped to PROFILE_DIR.
+PROFILE_STAGES = ()
+PROFILE_DIR = 'profiles'
+
+ID_INDEX_PATH = 'seen_ids.bitmap'
+ID_INDEX_INITIAL_SIZE = 1 << 20
+
+ASYNC_CONCURRENCY = 1000
+ASYNC_PER_HOST_CONCURRENCY = 200
+ASYNC_PER_PROXY_CONCURRENCY = 20
+ASYNC_REQUEST_TIMEOUT = 3
+ASYNC_KEEPALIVE_TIMEOUT = 30
+
+PREFETCH_PAGES = 4
+FETCH_WORKERS = 32
+QUESTION_QUEUE_SIZE = 100
+STREAM_WINDOW = 100
+QUEUE_POLL_INTERVAL = 0.1
+# 'pages' scrapes question pages, 'api' fetches them in batches through
+# the Stack Exchange API (listing pages are scraped either way).
+FETCH_BACKEND = 'pages'
+STACKEXCHANGE_API_BATCH_SIZE = 100
+STACKEXCHANGE_API_BATCH_WAIT = 0.5
+STACKEXCHANGE_API_FETCH_WORKERS = 2
+
+PARSER_BACKEND = 'lxml'
+PARSER_TARGETED = True
+PARSE_WORKERS = 0
+PARSE_START_METHOD = 'spawn'
+
+RATE_INITIAL = 10.0
+RATE_MIN = 0.5
+RATE_MAX = 200.0
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+RATE_BURST = 5.0
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+FETCH_MAX_RETRIES = 8
+REQUEST_TIMEOUT = 3
+THROTTLE_STATUS_CODES = (429, 503)
+GONE_STATUS_CODES = (404, 410)
+# Answered by the proxy itself, the page never reached stackoverflow.
+PROXY_ERROR_STATUS_CODES = (407,)
+
+HEDGE_REQUESTS = False
+HEDGE_QUANTILE = 0.95
+HEDGE_MAX_RATIO = 0.05
+HEDGE_BURST = 10.0
+HEDGE_MIN_DELAY = 0.05
+HEDGE_WINDOW = 1000
+HEDGE_MIN_SAMPLES = 50
+
+DUMP_CHUNKS_PER_WORKER = 4
+DUMP_BATCH_SIZE = 500
+
+CACHE_DIR = 'response_cache'
+CACHE_MAX_SIZE = 20 * 2 ** 30
+CACHE_TTL = None
+CACHE_COMPRESSION_LEVEL = 9
+
+CHECKPOINT_PATH = 'crawl.checkpoint'
+CHECKPOINT_COMPACT_AFTER = 100000
+CHECKPOINT_MAX_RETRIES = 3
+
+WORK_QUEUE_PATH = 'work_queue.sqlite'
+WORK_QUEUE_LEASE = 120.0
+WORK_QUEUE_MAX_ATTEMPTS = 3
+WORK_QUEUE_BATCH_SIZE = 100
+WORK_QUEUE_POLL_INTERVAL = 1.0
+WORK_QUEUE_BUSY_TIMEOUT = 30.0
+
+REFRESH_SUMMARIES_PATH = 'refresh_summaries.sqlite'
+REFRESH_QUIET_PAGES = 5
+
+
+@functools.lru_cache(maxsize=None)
+def load_proxy_list(path: str = PROXY_LIST_PATH) -> list:
+    with open(path, 'r') as file:
+        return [proxy.strip() for proxy in file.read().split('\n') if proxy.strip()]
+
+
+def __getattr__(name: str):
+    # Read on first use, from next to this file rather than the working
+    # directory, so commands that never make a request don't need the list.
+    if name == 'PAID_PROXY':
+        return load_proxy_list()
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
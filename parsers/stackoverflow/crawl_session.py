@@ -0,0 +1,145 @@
+from logger import logger
+from metrics import metrics
+import models
+from scrapper import StackOverflowScrapper
+import utils
+
+import bs4
+import collections
+import threading
+import typing
+
+
+def block_matches_filter(
+        block: models.StackOverflowQuestionBlock,
+        filter_: models.StackOverflowParserFilter) -> bool:
+    return all(tag.value in block.tags for tag in filter_.tags) \
+        and utils.block_rejection_reason(block, filter_) is None
+
+
+# One crawl over several filters. Their listing pages are read in turns, a
+# page of each filter at a time, and feed a single fetch pipeline, so proxies,
+# rate limit and dedup are shared. A question is fetched once and carries the
+# keys of every filter it matched in `filters`: the ones whose listing showed
+# it while it was in flight, and the ones its summary tags and stats fit.
+class CrawlSession(StackOverflowScrapper):
+    def __init__(
+            self, filters: typing.List[models.StackOverflowParserFilter],
+            config: models.StackOverflowParserConfig = (
+                    models.StackOverflowParserConfig()
+            ),
+            delay: int = 0,
+            seen_ids: typing.Optional[typing.Container] = None,
+            **kwargs,
+    ):
+        if not filters:
+            raise Exception('Crawl session needs at least one filter')
+
+        # The rest of the arguments go to `StackOverflowScrapper` as they are.
+        super().__init__(filters[0], config, delay, seen_ids, **kwargs)
+        self.filters = filters
+        self.last_pages: typing.Dict[str, int] = {}
+        # Filters that matched the summaries of the page being read, only
+        # touched by the producer thread.
+        self.listed: typing.Dict[str, typing.Set[str]] = {}
+        # Filters of the questions in flight, until they are resolved.
+        self.attributions: typing.Dict[str, typing.Set[str]] = {}
+        self.attributions_lock = threading.Lock()
+
+    def __is_question_block_suitable__(
+            self, question_block: bs4.element.Tag,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None) -> bool:
+        filter_ = filter_ if filter_ is not None else self.filter
+        block = utils.prepare_block(question_block)
+        block_id = question_block.attrs['id']
+        question_id = block_id.partition('question-summary-')[2]
+
+        reason = utils.block_rejection_reason(block, filter_)
+        if reason is not None:
+            logger.debug('%s is not suitable due to %s', question_id, reason)
+            metrics.inc('rejected_total', reason=reason)
+            return False
+
+        self.listed[question_id] = {filter_.key()} | {
+            other.key() for other in self.filters
+            if other is not filter_ and block_matches_filter(block, other)
+        }
+        return True
+
+    def __attribute__(self, question_id: str, keys: typing.Set[str], queued: bool):
+        # A question listed again after it was resolved is already out with
+        # the filters known at that point.
+        with self.attributions_lock:
+            if not queued:
+                self.attributions[question_id] = set(keys)
+            elif question_id in self.attributions:
+                self.attributions[question_id].update(keys)
+
+    def __question_filters__(self, question_id: str) -> typing.List[str]:
+        with self.attributions_lock:
+            keys = self.attributions.pop(question_id, {self.filter.key()})
+
+        return sorted(keys)
+
+    def __produce_question_ids__(
+            self, put: typing.Callable[[str], bool], count, page_limit,
+            skip_ids: typing.Optional[typing.Container] = None,
+            last_page: int = 1,
+    ) -> int:
+        produced = 0
+        queued = set()
+        self.failed_pages.clear()
+        logger.info(f"Starting scrapping ids of {len(self.filters)} filters")
+
+        for filter_ in self.filters:
+            for question_id in self.__resumed_question_ids__(skip_ids, filter_):
+                if produced >= count:
+                    break
+                self.__attribute__(question_id, {filter_.key()}, question_id in queued)
+                if question_id in queued:
+                    continue
+                if not put(question_id):
+                    return last_page
+                queued.add(question_id)
+                produced += 1
+
+        streams = collections.deque(
+            (filter_, self.__iter_page_question_ids__(
+                page_limit, skip_ids, self.__resume_page__(last_page, filter_), filter_))
+            for filter_ in self.filters
+        )
+        try:
+            while streams and produced < count:
+                filter_, stream = streams[0]
+                streams.rotate(-1)
+                page = next(stream, None)
+                listed, self.listed = self.listed, {}
+                if page is None:
+                    logger.info(f"Pages limit reached for {filter_.key()}")
+                    streams.remove((filter_, stream))
+                    continue
+
+                page_number, page_question_ids = page
+                self.last_pages[filter_.key()] = self.__record_page__(
+                    page_number, page_question_ids, filter_)
+                for question_id in page_question_ids or ():
+                    if produced >= count:
+                        break
+                    self.__attribute__(
+                        question_id, listed.get(question_id, {filter_.key()}),
+                        question_id in queued)
+                    if question_id in queued:
+                        metrics.inc('rejected_total', reason='duplicate')
+                        continue
+                    # Blocks while fetch workers are behind.
+                    if not put(question_id):
+                        return max(self.last_pages.values(), default=last_page)
+                    queued.add(question_id)
+                    produced += 1
+        finally:
+            for _, stream in streams:
+                stream.close()
+
+        if produced >= count:
+            logger.info(f"Scrapper found {count} questions, stopping scrapping ids")
+        return max(self.last_pages.values(), default=last_page)
@@ -0,0 +1,256 @@
+import const
+from dump_ingest import add_filter_arguments
+from dump_ingest import filter_from_arguments
+from id_index import QuestionIdIndex
+from logger import logger
+import models
+from reparse import add_config_arguments
+from reparse import config_from_arguments
+from scrapper import StackOverflowScrapper
+from storage import ShardedCorpusStore
+from work_queue import Lease
+from work_queue import PAGE_TASK
+from work_queue import QUESTION_TASK
+from work_queue import SqliteWorkQueue
+from work_queue import WorkQueue
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import socket
+import threading
+import time
+import typing
+
+
+def page_key(filter_: models.StackOverflowParserFilter, page: int) -> str:
+    return f'{filter_.key()}#{page}'
+
+
+def seed(
+        queue: WorkQueue, filter_: models.StackOverflowParserFilter,
+        first_page: int, last_page: int) -> int:
+    # Every listing page is a task of its own, the filter travels with it.
+    payload = json.dumps(filter_.dict())
+    added = queue.add(
+        PAGE_TASK, (page_key(filter_, page) for page in range(first_page, last_page)),
+        payload)
+    logger.info(f'Seeded {added} listing pages of {filter_.key()}')
+
+    return added
+
+
+# Takes listing pages and question ids from the queue until it is drained.
+# A page task adds the ids it lists as question tasks, and since tasks are
+# unique by id, a question listed by several pages or workers is fetched
+# once. Claimed tasks are heartbeat from a thread of their own and committed
+# after the questions are in this worker's store.
+class CrawlWorker:
+    def __init__(
+            self, queue: WorkQueue, store: ShardedCorpusStore,
+            config: models.StackOverflowParserConfig = (
+                    models.StackOverflowParserConfig()
+            ),
+            name: typing.Optional[str] = None,
+            seen_ids: typing.Optional[QuestionIdIndex] = None,
+            lease: float = const.WORK_QUEUE_LEASE,
+            batch_size: int = const.WORK_QUEUE_BATCH_SIZE,
+            poll_interval: float = const.WORK_QUEUE_POLL_INTERVAL,
+            **scrapper_options,
+    ):
+        self.queue = queue
+        self.store = store
+        self.config = config
+        self.name = name if name is not None else f'{socket.gethostname()}-{os.getpid()}'
+        self.seen_ids = seen_ids
+        self.lease = lease
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.scrapper_options = scrapper_options
+        self.scrapper: typing.Optional[StackOverflowScrapper] = None
+        self.scrapper_lock = threading.Lock()
+        self.filters: typing.Dict[str, models.StackOverflowParserFilter] = {}
+
+        self.held: typing.Dict[str, typing.Set[str]] = {PAGE_TASK: set(), QUESTION_TASK: set()}
+        self.held_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def __filter__(self, payload: str) -> models.StackOverflowParserFilter:
+        if payload not in self.filters:
+            self.filters[payload] = models.StackOverflowParserFilter.from_dict(
+                json.loads(payload))
+
+        return self.filters[payload]
+
+    def __scrapper__(self, payload: str) -> StackOverflowScrapper:
+        # One scrapper for every filter, so the worker has one proxy pool
+        # and rate budget. Page tasks pass their filter to it, question
+        # tasks only need the config.
+        with self.scrapper_lock:
+            if self.scrapper is None:
+                self.scrapper = StackOverflowScrapper(
+                    self.__filter__(payload), self.config,
+                    seen_ids=self.seen_ids, **self.scrapper_options)
+
+            return self.scrapper
+
+    def __hold__(self, leases: typing.List[Lease]):
+        with self.held_lock:
+            for lease in leases:
+                self.held[lease.kind].add(lease.key)
+
+    def __release__(self, kind: str, keys: typing.Iterable[str]):
+        with self.held_lock:
+            self.held[kind].difference_update(keys)
+
+    def __heartbeat__(self):
+        while not self.stopped.wait(self.lease / 3):
+            for kind in (PAGE_TASK, QUESTION_TASK):
+                with self.held_lock:
+                    keys = list(self.held[kind])
+                if not keys:
+                    continue
+
+                try:
+                    held = self.queue.heartbeat(self.name, kind, keys, self.lease)
+                except Exception as e:
+                    logger.error(f"Can't heartbeat {len(keys)} {kind} tasks: {e}")
+                    continue
+                lost = set(keys) - set(held)
+                if lost:
+                    logger.warning('Lost the lease of %s %s tasks', len(lost), kind)
+                    self.__release__(kind, lost)
+
+    def __run_page__(self, lease: Lease):
+        scrapper = self.__scrapper__(lease.payload)
+        filter_ = self.__filter__(lease.payload)
+        page = int(lease.key.rpartition('#')[2])
+        try:
+            # Page keys are 1-based like the crawl's page numbers and
+            # checkpoint cursors, `__page_soup__` takes them from 0.
+            question_ids = scrapper.__page_question_ids__(
+                scrapper.__page_soup__(page - 1, filter_), filter_=filter_)
+        except Exception as e:
+            logger.error('Listing page task %s failed: %s', lease.key, e)
+            self.queue.fail(self.name, PAGE_TASK, [lease.key])
+            return
+
+        added = self.queue.add(QUESTION_TASK, question_ids, lease.payload)
+        self.queue.commit(self.name, PAGE_TASK, [lease.key])
+        logger.info('Page task %s: %s questions, %s new', lease.key, len(question_ids), added)
+
+    def __fetch__(self, lease: Lease) -> typing.Tuple[
+            str, typing.Optional[models.StackOverflowQuestion], typing.Optional[Exception]]:
+        try:
+            return lease.key, self.__scrapper__(lease.payload).get_question(lease.key), None
+        except Exception as e:
+            return lease.key, None, e
+
+    def __run_questions__(self, leases: typing.List[Lease], executor: ThreadPoolExecutor):
+        questions, done, failed = [], [], []
+        for question_id, question, error in executor.map(self.__fetch__, leases):
+            if error is not None:
+                logger.error('Question id %s generated an exception: %s', question_id, error)
+                failed.append(question_id)
+                continue
+            done.append(question_id)
+            if question is not None:
+                questions.append(question)
+
+        # Stored before the commit: a worker dying in between leaves the
+        # tasks to be fetched again rather than lost.
+        if questions:
+            self.store.append(questions)
+            if self.seen_ids is not None:
+                self.seen_ids.update(question.id for question in questions)
+                self.seen_ids.sync(len(self.store))
+        self.queue.commit(self.name, QUESTION_TASK, done)
+        self.queue.fail(self.name, QUESTION_TASK, failed)
+
+    def run(self) -> int:
+        # Questions go before pages, so the queue holds about one page of
+        # question tasks per worker instead of growing with the listing.
+        heartbeat = threading.Thread(target=self.__heartbeat__, daemon=True)
+        heartbeat.start()
+        stored = len(self.store)
+        fetch_workers = self.scrapper_options.get('fetch_workers', const.FETCH_WORKERS)
+
+        try:
+            with ThreadPoolExecutor(fetch_workers) as executor:
+                while True:
+                    leases = self.queue.claim(
+                        self.name, QUESTION_TASK, self.batch_size, self.lease)
+                    if not leases:
+                        leases = self.queue.claim(self.name, PAGE_TASK, 1, self.lease)
+                    if not leases:
+                        if self.queue.is_drained():
+                            break
+                        time.sleep(self.poll_interval)
+                        continue
+
+                    self.__hold__(leases)
+                    try:
+                        if leases[0].kind == PAGE_TASK:
+                            self.__run_page__(leases[0])
+                        else:
+                            self.__run_questions__(leases, executor)
+                    finally:
+                        self.__release__(leases[0].kind, (lease.key for lease in leases))
+        finally:
+            self.stopped.set()
+            heartbeat.join()
+            if self.scrapper is not None:
+                self.scrapper.close()
+
+        stored = len(self.store) - stored
+        logger.info(f'Worker {self.name} finished, {stored} questions stored')
+        return stored
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Crawl through a shared queue of leased listing page and question tasks')
+    argument_parser.add_argument('--queue', default=const.WORK_QUEUE_PATH)
+    commands = argument_parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='add listing pages of a filter')
+    seed_parser.add_argument('--first-page', type=int, default=1)
+    seed_parser.add_argument('--last-page', type=int, default=100)
+    add_filter_arguments(seed_parser)
+
+    work_parser = commands.add_parser('work', help='process tasks until the queue is drained')
+    work_parser.add_argument('--output', required=True)
+    work_parser.add_argument('--name', default=None)
+    work_parser.add_argument('--seen-ids', default=None)
+    work_parser.add_argument('--lease', type=float, default=const.WORK_QUEUE_LEASE)
+    work_parser.add_argument('--batch-size', type=int, default=const.WORK_QUEUE_BATCH_SIZE)
+    work_parser.add_argument('--fetch-workers', type=int, default=const.FETCH_WORKERS)
+    add_config_arguments(work_parser)
+
+    commands.add_parser('status', help='print task counts')
+    arguments = argument_parser.parse_args()
+
+    queue = SqliteWorkQueue(arguments.queue)
+    try:
+        if arguments.command == 'seed':
+            seed(queue, filter_from_arguments(arguments),
+                 arguments.first_page, arguments.last_page + 1)
+        elif arguments.command == 'work':
+            seen_ids = QuestionIdIndex(arguments.seen_ids) \
+                if arguments.seen_ids is not None else None
+            CrawlWorker(
+                queue, ShardedCorpusStore(arguments.output),
+                config_from_arguments(arguments),
+                name=arguments.name, seen_ids=seen_ids,
+                lease=arguments.lease, batch_size=arguments.batch_size,
+                fetch_workers=arguments.fetch_workers,
+            ).run()
+        else:
+            print(json.dumps(queue.counts(), indent=2))
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
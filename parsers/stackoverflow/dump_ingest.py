@@ -0,0 +1,477 @@
+import const
+from exceptions import SkipQuestionException
+from id_index import QuestionIdIndex
+from logger import logger
+from metrics import metrics
+import models
+from models import StackOverflowParserConfig
+from models import StackOverflowParserFilter
+import parsing
+from reparse import add_config_arguments
+from reparse import config_from_arguments
+from storage import ShardedCorpusStore
+import utils
+
+import argparse
+import bz2
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import typing
+import xml.etree.ElementTree as ElementTree
+
+QUESTION_POST_TYPE = '1'
+ANSWER_POST_TYPE = '2'
+ROW_MARKUP = b'<row'
+
+Chunk = typing.Tuple[int, typing.Optional[int]]
+
+
+def open_dump(path: str) -> typing.BinaryIO:
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+
+    return open(path, 'rb')
+
+
+def split_chunks(path: str, count: int) -> typing.List[Chunk]:
+    # Byte ranges of whole lines, the dump keeps one <row> per line. A
+    # compressed dump can't be seeked into and is read as a single chunk.
+    if path.endswith('.bz2') or count <= 1:
+        return [(0, None)]
+
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as file:
+        for index in range(1, count):
+            file.seek(size * index // count)
+            file.readline()
+            if file.tell() > starts[-1]:
+                starts.append(file.tell())
+
+    return [
+        (start, end) for start, end in zip(starts, starts[1:] + [None])
+        if end is None or start < end
+    ]
+
+
+class DumpChunkReader:
+    # File-like view of the <row> lines of one chunk wrapped in a root
+    # element, so every chunk is a document of its own for iterparse.
+    def __init__(self, file: typing.BinaryIO, start: int, end: typing.Optional[int]):
+        self.file = file
+        self.end = end
+        self.position = start
+        self.pending = b'<posts>\n'
+        self.finished = False
+        file.seek(start)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = 1 << 16
+
+        parts = [self.pending]
+        length = len(self.pending)
+        while length < size and not self.finished:
+            if self.end is not None and self.position >= self.end:
+                line = b''
+            else:
+                line = self.file.readline()
+                self.position += len(line)
+
+            if not line:
+                parts.append(b'</posts>\n')
+                self.finished = True
+                break
+            if line.lstrip().startswith(ROW_MARKUP):
+                parts.append(line)
+                length += len(line)
+
+        data = b''.join(parts)
+        self.pending = data[size:]
+        return data[:size]
+
+
+def iter_chunk_rows(path: str, chunk: Chunk) -> typing.Iterator[typing.Dict[str, str]]:
+    # Constant memory: every row is cleared from the tree once read.
+    with open_dump(path) as file:
+        root = None
+        for event, element in ElementTree.iterparse(
+                DumpChunkReader(file, *chunk), events=('start', 'end')):
+            if root is None:
+                root = element
+                continue
+            if event == 'end' and element.tag == 'row':
+                yield element.attrib
+                root.clear()
+
+
+def parse_tags(tags: str) -> typing.List[str]:
+    # Older dumps write '<c++><templates>', newer ones '|c++|templates|'.
+    if tags.startswith('<'):
+        return tags[1:-1].split('><')
+
+    return [tag for tag in tags.split('|') if tag]
+
+
+def row_block(row: typing.Dict[str, str]) -> models.StackOverflowQuestionBlock:
+    block = models.StackOverflowQuestionBlock()
+    block.score = int(row.get('Score', 0))
+    block.answers_count = int(row.get('AnswerCount', 0))
+    block.has_accepted_answer = 'AcceptedAnswerId' in row
+
+    return block
+
+
+def question_row_rejection_reason(
+        row: typing.Dict[str, str], filter_: StackOverflowParserFilter,
+        config: StackOverflowParserConfig) -> typing.Optional[str]:
+    # The listing filter first, then what `utils.source_rejection_reason`
+    # checks on question pages. A question has to carry all filter tags.
+    tags = parse_tags(row.get('Tags', ''))
+    if any(tag.value not in tags for tag in filter_.tags):
+        return 'tags'
+
+    block = row_block(row)
+    reason = utils.block_rejection_reason(block, filter_)
+    if reason is not None:
+        return reason
+    if block.answers_count == 0:
+        return 'no_answers'
+    if config.only_accepted_answers and not block.has_accepted_answer:
+        return 'no_accepted_answer'
+
+    return None
+
+
+# Files of the merge steps, next to the `chunk-NNNN.*` files of the chunks.
+MERGED_FILES = ('questions.bitmap', 'accepted.bitmap', 'answers.sqlite')
+
+
+def chunk_path(work_dir: str, index: int, suffix: str) -> str:
+    return os.path.join(work_dir, f'chunk-{index:04}.{suffix}')
+
+
+def clear_work_dir(work_dir: str):
+    # Chunk databases and bitmaps are opened for appending, so the ones an
+    # earlier run left, maybe with another filter, config or chunk count,
+    # would mix into this one. Nothing else in the directory is touched.
+    paths = glob.glob(os.path.join(work_dir, 'chunk-*')) + [
+        os.path.join(work_dir, name) for name in MERGED_FILES]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    # Scratch databases, rebuilt from the dump if anything goes wrong.
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=OFF')
+    connection.execute('PRAGMA synchronous=OFF')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS questions ('
+        'id INTEGER PRIMARY KEY, title TEXT, score INTEGER, '
+        'answers_count INTEGER, body TEXT)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS answers ('
+        'id INTEGER PRIMARY KEY, question_id INTEGER, score INTEGER, '
+        'has_accepted INTEGER, body TEXT)')
+
+    return connection
+
+
+def scan_questions(
+        path: str, chunk: Chunk, work_dir: str, index: int,
+        filter_: StackOverflowParserFilter, config: StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+) -> typing.Counter[str]:
+    # First pass, in a worker process: suitable questions of the chunk go to
+    # its database, their ids and accepted answer ids to its bitmaps.
+    outcomes = collections.Counter()
+    connection = connect(chunk_path(work_dir, index, 'sqlite'))
+    questions = QuestionIdIndex(chunk_path(work_dir, index, 'questions.bitmap'))
+    accepted = QuestionIdIndex(chunk_path(work_dir, index, 'accepted.bitmap'))
+
+    try:
+        for row in iter_chunk_rows(path, chunk):
+            if row.get('PostTypeId') != QUESTION_POST_TYPE:
+                continue
+
+            reason = question_row_rejection_reason(row, filter_, config)
+            if reason is not None:
+                outcomes[reason] += 1
+                continue
+
+            try:
+                body = utils.format_body_html(row['Body'], config, backend)
+            except SkipQuestionException:
+                outcomes['drop_policy'] += 1
+                continue
+
+            connection.execute(
+                'INSERT OR REPLACE INTO questions VALUES (?, ?, ?, ?, ?)',
+                (int(row['Id']), row.get('Title', ''), int(row.get('Score', 0)),
+                 int(row.get('AnswerCount', 0)), body))
+            questions.add(row['Id'])
+            if 'AcceptedAnswerId' in row:
+                accepted.add(row['AcceptedAnswerId'])
+            outcomes['selected'] += 1
+
+        connection.commit()
+    finally:
+        connection.close()
+        questions.close()
+        accepted.close()
+
+    return outcomes
+
+
+def scan_answers(
+        path: str, chunk: Chunk, work_dir: str, index: int,
+        config: StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+) -> typing.Counter[str]:
+    # Second pass: answers of the selected questions, from any chunk, that
+    # fit the config. `answers_limit` is applied when merging.
+    outcomes = collections.Counter()
+    connection = connect(chunk_path(work_dir, index, 'sqlite'))
+    questions = QuestionIdIndex(os.path.join(work_dir, 'questions.bitmap'))
+    accepted = QuestionIdIndex(os.path.join(work_dir, 'accepted.bitmap'))
+
+    try:
+        for row in iter_chunk_rows(path, chunk):
+            if row.get('PostTypeId') != ANSWER_POST_TYPE \
+                    or row.get('ParentId') not in questions:
+                continue
+
+            answer = models.StackOverflowAnswer()
+            answer.id = row['Id']
+            answer.score = int(row.get('Score', 0))
+            answer.has_accepted = answer.id in accepted
+            if not utils.is_answer_fits_config(answer, config):
+                outcomes['answer_filtered'] += 1
+                continue
+
+            try:
+                answer.body = utils.format_body_html(row['Body'], config, backend)
+            except SkipQuestionException:
+                outcomes['answer_dropped'] += 1
+                continue
+
+            connection.execute(
+                'INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)',
+                (int(answer.id), int(row['ParentId']), answer.score,
+                 int(answer.has_accepted), answer.body))
+            outcomes['answers'] += 1
+
+        connection.commit()
+    finally:
+        connection.close()
+        questions.close()
+        accepted.close()
+
+    return outcomes
+
+
+def merge_bitmaps(work_dir: str, chunks_count: int, suffix: str):
+    merged = QuestionIdIndex(os.path.join(work_dir, suffix))
+    try:
+        for index in range(chunks_count):
+            chunk_index = QuestionIdIndex(chunk_path(work_dir, index, suffix))
+            merged.union_update(chunk_index)
+            chunk_index.close()
+    finally:
+        merged.close()
+
+
+def merge_answers(work_dir: str, chunks_count: int) -> sqlite3.Connection:
+    connection = connect(os.path.join(work_dir, 'answers.sqlite'))
+    for index in range(chunks_count):
+        connection.execute(
+            'ATTACH DATABASE ? AS chunk', (chunk_path(work_dir, index, 'sqlite'),))
+        connection.execute('INSERT OR REPLACE INTO answers SELECT * FROM chunk.answers')
+        connection.commit()
+        connection.execute('DETACH DATABASE chunk')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS answers_by_question '
+        'ON answers (question_id, score DESC, id)')
+    connection.commit()
+
+    return connection
+
+
+def iter_merged_questions(
+        work_dir: str, chunks_count: int, config: StackOverflowParserConfig,
+        seen_ids: typing.Optional[typing.Container] = None,
+) -> typing.Iterator[models.StackOverflowQuestion]:
+    # Chunks follow the dump, so questions come out in id order. Answers are
+    # taken by votes, like the scrapper sees them on the page.
+    answers = merge_answers(work_dir, chunks_count)
+    try:
+        for index in range(chunks_count):
+            connection = connect(chunk_path(work_dir, index, 'sqlite'))
+            try:
+                for question_id, title, score, answers_count, body in connection.execute(
+                        'SELECT * FROM questions ORDER BY id'):
+                    if seen_ids is not None and str(question_id) in seen_ids:
+                        metrics.inc('rejected_total', reason='seen')
+                        continue
+
+                    question = models.StackOverflowQuestion()
+                    question.id = str(question_id)
+                    question.title = title
+                    question.score = score
+                    question.answers_count = answers_count
+                    question.body = body
+                    question.answers = []
+                    for answer_id, answer_score, has_accepted, answer_body in answers.execute(
+                            'SELECT id, score, has_accepted, body FROM answers '
+                            'WHERE question_id = ? ORDER BY score DESC, id LIMIT ?',
+                            (question_id, config.answers_limit)):
+                        answer = models.StackOverflowAnswer()
+                        answer.id = str(answer_id)
+                        answer.score = answer_score
+                        answer.has_accepted = bool(has_accepted)
+                        answer.body = answer_body
+                        question.answers.append(answer)
+
+                    if not question.answers:
+                        metrics.inc('rejected_total', reason='no_suitable_answers')
+                        continue
+                    yield question
+            finally:
+                connection.close()
+    finally:
+        answers.close()
+
+
+def record_outcomes(outcomes: typing.Counter[str]):
+    for reason, count in outcomes.items():
+        if reason not in ('selected', 'answers'):
+            metrics.inc('rejected_total', count, reason=reason)
+
+
+def ingest_dump(
+        path: str, store: ShardedCorpusStore,
+        filter_: StackOverflowParserFilter, config: StackOverflowParserConfig,
+        workers: typing.Optional[int] = None,
+        chunks_count: typing.Optional[int] = None,
+        work_dir: typing.Optional[str] = None,
+        seen_ids: typing.Optional[typing.Container] = None,
+        batch_size: int = const.DUMP_BATCH_SIZE,
+        backend: str = const.PARSER_BACKEND,
+) -> int:
+    # Answers can sit anywhere after their question in the dump, so it is
+    # read twice: questions first, then the answers of the selected ones.
+    # Both passes run over chunks of the file in parallel processes.
+    workers = workers or os.cpu_count()
+    chunks = split_chunks(
+        path, chunks_count or workers * const.DUMP_CHUNKS_PER_WORKER)
+    keep_work_dir = work_dir is not None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='dump-ingest-')
+    os.makedirs(work_dir, exist_ok=True)
+    clear_work_dir(work_dir)
+    logger.info(f"Ingesting '{path}' in {len(chunks)} chunks with {workers} workers")
+
+    written = 0
+    try:
+        with ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context(const.PARSE_START_METHOD),
+        ) as executor:
+            outcomes = collections.Counter()
+            with metrics.timer('dump_questions', profile=False):
+                for result in executor.map(
+                        scan_questions, *zip(*[
+                            (path, chunk, work_dir, index, filter_, config, backend)
+                            for index, chunk in enumerate(chunks)])):
+                    outcomes.update(result)
+            merge_bitmaps(work_dir, len(chunks), 'questions.bitmap')
+            merge_bitmaps(work_dir, len(chunks), 'accepted.bitmap')
+            logger.info(f"{outcomes['selected']} questions selected")
+
+            with metrics.timer('dump_answers', profile=False):
+                for result in executor.map(
+                        scan_answers, *zip(*[
+                            (path, chunk, work_dir, index, config, backend)
+                            for index, chunk in enumerate(chunks)])):
+                    outcomes.update(result)
+            logger.info(f"{outcomes['answers']} answers selected")
+            record_outcomes(outcomes)
+
+        batch = []
+        for question in iter_merged_questions(work_dir, len(chunks), config, seen_ids):
+            batch.append(question)
+            if len(batch) >= batch_size:
+                written += store.append(batch)
+                batch = []
+        if batch:
+            written += store.append(batch)
+    finally:
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.info(f"Ingested {written} questions from '{path}'")
+    return written
+
+
+def add_filter_arguments(argument_parser: argparse.ArgumentParser):
+    argument_parser.add_argument(
+        '--tags', nargs='+', default=['python'],
+        choices=[tag.name for tag in models.StackOverflowParserTag])
+    argument_parser.add_argument(
+        '--rank-by', default=models.StackOverflowParserRanking.newest.name,
+        choices=[ranking.name for ranking in models.StackOverflowParserRanking])
+    argument_parser.add_argument('--min-score', type=int, default=0)
+    argument_parser.add_argument('--max-score', type=int, default=None)
+    argument_parser.add_argument('--min-answers-count', type=int, default=0)
+    argument_parser.add_argument('--max-answers-count', type=int, default=None)
+    argument_parser.add_argument('--has-accepted-answer', choices=['yes', 'no'], default=None)
+
+
+def filter_from_arguments(arguments: argparse.Namespace) -> StackOverflowParserFilter:
+    has_accepted_answer = None
+    if arguments.has_accepted_answer is not None:
+        has_accepted_answer = arguments.has_accepted_answer == 'yes'
+
+    return StackOverflowParserFilter(
+        [models.StackOverflowParserTag[tag] for tag in arguments.tags],
+        rank_by=models.StackOverflowParserRanking[arguments.rank_by],
+        min_score=arguments.min_score,
+        max_score=arguments.max_score,
+        min_answers_count=arguments.min_answers_count,
+        max_answers_count=arguments.max_answers_count,
+        has_accepted_answer=has_accepted_answer,
+    )
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Ingest questions from a Stack Exchange data dump Posts.xml')
+    argument_parser.add_argument('posts', help='Posts.xml, decompressed or .bz2')
+    argument_parser.add_argument('--output', required=True)
+    argument_parser.add_argument('--workers', type=int, default=None)
+    argument_parser.add_argument('--chunks', type=int, default=None)
+    argument_parser.add_argument('--work-dir', default=None,
+                                 help='keep the intermediate databases there')
+    argument_parser.add_argument('--backend', default=const.PARSER_BACKEND)
+    add_filter_arguments(argument_parser)
+    add_config_arguments(argument_parser)
+    arguments = argument_parser.parse_args()
+
+    store = ShardedCorpusStore(arguments.output)
+    ingest_dump(
+        arguments.posts, store,
+        filter_from_arguments(arguments), config_from_arguments(arguments),
+        arguments.workers, arguments.chunks, arguments.work_dir,
+        backend=parsing.resolve_backend(arguments.backend))
+
+
+if __name__ == '__main__':
+    main()
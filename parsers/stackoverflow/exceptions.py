@@ -1,2 +1,9 @@
 class SkipQuestionException(Exception):
     pass
+
+
+class FetchFailedException(Exception):
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"Can't fetch '{url}': {reason}")
+        self.url = url
+        self.reason = reason
@@ -0,0 +1,217 @@
+import const
+from logger import logger
+from storage import ShardedCorpusStore
+import storage
+
+import argparse
+import collections
+import csv
+import functools
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import shutil
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+# File names hpc_scripts/gpt2/main.py and hpc_scripts/t5/main.py read.
+SPLIT_FILES = {
+    'gpt2': {
+        'train': 'code_instructions_train.txt',
+        'validation': 'code_instructions_validation.txt',
+    },
+    't5': {
+        'train': 'github_train.csv',
+        'validation': 'github_val.csv',
+    },
+}
+T5_COLUMNS = ['instruction', 'input', 'output']
+GPT2_END_OF_TEXT = '<|endoftext|>'
+
+
+def export_jsonl(store: ShardedCorpusStore, path: str) -> int:
+    # The latest revision of every question, one JSON dict per line.
+    written = 0
+    with open(path, 'w') as file:
+        for record in store.iter_latest_records():
+            file.write(json.dumps(dict(record), ensure_ascii=False))
+            file.write('\n')
+            written += 1
+
+    logger.info('Exported %s questions to %s', written, path)
+    return written
+
+
+@functools.lru_cache(maxsize=None)
+def load_t5_const(path: str = const.EXPORT_T5_CONST_PATH):
+    # hpc_scripts/t5 has a `const` module of its own, it is loaded under
+    # another name so it doesn't replace this one.
+    spec = importlib.util.spec_from_file_location('t5_const', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def is_validation(question_id: str, ratio: float, salt: str = const.EXPORT_SPLIT_SALT) -> bool:
+    # Depends on the id only, so a question stays on its side of the split
+    # across exports, worker counts and corpus growth.
+    digest = hashlib.blake2b(f'{salt}{question_id}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') < ratio * (1 << 64)
+
+
+def pick_answer(record: typing.Mapping) -> typing.Optional[dict]:
+    # The accepted answer, otherwise the best scored one.
+    answers = record['answers']
+    if not answers:
+        return None
+
+    return max(answers, key=lambda answer: (bool(answer['has_accepted']), answer['score']))
+
+
+class SplitWriter:
+    # Writes the examples of one corpus shard to a part file per split.
+    def __init__(self, format_: str, directory: str, index: int):
+        t5_const = load_t5_const()
+        self.format = format_
+        self.q_prefix = t5_const.Q_PREFIX
+        self.a_prefix = t5_const.A_PREFIX
+        self.files = {
+            split: open(part_path(directory, name, index), 'w', newline='', encoding='utf-8')
+            for split, name in SPLIT_FILES[format_].items()
+        }
+        self.csv_writers = {
+            split: csv.writer(file) for split, file in self.files.items()
+        }
+
+    def write(self, split: str, record: typing.Mapping, answer: dict):
+        if self.format == 'gpt2':
+            self.files[split].write(
+                f"{self.q_prefix}{record['title']}\n{record['body']}\n"
+                f"{self.a_prefix}{answer['body']}\n{GPT2_END_OF_TEXT}\n")
+        else:
+            # The t5 prompt has the title as the problem and the body as
+            # its seed, an empty column would be read back as null.
+            self.csv_writers[split].writerow([
+                f"{self.q_prefix}{record['title']}", record['body'],
+                f"{self.a_prefix}{answer['body']}"])
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def part_path(directory: str, name: str, index: int) -> str:
+    return os.path.join(directory, f'{name}.part{index:05}')
+
+
+def export_shard(
+        directory: str, shard: dict, start: int,
+        repeated_positions: typing.Dict[str, int],
+        format_: str, output: str, index: int, validation_ratio: float,
+) -> typing.Counter[str]:
+    # Runs in a worker process, reads one corpus shard without opening the
+    # store and skips the records a later revision of the question replaces.
+    counts = collections.Counter()
+    writer = SplitWriter(format_, output, index)
+    try:
+        for position, record in enumerate(storage.read_shard(directory, shard), start):
+            question_id = record['id']
+            if repeated_positions.get(question_id, position) != position:
+                continue
+            answer = pick_answer(record)
+            if answer is None:
+                counts['unanswered'] += 1
+                continue
+            split = 'validation' if is_validation(question_id, validation_ratio) else 'train'
+            writer.write(split, record, answer)
+            counts[split] += 1
+    finally:
+        writer.close()
+
+    return counts
+
+
+def merge_parts(format_: str, output: str, parts_count: int):
+    # Parts are concatenated in shard order, so the files only depend on
+    # the corpus and not on which worker finished first.
+    for name in SPLIT_FILES[format_].values():
+        with open(os.path.join(output, name), 'w', newline='', encoding='utf-8') as file:
+            if format_ == 't5':
+                csv.writer(file).writerow(T5_COLUMNS)
+            for index in range(parts_count):
+                path = part_path(output, name, index)
+                with open(path, encoding='utf-8', newline='') as part:
+                    shutil.copyfileobj(part, file)
+                os.remove(path)
+
+
+def export_training_text(
+        store: ShardedCorpusStore, output: str, format_: str,
+        validation_ratio: float = const.EXPORT_VALIDATION_RATIO,
+        workers: typing.Optional[int] = None,
+) -> typing.Counter[str]:
+    # Every corpus shard is formatted by a worker process into part files
+    # which are then joined into the files the training scripts read. Only
+    # the ids stored more than once are held in memory.
+    os.makedirs(output, exist_ok=True)
+    repeated_positions = store.repeated_positions()
+    shards = list(store.manifest['shards'])
+    starts = []
+    start = 0
+    for shard in shards:
+        starts.append(start)
+        start += shard['records']
+
+    counts = collections.Counter()
+    with ProcessPoolExecutor(
+            workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context(const.PARSE_START_METHOD),
+    ) as executor:
+        futures = [
+            executor.submit(
+                export_shard, store.directory, shard, shard_start, repeated_positions,
+                format_, output, index, validation_ratio)
+            for index, (shard, shard_start) in enumerate(zip(shards, starts))
+        ]
+        for future in futures:
+            counts.update(future.result())
+    merge_parts(format_, output, len(shards))
+
+    logger.info(
+        'Exported %s train and %s validation questions to %s, %s without answers',
+        counts['train'], counts['validation'], output, counts['unanswered'])
+    return counts
+
+
+def add_export_arguments(argument_parser: argparse.ArgumentParser):
+    argument_parser.add_argument('--store', default=const.CORPUS_DIR)
+    argument_parser.add_argument(
+        '--output', required=True,
+        help='a file for jsonl, a directory for the gpt2 and t5 training text')
+    argument_parser.add_argument('--format', choices=['jsonl', *SPLIT_FILES], default='jsonl')
+    argument_parser.add_argument(
+        '--validation-ratio', type=float, default=const.EXPORT_VALIDATION_RATIO)
+    argument_parser.add_argument('--workers', type=int, default=None)
+
+
+def export_from_arguments(arguments: argparse.Namespace):
+    store = ShardedCorpusStore(arguments.store)
+    if arguments.format == 'jsonl':
+        return export_jsonl(store, arguments.output)
+
+    return export_training_text(
+        store, arguments.output, arguments.format,
+        arguments.validation_ratio, arguments.workers)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Export the stored questions')
+    add_export_arguments(argument_parser)
+    export_from_arguments(argument_parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
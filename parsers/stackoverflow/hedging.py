@@ -0,0 +1,94 @@
+import const
+
+import collections
+import threading
+import time
+import typing
+
+
+class HedgeAttempt:
+    # One copy of a hedged request. `proxy` is set and `sent` fires once the
+    # copy got through the rate limit and the proxy pool, the hedge delay
+    # only counts from there. A copy cancelled before it is sent releases
+    # its proxy unused.
+    __slots__ = ('proxy', 'sent', 'sent_at', 'cancelled')
+
+    def __init__(self):
+        self.proxy: typing.Optional[str] = None
+        self.sent = threading.Event()
+        self.sent_at: typing.Optional[float] = None
+        self.cancelled = threading.Event()
+
+    def send(self, proxy: str):
+        self.proxy = proxy
+        self.sent_at = time.monotonic()
+        self.sent.set()
+
+
+# When a request takes longer than `quantile` of the recent successful ones,
+# a second copy goes out through another proxy and the first good response
+# wins. Hedges come from a budget that every request adds `max_ratio` of a
+# hedge to, so a slow spell can't double the traffic of the proxies.
+class HedgePolicy:
+    def __init__(
+            self, quantile: float = const.HEDGE_QUANTILE,
+            max_ratio: float = const.HEDGE_MAX_RATIO,
+            burst: float = const.HEDGE_BURST,
+            min_delay: float = const.HEDGE_MIN_DELAY,
+            max_delay: float = const.REQUEST_TIMEOUT,
+            window: int = const.HEDGE_WINDOW,
+            min_samples: int = const.HEDGE_MIN_SAMPLES,
+    ):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.latencies: typing.Deque[float] = collections.deque(maxlen=window)
+        # Sorting the window on every request isn't needed, the delay is
+        # updated every tenth of a window.
+        self.update_every = max(window // 10, 1)
+        self.observed = 0
+        self.hedge_delay: typing.Optional[float] = None
+        self.budget = burst
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def observe(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+            self.observed += 1
+            if len(self.latencies) < self.min_samples:
+                return
+            if self.hedge_delay is not None and self.observed % self.update_every:
+                return
+
+            latencies = sorted(self.latencies)
+            value = latencies[min(int(self.quantile * len(latencies)), len(latencies) - 1)]
+            self.hedge_delay = min(max(value, self.min_delay), self.max_delay)
+
+    def delay(self) -> typing.Optional[float]:
+        # None until enough latencies were seen to know what slow is.
+        with self.lock:
+            return self.hedge_delay
+
+    def on_request(self):
+        with self.lock:
+            self.requests += 1
+            self.budget = min(self.budget + self.max_ratio, self.burst)
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            self.hedges += 1
+            return True
+
+    def summary(self) -> str:
+        with self.lock:
+            delay = f'{self.hedge_delay * 1000:.0f} ms' \
+                if self.hedge_delay is not None else 'none yet'
+            return f'{self.hedges} hedges for {self.requests} requests, delay {delay}'
@@ -0,0 +1,108 @@
+import const
+
+import mmap
+import os
+import struct
+import threading
+import typing
+
+INDEX_MAGIC = b'SOIDX001'
+INDEX_HEADER = struct.Struct('<8sQ')
+
+
+# Bit `n` of the memory-mapped bitmap is set once question `n` is stored,
+# so a lookup is O(1) and millions of ids cost a few megabytes.
+class QuestionIdIndex:
+    def __init__(
+            self, path: str = const.ID_INDEX_PATH,
+            initial_size: int = const.ID_INDEX_INITIAL_SIZE,
+    ):
+        self.path = path
+        self.lock = threading.Lock()
+
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                file.write(INDEX_HEADER.pack(INDEX_MAGIC, 0))
+                file.truncate(INDEX_HEADER.size + initial_size)
+
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        magic, _ = INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC:
+            raise Exception(f"'{path}' is not a question id index")
+
+    def __position__(self, question_id) -> typing.Tuple[int, int]:
+        number = int(question_id)
+        if number < 0:
+            raise Exception("Question id can't be below zero")
+
+        return INDEX_HEADER.size + (number >> 3), 1 << (number & 7)
+
+    def __grow__(self, size: int):
+        new_size = len(self.map)
+        while new_size <= size:
+            new_size *= 2
+
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(new_size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def __contains__(self, question_id) -> bool:
+        offset, bit = self.__position__(question_id)
+        with self.lock:
+            if offset >= len(self.map):
+                return False
+            return bool(self.map[offset] & bit)
+
+    def __len__(self) -> int:
+        with self.lock:
+            bitmap = self.map[INDEX_HEADER.size:]
+        return int.from_bytes(bitmap, 'little').bit_count()
+
+    def add(self, question_id):
+        offset, bit = self.__position__(question_id)
+        with self.lock:
+            if offset >= len(self.map):
+                self.__grow__(offset)
+            self.map[offset] |= bit
+
+    def update(self, question_ids: typing.Iterable):
+        for question_id in question_ids:
+            self.add(question_id)
+
+    def union_update(self, other: 'QuestionIdIndex'):
+        with other.lock:
+            bitmap = other.map[INDEX_HEADER.size:].rstrip(b'\x00')
+        with self.lock:
+            end = INDEX_HEADER.size + len(bitmap)
+            if end > len(self.map):
+                self.__grow__(end)
+            current = self.map[INDEX_HEADER.size:end]
+            self.map[INDEX_HEADER.size:end] = (
+                int.from_bytes(current, 'little') | int.from_bytes(bitmap, 'little')
+            ).to_bytes(len(bitmap), 'little')
+
+    @property
+    def synced_records(self) -> int:
+        _, records = INDEX_HEADER.unpack_from(self.map, 0)
+        return records
+
+    def sync(self, records: int):
+        # `records` is the corpus size the index is known to cover, it lets
+        # the caller detect an index that lagged behind the store on crash.
+        with self.lock:
+            INDEX_HEADER.pack_into(self.map, 0, INDEX_MAGIC, records)
+            self.map.flush()
+
+    def clear(self):
+        with self.lock:
+            self.map[INDEX_HEADER.size:] = bytes(len(self.map) - INDEX_HEADER.size)
+            INDEX_HEADER.pack_into(self.map, 0, INDEX_MAGIC, 0)
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
@@ -1,9 +1,135 @@
 import const
 
+import atexit
+import datetime
+import json
 import logging
+import logging.handlers
+import multiprocessing.util
+import queue
+import threading
+import time
+import typing
 
-logger = logging.getLogger(__name__)
-logger.setLevel(const.LOGGING_LEVEL)
+# Attributes every `LogRecord` has, anything else on a record came from
+# `extra=` and goes to the JSON line as a field of its own.
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'event', 'dropped',
+}
 
-for logger_handler in const.LOGGING_HANDLERS:
-    logger.addHandler(logger_handler)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': event_key(record),
+            'message': record.getMessage(),
+            'where': f'{record.module}:{record.lineno}',
+            'thread': record.threadName,
+        }
+        dropped = getattr(record, 'dropped', 0)
+        if dropped:
+            line['dropped'] = dropped
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                line[name] = value
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(line, default=str, ensure_ascii=False)
+
+
+def event_key(record: logging.LogRecord) -> str:
+    # The message template, records logged with %-style arguments of the
+    # same call share it. `extra={'event': ...}` names an event explicitly.
+    event = getattr(record, 'event', None)
+    return event if event is not None else str(record.msg)
+
+
+# Lets through `rate` records per second of every event, with bursts of up
+# to `burst`. The first record let through after a drop carries the number
+# of records dropped since then.
+class EventSampler(logging.Filter):
+    def __init__(
+            self, rate: float = const.LOGGING_SAMPLE_RATE,
+            burst: float = const.LOGGING_SAMPLE_BURST,
+            max_events: int = const.LOGGING_SAMPLE_MAX_EVENTS,
+    ):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_events = max_events
+        # Event -> (tokens, updated at, dropped since the last record).
+        self.events: typing.Dict[str, typing.Tuple[float, float, int]] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = event_key(record)
+        now = time.monotonic()
+        with self.lock:
+            if key not in self.events and len(self.events) >= self.max_events:
+                # Messages formatted before logging make an event each,
+                # forgetting them all is cheaper than tracking their age.
+                self.events.clear()
+            tokens, updated_at, dropped = self.events.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens < 1:
+                self.events[key] = (tokens, now, dropped + 1)
+                return False
+            self.events[key] = (tokens - 1, now, 0)
+
+        if dropped:
+            record.dropped = dropped
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock handler formats the message in the logging thread before
+    # queueing it. The queue never leaves the process, so the record goes
+    # as it is and the listener thread does the formatting.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logger(
+        name: str, level: int = const.LOGGING_LEVEL,
+        handlers: typing.Iterable[logging.Handler] = const.LOGGING_HANDLERS,
+) -> typing.Tuple[logging.Logger, logging.handlers.QueueListener]:
+    # Records are filtered and sampled in the calling thread and written by
+    # a listener thread, so a slow stdout doesn't hold up a fetch worker.
+    handlers = list(handlers)
+    for handler in handlers:
+        if handler.formatter is None and const.LOGGING_JSON:
+            handler.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(EventSampler())
+
+    logger_ = logging.getLogger(name)
+    logger_.setLevel(level)
+    logger_.addHandler(queue_handler)
+    logger_.propagate = False
+
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    listener.start()
+
+    # Whatever is still queued is written out on exit. Pool processes
+    # leave without running `atexit`, but they do run finalizers.
+    stopped = threading.Event()
+
+    def stop():
+        if not stopped.is_set():
+            stopped.set()
+            listener.stop()
+
+    atexit.register(stop)
+    multiprocessing.util.Finalize(None, stop, exitpriority=10)
+
+    return logger_, listener
+
+
+logger, listener = setup_logger(__name__)
@@ -1,25 +1,35 @@
-import models
+from api_scrapper import ApiStackOverflowScrapper
+from cache import ResponseCache
+from checkpoint import CrawlCheckpoint
+from crawl_session import CrawlSession
+import const
+from hedging import HedgePolicy
 from models import StackOverflowParserFilter
 from models import StackOverflowParserRanking
 from models import StackOverflowParserTag
 from models import StackOverflowParserConfig
 from models import StackOverflowParserPolicy
-from scrapper import StackOverflowScrapper
+from id_index import QuestionIdIndex
+from metrics import metrics
+from metrics import MetricsReporter
+from metrics import serve_metrics
+from storage import ShardedCorpusStore
 
 from pprint import pprint
-import typing
+import os
 import json
 
 
-def get_question_dicts(questions: typing.List[models.StackOverflowQuestion]):
-    return list(map(lambda q: q.dict(), questions))
+def load_id_index(store_: ShardedCorpusStore) -> QuestionIdIndex:
+    index_ = QuestionIdIndex(const.ID_INDEX_PATH)
+    if index_.synced_records != len(store_):
+        # The index lagged behind the corpus (crash between the two writes
+        # or a fresh index), rebuild it once from the stored records.
+        index_.clear()
+        index_.update(record['id'] for record in store_.iter_records())
+        index_.sync(len(store_))
 
-
-def extract_ids(questions_file_data):
-    ids_ = set([])
-    for question_data in questions_file_data:
-        ids_.add(question_data['id'])
-    return ids_
+    return index_
 
 
 def get_all_questions(file_name_: str):
@@ -30,28 +40,77 @@ def get_all_questions(file_name_: str):
     return all_
 
 
-if __name__ == '__main__':
-    filter = StackOverflowParserFilter(
-        [StackOverflowParserTag.cpp],
-        rank_by=StackOverflowParserRanking.votes,
-        has_accepted_answer=True)
+def migrate_legacy_file(file_name_: str, store_: ShardedCorpusStore):
+    if len(store_) > 0 or not os.path.exists(file_name_):
+        return
+
+    store_.append(get_all_questions(file_name_))
+
+
+def main():
+    filters = [
+        StackOverflowParserFilter(
+            [StackOverflowParserTag.cpp],
+            rank_by=StackOverflowParserRanking.votes,
+            has_accepted_answer=True),
+    ]
     config = StackOverflowParserConfig(answers_limit=3, only_accepted_answers=True,
                                        code_policy=StackOverflowParserPolicy.embed)
-    scrapper = StackOverflowScrapper(filter, config)
 
     questions_limit = 1000000
     questions_batch = 500
     file_name = 'data.json'
 
-    all_questions = get_all_questions(file_name)
-    current_last_page = 1
+    store = ShardedCorpusStore(const.CORPUS_DIR)
+    migrate_legacy_file(file_name, store)
+    seen_ids = load_id_index(store)
+    hedge = HedgePolicy() if const.HEDGE_REQUESTS else None
+    checkpoint = CrawlCheckpoint(const.CHECKPOINT_PATH)
+    if const.FETCH_BACKEND == 'api':
+        # The api scrapper lists one filter, so every filter gets one, run
+        # one after another. They share the proxies, the rate budget and
+        # the seen ids, a question listed by several is stored once.
+        first = ApiStackOverflowScrapper(filters[0], config, seen_ids=seen_ids,
+                                         checkpoint=checkpoint, hedge=hedge)
+        scrappers = [first] + [
+            ApiStackOverflowScrapper(filter_, config, seen_ids=seen_ids,
+                                     checkpoint=checkpoint, hedge=hedge,
+                                     proxy_pool=first.proxy_pool,
+                                     rate_controller=first.rate_controller)
+            for filter_ in filters[1:]
+        ]
+    else:
+        # Listings of all filters feed one fetch pipeline.
+        scrappers = [CrawlSession(filters, config, seen_ids=seen_ids,
+                                  parse_workers=os.cpu_count(),
+                                  cache=ResponseCache(const.CACHE_DIR),
+                                  checkpoint=checkpoint,
+                                  hedge=hedge)]
+
+    def flush(scrapper_, questions_):
+        store.append(questions_)
+        seen_ids.update(question.id for question in questions_)
+        seen_ids.sync(len(store))
+        scrapper_.mark_stored(question.id for question in questions_)
 
-    for i in range(0, questions_limit, questions_batch):
-        ids = extract_ids(all_questions)
-        questions, last_page = scrapper.get_questions(questions_batch, 100000, ids, current_last_page)
-        current_last_page = last_page
-        all_questions.extend(get_question_dicts(questions))
-        with open(file_name, 'w') as f:
-            json.dump(all_questions, f)
+    reporter = MetricsReporter(const.METRICS_DUMP_PATH).start()
+    if const.METRICS_PORT is not None:
+        serve_metrics(const.METRICS_PORT)
 
+    try:
+        for scrapper in scrappers:
+            questions = []
+            for question in scrapper.iter_questions(questions_limit, 100000, None, 1):
+                questions.append(question)
+                if len(questions) >= questions_batch:
+                    flush(scrapper, questions)
+                    questions = []
+            flush(scrapper, questions)
+    finally:
+        reporter.stop()
+        if const.PROFILE_STAGES:
+            metrics.dump_profiles(const.PROFILE_DIR)
 
+
+if __name__ == '__main__':
+    main()
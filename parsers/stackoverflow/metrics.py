@@ -0,0 +1,357 @@
+import const
+from logger import logger
+
+import bisect
+import contextlib
+import cProfile
+import http.server
+import json
+import os
+import pstats
+import threading
+import time
+import typing
+
+# Upper bounds in seconds, from 1 ms doubling up to ~65 sec.
+LATENCY_BUCKETS = tuple(0.001 * 2 ** power for power in range(17))
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+def make_labels(labels: dict) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: 'Histogram'):
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        # Upper bound of the bucket the quantile falls into, values past the
+        # last bucket are reported as its bound.
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                break
+
+        return self.buckets[min(index, len(self.buckets) - 1)]
+
+    def dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class ProfileStats:
+    # Profile data of another process, in the shape `pstats.Stats` loads.
+    def __init__(self, stats: dict):
+        self.data = stats
+        self.stats = {}
+
+    def create_stats(self):
+        self.stats = self.data
+
+
+# Counters, latency histograms and gauges of the whole process. Stages time
+# themselves with `timer`, which can also run them under cProfile when the
+# stage is listed in `profile_stages`.
+class Metrics:
+    def __init__(self, profile_stages: typing.Iterable[str] = const.PROFILE_STAGES):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters: typing.Dict[str, typing.Dict[Labels, float]] = {}
+        self.histograms: typing.Dict[str, typing.Dict[Labels, Histogram]] = {}
+        self.gauges: typing.Dict[str, typing.Dict[Labels, typing.Callable[[], float]]] = {}
+
+        self.profile_stages = set(profile_stages)
+        self.profiles: typing.Dict[
+            str, typing.List[typing.Union[cProfile.Profile, ProfileStats]]] = {}
+        self.profiling = threading.local()
+        # Bumped by `drain`, threads drop the profilers it took away.
+        self.profiles_generation = 0
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = make_labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = make_labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def gauge(self, name: str, read: typing.Callable[[], float], **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[make_labels(labels)] = read
+
+    def remove_gauge(self, name: str, **labels):
+        with self.lock:
+            self.gauges.get(name, {}).pop(make_labels(labels), None)
+
+    def __profiler__(self, stage: str) -> typing.Optional[cProfile.Profile]:
+        # cProfile hooks the current thread only and nested profilers would
+        # replace each other, so every thread keeps a profiler per stage and
+        # only the outermost profiled stage of a thread enables its own.
+        if stage not in self.profile_stages \
+                or getattr(self.profiling, 'active', False):
+            return None
+
+        if getattr(self.profiling, 'generation', None) != self.profiles_generation:
+            self.profiling.profiles = {}
+            self.profiling.generation = self.profiles_generation
+        profile = self.profiling.profiles.get(stage)
+        if profile is None:
+            profile = self.profiling.profiles[stage] = cProfile.Profile()
+            with self.lock:
+                self.profiles.setdefault(stage, []).append(profile)
+
+        return profile
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, profile: bool = True, **labels):
+        profiler = self.__profiler__(stage) if profile else None
+        if profiler is not None:
+            self.profiling.active = True
+            profiler.enable()
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                self.profiling.active = False
+            self.observe('stage_seconds', elapsed, stage=stage, **labels)
+
+    def drain(self) -> dict:
+        # Counters, histograms and profiles recorded since the previous call,
+        # the registry starts over. Worker processes send this back with
+        # their results and the parent `merge`s it into its own registry.
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            profiles, self.profiles = self.profiles, {}
+            self.profiles_generation += 1
+
+        return {
+            'counters': counters,
+            'histograms': histograms,
+            'profiles': {
+                stage: [pstats.Stats(profile).stats for profile in items]
+                for stage, items in profiles.items()
+            },
+        }
+
+    def merge(self, drained: dict):
+        with self.lock:
+            for name, series in drained['counters'].items():
+                target = self.counters.setdefault(name, {})
+                for key, value in series.items():
+                    target[key] = target.get(key, 0) + value
+
+            for name, series in drained['histograms'].items():
+                target = self.histograms.setdefault(name, {})
+                for key, histogram in series.items():
+                    if key not in target:
+                        target[key] = Histogram(histogram.buckets)
+                    target[key].merge(histogram)
+
+            for stage, items in drained['profiles'].items():
+                self.profiles.setdefault(stage, []).extend(
+                    ProfileStats(stats) for stats in items)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = {
+                name: [{'labels': dict(key), 'value': value}
+                       for key, value in series.items()]
+                for name, series in self.counters.items()
+            }
+            histograms = {
+                name: [{'labels': dict(key), **histogram.dict()}
+                       for key, histogram in series.items()]
+                for name, series in self.histograms.items()
+            }
+            gauges = {
+                name: list(series.items())
+                for name, series in self.gauges.items()
+            }
+
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started_at,
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': {
+                name: [{'labels': dict(key), 'value': read()} for key, read in series]
+                for name, series in gauges.items()
+            },
+        }
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in self.counters.items():
+                lines.append(f'# TYPE {name} counter')
+                for key, value in series.items():
+                    lines.append(f'{name}{format_labels(key)} {value}')
+
+            for name, series in self.histograms.items():
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bucket, bucket_count in zip(
+                            histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += bucket_count
+                        bound = '+Inf' if bucket == float('inf') else repr(bucket)
+                        bucket_key = key + (('le', bound),)
+                        lines.append(f'{name}_bucket{format_labels(bucket_key)} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(key)} {histogram.count}')
+
+            gauges = [
+                (name, list(series.items()))
+                for name, series in self.gauges.items() if series
+            ]
+
+        for name, series in gauges:
+            lines.append(f'# TYPE {name} gauge')
+            for key, read in series:
+                lines.append(f'{name}{format_labels(key)} {read()}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump_profiles(self, directory: str = const.PROFILE_DIR):
+        with self.lock:
+            profiles = {stage: list(items) for stage, items in self.profiles.items()}
+
+        os.makedirs(directory, exist_ok=True)
+        for stage, items in profiles.items():
+            stats = pstats.Stats(items[0])
+            for profile in items[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(directory, f'{stage}.pstats'))
+
+
+metrics = Metrics()
+
+
+# Writes `metrics.snapshot()` to a JSON file every `interval` seconds, with
+# per-second rates of the counters since the previous dump.
+class MetricsReporter:
+    def __init__(
+            self, path: str = const.METRICS_DUMP_PATH,
+            interval: float = const.METRICS_DUMP_INTERVAL,
+            registry: Metrics = metrics,
+    ):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.previous: typing.Optional[dict] = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+
+    def start(self) -> 'MetricsReporter':
+        self.thread.start()
+        return self
+
+    def __rates__(self, snapshot: dict) -> dict:
+        if self.previous is None:
+            return {}
+
+        elapsed = snapshot['time'] - self.previous['time']
+        previous = {
+            (name, make_labels(item['labels'])): item['value']
+            for name, series in self.previous['counters'].items() for item in series
+        }
+        return {
+            name: [
+                {
+                    'labels': item['labels'],
+                    'per_second': round((item['value'] - previous.get(
+                        (name, make_labels(item['labels'])), 0)) / elapsed, 3),
+                }
+                for item in series
+            ]
+            for name, series in snapshot['counters'].items()
+        }
+
+    def dump(self):
+        snapshot = self.registry.snapshot()
+        snapshot['rates'] = self.__rates__(snapshot)
+        self.previous = snapshot
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def __run__(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.dump()
+            except Exception as e:
+                logger.error(f"Can't dump metrics to '{self.path}': {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.dump()
+
+
+def serve_metrics(
+        port: int, host: str = '127.0.0.1',
+        registry: Metrics = metrics) -> http.server.ThreadingHTTPServer:
+    # Prometheus text format on any path, served from a daemon thread.
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Serving metrics on http://{host}:{server.server_port}/metrics')
+
+    return server
@@ -47,6 +47,38 @@ class StackOverflowParserFilter:
         self.max_answers_count = max_answers_count
         self.has_accepted_answer = has_accepted_answer
 
+    def key(self) -> str:
+        return ':'.join([
+            '+'.join(tag.value for tag in self.tags),
+            self.rank_by.value,
+            str(self.min_score), str(self.max_score),
+            str(self.min_answers_count), str(self.max_answers_count),
+            str(self.has_accepted_answer),
+        ])
+
+    def dict(self) -> dict:
+        return {
+            'tags': [tag.value for tag in self.tags],
+            'rank_by': self.rank_by.value,
+            'min_score': self.min_score,
+            'max_score': self.max_score,
+            'min_answers_count': self.min_answers_count,
+            'max_answers_count': self.max_answers_count,
+            'has_accepted_answer': self.has_accepted_answer,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'StackOverflowParserFilter':
+        return cls(
+            [StackOverflowParserTag(tag) for tag in data['tags']],
+            rank_by=StackOverflowParserRanking(data['rank_by']),
+            min_score=data['min_score'],
+            max_score=data['max_score'],
+            min_answers_count=data['min_answers_count'],
+            max_answers_count=data['max_answers_count'],
+            has_accepted_answer=data['has_accepted_answer'],
+        )
+
 
 class StackOverflowParserConfig:
     def __init__(
@@ -66,6 +98,9 @@ class StackOverflowParserConfig:
             StackOverflowParserPolicy.leave_as_is
         ),
         code_embedding='<CODE>|</CODE>',
+        unknown_tags_policy: StackOverflowParserPolicy = (
+            StackOverflowParserPolicy.drop
+        ),
     ):
         self.answers_limit = answers_limit
         self.only_accepted_answers = only_accepted_answers
@@ -77,20 +112,28 @@ class StackOverflowParserConfig:
         self.table_embedding = table_embedding
         self.code_policy = code_policy
         self.code_embedding = code_embedding
+        self.unknown_tags_policy = unknown_tags_policy
 
 
 class StackOverflowQuestionBlock:
     score: int
     answers_count: int
     has_accepted_answer: bool = False
+    tags: typing.Tuple[str, ...] = ()
+    activity: typing.Optional[str] = None
 
 
 class StackOverflowAnswer:
+    __slots__ = ('id', 'score', 'has_accepted', 'body')
+
     id: str
     score: int
-    has_accepted: bool = False
+    has_accepted: bool
     body: str
 
+    def __init__(self):
+        self.has_accepted = False
+
     def dict(self):
         return {
             'id': self.id,
@@ -99,8 +142,32 @@ class StackOverflowAnswer:
             'body': self.body,
         }
 
+    def row(self) -> list:
+        return [self.id, self.score, self.has_accepted, self.body]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'StackOverflowAnswer':
+        answer = cls()
+        answer.id = data['id']
+        answer.score = data['score']
+        answer.has_accepted = data['has_accepted']
+        answer.body = data['body']
+
+        return answer
+
+    @classmethod
+    def from_row(cls, row: list) -> 'StackOverflowAnswer':
+        answer = cls()
+        answer.id, answer.score, answer.has_accepted, answer.body = row
+
+        return answer
+
 
 class StackOverflowQuestion:
+    __slots__ = (
+        'id', 'title', 'score', 'answers_count', 'body', 'answers', 'filters', 'revision',
+    )
+
     id: str
     title: str
     score: int
@@ -108,6 +175,15 @@ class StackOverflowQuestion:
     body: str
 
     answers: typing.List[StackOverflowAnswer]
+    # Keys of the filters the question was found by.
+    filters: typing.List[str]
+    # Times the question was re-fetched by a refresh, the corpus keeps the
+    # latest revision of a question.
+    revision: int
+
+    def __init__(self):
+        self.filters = []
+        self.revision = 0
 
     def dict(self):
         answers_list = list(map(lambda answer: answer.dict(), self.answers))
@@ -118,4 +194,38 @@ class StackOverflowQuestion:
             'answers_count': self.answers_count,
             'body': self.body,
             'answers': answers_list,
+            'filters': self.filters,
+            'revision': self.revision,
         }
+
+    def row(self) -> list:
+        # Positional form of `dict()` used by the binary corpus codec, field
+        # names aren't repeated in every record this way.
+        return [
+            self.id, self.title, self.score, self.answers_count, self.body,
+            [answer.row() for answer in self.answers], self.filters, self.revision,
+        ]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'StackOverflowQuestion':
+        question = cls()
+        question.id = data['id']
+        question.title = data['title']
+        question.score = data['score']
+        question.answers_count = data['answers_count']
+        question.body = data['body']
+        question.answers = list(map(StackOverflowAnswer.from_dict, data['answers']))
+        question.filters = data.get('filters', [])
+        question.revision = data.get('revision', 0)
+
+        return question
+
+    @classmethod
+    def from_row(cls, row: list) -> 'StackOverflowQuestion':
+        question = cls()
+        question.id, question.title, question.score, \
+            question.answers_count, question.body, answers, \
+            question.filters, question.revision = row
+        question.answers = list(map(StackOverflowAnswer.from_row, answers))
+
+        return question
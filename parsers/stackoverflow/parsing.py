@@ -0,0 +1,81 @@
+import const
+from logger import logger
+from metrics import metrics
+import models
+import utils
+
+import bs4
+import typing
+
+# Only these regions are read by `utils`, everything else on the page is
+# skipped by the tokenizer without building a tree for it.
+LISTING_REGIONS = bs4.SoupStrainer(id='questions')
+QUESTION_REGIONS = bs4.SoupStrainer(id=['question-header', 'question', 'answers'])
+
+FALLBACK_BACKEND = 'html.parser'
+
+
+def resolve_backend(backend: str) -> str:
+    if bs4.builder.builder_registry.lookup(backend) is not None:
+        return backend
+
+    logger.warning("Parser backend '%s' is not installed, falling back to '%s'",
+                   backend, FALLBACK_BACKEND)
+    return FALLBACK_BACKEND
+
+
+def make_soup(
+        source_code: typing.Union[str, bytes],
+        backend: str = const.PARSER_BACKEND,
+        regions: typing.Optional[bs4.SoupStrainer] = None,
+) -> bs4.BeautifulSoup:
+    return bs4.BeautifulSoup(source_code, backend, parse_only=regions)
+
+
+def listing_soup(
+        source_code: typing.Union[str, bytes],
+        backend: str = const.PARSER_BACKEND,
+        targeted: bool = const.PARSER_TARGETED,
+) -> bs4.BeautifulSoup:
+    return make_soup(source_code, backend, LISTING_REGIONS if targeted else None)
+
+
+def question_soup(
+        source_code: typing.Union[str, bytes],
+        backend: str = const.PARSER_BACKEND,
+        targeted: bool = const.PARSER_TARGETED,
+) -> bs4.BeautifulSoup:
+    return make_soup(source_code, backend, QUESTION_REGIONS if targeted else None)
+
+
+def parse_question(
+        question_id: str,
+        source_code: typing.Union[str, bytes],
+        config: models.StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+        targeted: bool = const.PARSER_TARGETED,
+) -> typing.Optional[models.StackOverflowQuestion]:
+    if utils.is_source_rejected(source_code, config):
+        logger.debug('Question %s rejected by raw markup', question_id)
+        return None
+
+    with metrics.timer('parse'):
+        soup = question_soup(source_code, backend, targeted)
+    with metrics.timer('format'):
+        return utils.format_question(question_id, soup, config)
+
+
+def parse_question_record(
+        question_id: str,
+        source_code: typing.Union[str, bytes],
+        config: models.StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+        targeted: bool = const.PARSER_TARGETED,
+) -> typing.Tuple[typing.Optional[dict], dict]:
+    # Entry point of the parse processes, the result is a plain dict so it
+    # pickles back to the parent cheaply. The stage timings and rejections
+    # of the task go with it, for the parent to `metrics.merge`.
+    question = parse_question(question_id, source_code, config, backend, targeted)
+    record = None if question is None else question.dict()
+
+    return record, metrics.drain()
@@ -0,0 +1,191 @@
+import const
+from logger import logger
+from rate_limit import AdaptiveRateController
+
+import asyncio
+import random
+import threading
+import time
+import typing
+
+
+class ProxyStats:
+    def __init__(self, proxy: str, limiter: AdaptiveRateController):
+        self.proxy = proxy
+        self.limiter = limiter
+        self.requests = 0
+        self.errors = 0
+        self.challenges = 0
+        self.throttles = 0
+        self.latency: typing.Optional[float] = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def score(self) -> float:
+        # Lower is better. Proxies nobody has measured yet look fast, so
+        # each of them gets tried early on.
+        latency = self.latency if self.latency is not None else 0.0
+        return (latency + 0.1) * (1 + 4 * self.error_rate) * (1 + self.in_flight)
+
+    def dict(self, now: float) -> dict:
+        return {
+            'proxy': self.proxy.rpartition('@')[2],
+            'requests': self.requests,
+            'errors': self.errors,
+            'challenges': self.challenges,
+            'throttles': self.throttles,
+            'rate': round(self.limiter.rate, 3),
+            'latency': self.latency,
+            'error_rate': round(self.error_rate, 3),
+            'in_flight': self.in_flight,
+            'ejected_for': max(self.ejected_until - now, 0.0),
+        }
+
+
+class ProxyPool:
+    def __init__(
+            self, proxies: typing.Iterable[str],
+            rate: float = const.PROXY_RATE,
+            max_rate: float = const.PROXY_MAX_RATE,
+            max_in_flight: int = const.PROXY_MAX_IN_FLIGHT,
+            eject_after: int = const.PROXY_EJECT_AFTER,
+            cooldown: float = const.PROXY_COOLDOWN,
+            max_cooldown: float = const.PROXY_MAX_COOLDOWN,
+            smoothing: float = const.PROXY_STATS_SMOOTHING,
+    ):
+        self.proxies = {
+            proxy: ProxyStats(proxy, AdaptiveRateController(
+                initial_rate=rate, max_rate=max_rate))
+            for proxy in proxies if proxy
+        }
+        if not self.proxies:
+            raise Exception("Proxy pool can't be empty")
+
+        self.max_in_flight = max_in_flight
+        self.eject_after = eject_after
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.smoothing = smoothing
+        self.condition = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    def __try_acquire__(
+            self, exclude: typing.Container = (),
+    ) -> typing.Tuple[typing.Optional[str], float]:
+        now = time.monotonic()
+        candidates = [
+            stats for stats in self.proxies.values()
+            if not stats.is_ejected(now) and stats.proxy not in exclude
+        ]
+        if not candidates:
+            # Every proxy is ejected or excluded, a retry may reuse an
+            # excluded one rather than wait for the cooldown to end.
+            candidates = [
+                stats for stats in self.proxies.values()
+                if not stats.is_ejected(now)
+            ]
+        if not candidates:
+            return None, min(
+                stats.ejected_until for stats in self.proxies.values()) - now
+
+        waits = {
+            stats.proxy: stats.limiter.wait_time(now) for stats in candidates
+        }
+        ready = [
+            stats for stats in candidates
+            if waits[stats.proxy] == 0 and stats.in_flight < self.max_in_flight
+        ]
+        if not ready:
+            return None, max(min(waits.values()), 0.01)
+
+        best = min(ready, key=lambda stats: (stats.score(), random.random()))
+        best.limiter.take(now)
+        best.in_flight += 1
+        best.requests += 1
+
+        return best.proxy, 0.0
+
+    def acquire(self, exclude: typing.Container = ()) -> str:
+        with self.condition:
+            while True:
+                proxy, wait = self.__try_acquire__(exclude)
+                if proxy is not None:
+                    return proxy
+                self.condition.wait(wait)
+
+    async def acquire_async(self, exclude: typing.Container = ()) -> str:
+        while True:
+            with self.condition:
+                proxy, wait = self.__try_acquire__(exclude)
+            if proxy is not None:
+                return proxy
+            await asyncio.sleep(wait)
+
+    def release(
+            self, proxy: str, latency: float,
+            ok: bool = True, challenge: bool = False, throttled: bool = False):
+        with self.condition:
+            stats = self.proxies[proxy]
+            stats.in_flight -= 1
+            failed = not ok or challenge or throttled
+
+            stats.error_rate += self.smoothing * (failed - stats.error_rate)
+            if ok:
+                stats.latency = latency if stats.latency is None \
+                    else stats.latency + self.smoothing * (latency - stats.latency)
+            if not ok:
+                stats.errors += 1
+            if challenge:
+                stats.challenges += 1
+            if throttled:
+                stats.throttles += 1
+
+            if not failed:
+                stats.limiter.on_success()
+                stats.consecutive_failures = 0
+                stats.ejections = 0
+            else:
+                stats.limiter.on_throttle()
+                stats.consecutive_failures += 1
+                if stats.consecutive_failures >= self.eject_after:
+                    self.__eject__(stats)
+
+            self.condition.notify_all()
+
+    def cancel(self, proxy: str):
+        # A request dropped before it was sent tells nothing about the proxy.
+        with self.condition:
+            self.proxies[proxy].in_flight -= 1
+            self.condition.notify_all()
+
+    def __eject__(self, stats: ProxyStats):
+        cooldown = min(self.cooldown * 2 ** stats.ejections, self.max_cooldown)
+        stats.ejected_until = time.monotonic() + cooldown
+        stats.ejections += 1
+        stats.consecutive_failures = 0
+        logger.warning('Proxy %s ejected for %.0f sec',
+                       stats.proxy.rpartition('@')[2], cooldown)
+
+    def stats(self) -> typing.List[dict]:
+        with self.condition:
+            now = time.monotonic()
+            return [stats.dict(now) for stats in self.proxies.values()]
+
+    def summary(self) -> str:
+        stats = self.stats()
+        active = sum(1 for item in stats if item['ejected_for'] == 0)
+        requests = sum(item['requests'] for item in stats)
+        errors = sum(item['errors'] for item in stats)
+        challenges = sum(item['challenges'] for item in stats)
+        throttles = sum(item['throttles'] for item in stats)
+
+        return (f'{active}/{len(stats)} proxies active, {requests} requests, '
+                f'{errors} errors, {challenges} challenges, {throttles} throttles')
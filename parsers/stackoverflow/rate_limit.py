@@ -0,0 +1,104 @@
+import const
+
+import asyncio
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def __refill__(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        self.__refill__(now)
+        if self.tokens >= 1:
+            return 0.0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.__refill__(now)
+        self.tokens -= 1
+
+
+# Additive increase while responses are clean, multiplicative decrease on
+# challenges, timeouts and 429/503, the same way TCP finds its window.
+class AdaptiveRateController:
+    def __init__(
+            self, initial_rate: float = const.RATE_INITIAL,
+            min_rate: float = const.RATE_MIN,
+            max_rate: float = const.RATE_MAX,
+            increase: float = const.RATE_INCREASE,
+            decrease: float = const.RATE_DECREASE,
+            burst: float = const.RATE_BURST,
+    ):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.bucket = TokenBucket(
+            min(max(initial_rate, min_rate), max_rate), burst)
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def on_success(self):
+        with self.lock:
+            self.bucket.rate = min(self.bucket.rate + self.increase, self.max_rate)
+
+    def on_throttle(self):
+        with self.lock:
+            self.bucket.rate = max(self.bucket.rate * self.decrease, self.min_rate)
+
+    def wait_time(self, now: float) -> float:
+        with self.lock:
+            return self.bucket.wait_time(now)
+
+    def take(self, now: float):
+        with self.lock:
+            self.bucket.take(now)
+
+    def __reserve__(self) -> float:
+        # Takes a token ahead of time and returns how long to wait for it,
+        # concurrent callers queue up behind each other this way.
+        with self.lock:
+            now = time.monotonic()
+            wait = self.bucket.wait_time(now)
+            self.bucket.take(now)
+            return wait
+
+    def acquire(self):
+        wait = self.__reserve__()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.__reserve__()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class Backoff:
+    def __init__(
+            self, base: float = const.BACKOFF_BASE,
+            cap: float = const.BACKOFF_CAP,
+            max_retries: int = const.FETCH_MAX_RETRIES,
+    ):
+        self.base = base
+        self.cap = cap
+        self.max_retries = max_retries
+
+    def delay(self, attempt: int) -> float:
+        # "Full jitter": a random delay up to the exponential bound, so
+        # retries of many workers don't arrive together.
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
@@ -0,0 +1,346 @@
+from cache import ResponseCache
+import const
+from dump_ingest import add_filter_arguments
+from dump_ingest import filter_from_arguments
+from logger import logger
+from metrics import metrics
+import models
+from reparse import add_config_arguments
+from reparse import config_from_arguments
+from scrapper import StackOverflowScrapper
+from storage import ShardedCorpusStore
+import utils
+
+import argparse
+import bs4
+import sqlite3
+import threading
+import typing
+
+
+class QuestionSummary:
+    __slots__ = ('score', 'answers_count', 'has_accepted_answer', 'activity', 'revision')
+
+    def __init__(
+            self, score: int, answers_count: int,
+            has_accepted_answer: typing.Optional[bool],
+            activity: typing.Optional[str], revision: int):
+        self.score = score
+        self.answers_count = answers_count
+        self.has_accepted_answer = has_accepted_answer
+        self.activity = activity
+        self.revision = revision
+
+
+# What the listing showed of every stored question the last time it was
+# looked at. Questions picked up from the store only know their score and
+# answers count, the accepted flag and last activity are filled in by the
+# first refresh that lists them.
+class QuestionSummaries:
+    def __init__(self, path: str = const.REFRESH_SUMMARIES_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS summaries ('
+            'id INTEGER PRIMARY KEY, score INTEGER NOT NULL, '
+            'answers_count INTEGER NOT NULL, has_accepted INTEGER, activity TEXT, '
+            'revision INTEGER NOT NULL DEFAULT 0)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        self.connection.commit()
+
+    @property
+    def synced_records(self) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'synced_records'").fetchone()
+
+        return row[0] if row is not None else 0
+
+    def sync(self, records: int):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('synced_records', ?)", (records,))
+            self.connection.commit()
+
+    def sync_from_store(self, store: ShardedCorpusStore) -> int:
+        # Records appended since the last sync, by a crawl or by a refresh
+        # that died before saving its summaries. A newer revision of a
+        # question resets what is known about its listing.
+        rows = (
+            (int(record['id']), record['score'], record['answers_count'],
+             record.get('revision', 0))
+            for record in store.iter_records(self.synced_records)
+        )
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                'INSERT INTO summaries (id, score, answers_count, revision) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                'score = excluded.score, answers_count = excluded.answers_count, '
+                'has_accepted = NULL, activity = NULL, revision = excluded.revision '
+                'WHERE excluded.revision > summaries.revision', rows)
+            synced = self.connection.total_changes - before
+            self.connection.commit()
+        self.sync(len(store))
+
+        logger.info(f'Synced {synced} question summaries from the store')
+        return synced
+
+    def get(self, question_id: str) -> typing.Optional[QuestionSummary]:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT score, answers_count, has_accepted, activity, revision '
+                'FROM summaries WHERE id = ?', (int(question_id),)).fetchone()
+        if row is None:
+            return None
+
+        score, answers_count, has_accepted, activity, revision = row
+        return QuestionSummary(
+            score, answers_count,
+            None if has_accepted is None else bool(has_accepted),
+            activity, revision)
+
+    def put(self, summaries: typing.Iterable[
+            typing.Tuple[str, models.StackOverflowQuestionBlock, int]]):
+        rows = [
+            (int(question_id), block.score, block.answers_count,
+             int(block.has_accepted_answer), block.activity, revision)
+            for question_id, block, revision in summaries
+        ]
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM summaries').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def summary_change(
+        stored: QuestionSummary,
+        block: models.StackOverflowQuestionBlock) -> typing.Optional[str]:
+    # The first field that differs, fields the stored summary doesn't know
+    # yet don't count as changed.
+    if block.score != stored.score:
+        return 'score'
+    if block.answers_count != stored.answers_count:
+        return 'answers_count'
+    if stored.has_accepted_answer is not None \
+            and block.has_accepted_answer != stored.has_accepted_answer:
+        return 'accepted'
+    if stored.activity is not None and block.activity is not None \
+            and block.activity != stored.activity:
+        return 'activity'
+
+    return None
+
+
+# Walks the listing of a filter and only fetches stored questions whose
+# summary changed since they were stored, ranking by activity puts those
+# first. Re-fetched questions are appended to the corpus with the next
+# revision, readers take the latest one. Questions the corpus doesn't have
+# are left to the crawl, and the walk stops after `quiet_pages` listing
+# pages in a row without a change.
+class RefreshScrapper(StackOverflowScrapper):
+    def __init__(
+            self, filter_: models.StackOverflowParserFilter,
+            summaries: QuestionSummaries,
+            config: models.StackOverflowParserConfig = (
+                    models.StackOverflowParserConfig()
+            ),
+            delay: int = 0,
+            quiet_pages: typing.Optional[int] = const.REFRESH_QUIET_PAGES,
+            **kwargs,
+    ):
+        # Summaries are what a refresh resumes from: resumed checkpoint ids
+        # never went through the listing, so there is no summary to
+        # compare them to or save for them.
+        if kwargs.get('checkpoint') is not None:
+            raise Exception("Refresh doesn't take a checkpoint")
+        # The rest of the arguments go to `StackOverflowScrapper` as they are.
+        super().__init__(filter_, config, delay, None, **kwargs)
+        self.summaries = summaries
+        self.quiet_pages = quiet_pages
+        # Listing summaries of the changed questions in flight, saved once
+        # the new revision is stored.
+        self.changed: typing.Dict[str, typing.Tuple[models.StackOverflowQuestionBlock, int]] = {}
+        self.changed_lock = threading.Lock()
+
+    def __page_question_ids__(
+            self, soup: bs4.BeautifulSoup,
+            skip_ids: typing.Optional[typing.Container] = None,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None,
+    ) -> typing.List[str]:
+        filter_ = filter_ if filter_ is not None else self.filter
+        question_ids = []
+        unchanged = []
+
+        for question_id, question_block in self.__iter_page_blocks__(soup):
+            if self.__is_question_seen__(question_id, skip_ids):
+                metrics.inc('refresh_total', outcome='skipped')
+                continue
+
+            stored = self.summaries.get(question_id)
+            if stored is None:
+                metrics.inc('refresh_total', outcome='not_stored')
+                continue
+
+            block = utils.prepare_block(question_block)
+            field = summary_change(stored, block)
+            if field is None:
+                metrics.inc('refresh_total', outcome='unchanged')
+                unchanged.append((question_id, block, stored.revision))
+                continue
+
+            # A question that doesn't fit the filter anymore keeps its
+            # stored revision.
+            reason = utils.block_rejection_reason(block, filter_)
+            if reason is not None:
+                logger.debug('%s changed but is not suitable due to %s', question_id, reason)
+                metrics.inc('rejected_total', reason=reason)
+                unchanged.append((question_id, block, stored.revision))
+                continue
+
+            logger.debug('%s changed its %s', question_id, field)
+            metrics.inc('refresh_total', outcome='changed')
+            metrics.inc('refresh_changed_total', field=field)
+            with self.changed_lock:
+                self.changed[question_id] = (block, stored.revision + 1)
+            question_ids.append(question_id)
+
+        # Fills in what summaries taken from the store didn't know.
+        self.summaries.put(unchanged)
+        return question_ids
+
+    def __iter_page_question_ids__(
+            self, page_limit,
+            skip_ids: typing.Optional[typing.Container] = None,
+            last_page: int = 1,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None,
+    ) -> typing.Iterator[typing.Tuple[int, typing.Optional[typing.List[str]]]]:
+        quiet = 0
+        pages = super().__iter_page_question_ids__(page_limit, skip_ids, last_page, filter_)
+        try:
+            for page_number, question_ids in pages:
+                yield page_number, question_ids
+                if question_ids is None:
+                    # Not read, so it says nothing about changes.
+                    continue
+                quiet = 0 if question_ids else quiet + 1
+                if self.quiet_pages is not None and quiet >= self.quiet_pages:
+                    logger.info(f'No changes in {quiet} pages up to page {page_number}, '
+                                f'stopping refresh')
+                    return
+        finally:
+            pages.close()
+
+    def __get_question_source__(self, question_id: str) -> bytes:
+        # A cached page is the old revision, the fresh one replaces it.
+        url = self.__get_question_url_encoded__(question_id)
+        source_code = self.__get_source_code__(url, raw=True)
+        if self.cache is not None:
+            self.cache.put(url, source_code)
+
+        return source_code
+
+    def __resolve_result__(self, question_id, result, error):
+        question = super().__resolve_result__(question_id, result, error)
+        if question is not None:
+            with self.changed_lock:
+                question.revision = self.changed[question_id][1]
+
+        return question
+
+    def __record_result__(
+            self, question_id: str,
+            question: typing.Optional[models.StackOverflowQuestion],
+            failed: bool = False):
+        super().__record_result__(question_id, question, failed)
+        # A failed question is tried again by the next refresh. One that
+        # doesn't satisfy the config anymore keeps its stored revision.
+        if question is not None:
+            return
+        with self.changed_lock:
+            block, revision = self.changed.pop(question_id)
+        if not failed:
+            self.summaries.put([(question_id, block, revision - 1)])
+
+    def mark_stored(self, question_ids: typing.Iterable[str]):
+        question_ids = list(question_ids)
+        super().mark_stored(question_ids)
+
+        with self.changed_lock:
+            stored = [
+                (question_id, *self.changed.pop(question_id))
+                for question_id in question_ids
+            ]
+        self.summaries.put(stored)
+
+
+def refresh(
+        scrapper: RefreshScrapper, store: ShardedCorpusStore, count: int,
+        page_limit: int, batch_size: int = 500) -> int:
+    refreshed = 0
+
+    def flush(questions_):
+        store.append(questions_)
+        scrapper.mark_stored(question.id for question in questions_)
+        scrapper.summaries.sync(len(store))
+
+    questions = []
+    for question in scrapper.iter_questions(count, page_limit):
+        questions.append(question)
+        refreshed += 1
+        if len(questions) >= batch_size:
+            flush(questions)
+            questions = []
+    flush(questions)
+
+    logger.info(f'Refreshed {refreshed} questions')
+    return refreshed
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Re-fetch stored questions whose listing summary changed')
+    argument_parser.add_argument('--output', default=const.CORPUS_DIR)
+    argument_parser.add_argument('--summaries', default=const.REFRESH_SUMMARIES_PATH)
+    argument_parser.add_argument('--cache', default=None)
+    argument_parser.add_argument('--base-url', default=const.STACKOVERFLOW_BASE_URL)
+    argument_parser.add_argument('--questions', type=int, default=1000000)
+    argument_parser.add_argument('--pages', type=int, default=1000)
+    argument_parser.add_argument('--quiet-pages', type=int, default=const.REFRESH_QUIET_PAGES)
+    argument_parser.add_argument('--fetch-workers', type=int, default=const.FETCH_WORKERS)
+    add_filter_arguments(argument_parser)
+    add_config_arguments(argument_parser)
+    # Most recently active questions first, changed ones are there.
+    argument_parser.set_defaults(rank_by=models.StackOverflowParserRanking.active.name)
+    arguments = argument_parser.parse_args()
+
+    store = ShardedCorpusStore(arguments.output)
+    summaries = QuestionSummaries(arguments.summaries)
+    scrapper = RefreshScrapper(
+        filter_from_arguments(arguments), summaries,
+        config_from_arguments(arguments),
+        quiet_pages=arguments.quiet_pages if arguments.quiet_pages > 0 else None,
+        fetch_workers=arguments.fetch_workers,
+        cache=ResponseCache(arguments.cache) if arguments.cache is not None else None,
+        base_url=arguments.base_url,
+    )
+    try:
+        summaries.sync_from_store(store)
+        refresh(scrapper, store, arguments.questions, arguments.pages + 1)
+    finally:
+        scrapper.close()
+        summaries.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import cache
+import const
+from logger import logger
+from metrics import metrics
+import models
+from models import StackOverflowParserConfig
+from models import StackOverflowParserPolicy
+import parsing
+from storage import ShardedCorpusStore
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import typing
+import urllib.parse
+
+QUESTION_PATH_PREFIX = const.STACKOVERFLOW_QUESTION_PATH.partition('{}')[0]
+
+
+def question_id_from_url(url: str) -> typing.Optional[str]:
+    path = urllib.parse.urlparse(url).path
+    if not path.startswith(QUESTION_PATH_PREFIX):
+        return None
+
+    question_id = path[len(QUESTION_PATH_PREFIX):].partition('/')[0]
+    return question_id if question_id.isdigit() else None
+
+
+def reparse_subdirectory(
+        cache_directory: str, subdirectory: str,
+        config: StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND,
+) -> typing.Tuple[typing.List[dict], int, dict]:
+    # Runs in a worker process over one of the 256 cache fan-out directories,
+    # its parse metrics go back to the parent with the records.
+    records = []
+    failed = 0
+    for path in cache.iter_entry_paths(cache_directory, subdirectory):
+        try:
+            url, source_code, _ = cache.read_entry(path)
+            question_id = question_id_from_url(url)
+            if question_id is None:
+                continue
+
+            question = parsing.parse_question(
+                question_id, source_code, config, backend)
+            if question is not None:
+                records.append(question.dict())
+        except Exception as e:
+            logger.error("Can't reparse '%s': %s", path, e)
+            failed += 1
+
+    return records, failed, metrics.drain()
+
+
+def reparse(
+        cache_directory: str, store: ShardedCorpusStore,
+        config: StackOverflowParserConfig,
+        workers: typing.Optional[int] = None,
+        backend: str = const.PARSER_BACKEND,
+) -> int:
+    written = 0
+
+    with ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context(const.PARSE_START_METHOD),
+    ) as executor:
+        futures = [
+            executor.submit(
+                reparse_subdirectory, cache_directory, subdirectory, config, backend)
+            for subdirectory in cache.cache_subdirectories(cache_directory)
+        ]
+        for future in futures:
+            records, failed, drained = future.result()
+            metrics.merge(drained)
+            written += store.append(records)
+            if failed:
+                logger.warning('%s cache entries failed to reparse', failed)
+
+    logger.info(f'Reparsed {written} questions from {cache_directory}')
+    return written
+
+
+def add_config_arguments(argument_parser: argparse.ArgumentParser):
+    policies = [policy.name for policy in StackOverflowParserPolicy]
+    argument_parser.add_argument('--answers-limit', type=int, default=1)
+    argument_parser.add_argument('--only-accepted-answers', action='store_true')
+    argument_parser.add_argument('--min-answer-score', type=int, default=0)
+    argument_parser.add_argument('--max-answer-score', type=int, default=None)
+    argument_parser.add_argument('--images-policy', choices=policies, default='leave_as_is')
+    argument_parser.add_argument('--tables-policy', choices=policies, default='leave_as_is')
+    argument_parser.add_argument('--code-policy', choices=policies, default='leave_as_is')
+    argument_parser.add_argument('--unknown-tags-policy', choices=policies, default='drop')
+
+
+def config_from_arguments(arguments: argparse.Namespace) -> StackOverflowParserConfig:
+    return models.StackOverflowParserConfig(
+        answers_limit=arguments.answers_limit,
+        only_accepted_answers=arguments.only_accepted_answers,
+        min_answer_score=arguments.min_answer_score,
+        max_answer_score=arguments.max_answer_score,
+        images_policy=StackOverflowParserPolicy[arguments.images_policy],
+        tables_policy=StackOverflowParserPolicy[arguments.tables_policy],
+        code_policy=StackOverflowParserPolicy[arguments.code_policy],
+        unknown_tags_policy=StackOverflowParserPolicy[arguments.unknown_tags_policy],
+    )
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description='Re-run format_question over every cached question page')
+    argument_parser.add_argument('--cache', default=const.CACHE_DIR)
+    argument_parser.add_argument('--output', required=True)
+    argument_parser.add_argument('--workers', type=int, default=None)
+    argument_parser.add_argument('--backend', default=const.PARSER_BACKEND)
+    add_config_arguments(argument_parser)
+    arguments = argument_parser.parse_args()
+
+    store = ShardedCorpusStore(arguments.output)
+    reparse(arguments.cache, store, config_from_arguments(arguments),
+            arguments.workers, parsing.resolve_backend(arguments.backend))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,53 @@
-import random
-
+from cache import ResponseCache
+from checkpoint import CrawlCheckpoint
 import const
+from exceptions import FetchFailedException
+from hedging import HedgeAttempt, HedgePolicy
 from logger import logger
+from metrics import metrics
 import models
+import parsing
+from proxy_pool import ProxyPool
+from rate_limit import AdaptiveRateController, Backoff
 import utils
 
 import bs4
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from fp.fp import FreeProxy
-from random import choice
+import collections
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait
+import itertools
+import multiprocessing
+import queue
 import requests
-from requests.auth import HTTPProxyAuth
+import threading
 import time
 import typing
 import urllib.parse
 
 requests.packages.urllib3.disable_warnings()
 
+
+def put_until(queue_: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            queue_.put(item, timeout=const.QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def get_until(queue_: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return queue_.get(timeout=const.QUEUE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+
+    return None
+
+
 class StackOverflowScrapper:
     def __init__(
             self, filter_: models.StackOverflowParserFilter,
@@ -24,151 +55,434 @@ class StackOverflowScrapper:
                     models.StackOverflowParserConfig()
             ),
             delay: int = 0,
+            seen_ids: typing.Optional[typing.Container] = None,
+            prefetch_pages: int = const.PREFETCH_PAGES,
+            fetch_workers: int = const.FETCH_WORKERS,
+            queue_size: int = const.QUESTION_QUEUE_SIZE,
+            stream_window: int = const.STREAM_WINDOW,
+            parser_backend: str = const.PARSER_BACKEND,
+            targeted_parsing: bool = const.PARSER_TARGETED,
+            parse_workers: int = const.PARSE_WORKERS,
+            proxy_pool: typing.Optional[ProxyPool] = None,
+            rate_controller: typing.Optional[AdaptiveRateController] = None,
+            backoff: typing.Optional[Backoff] = None,
+            cache: typing.Optional[ResponseCache] = None,
+            checkpoint: typing.Optional[CrawlCheckpoint] = None,
+            base_url: str = const.STACKOVERFLOW_BASE_URL,
+            hedge: typing.Optional[HedgePolicy] = None,
     ):
         self.filter = filter_
         self.config = config
         self.delay = delay
-        self.proxy_switch_retries = 3
-        self.__switch_proxy__()
-
-        if delay < 0.05:
-            logger.warn(f'You set delay {delay}. You might be'
-                        f' banned soon, set the correct one please')
-
-    def __switch_proxy__(self):
-        self.session = requests.Session()
-        self.session.proxies = {
-            'https': f'http://{choice(const.PAID_PROXY)}'
-        }
-        self.session.trust_env = False
-
-    def __get_page_url_encoded__(self, page: int = 0) -> str:
+        self.seen_ids = seen_ids
+        self.prefetch_pages = prefetch_pages
+        self.fetch_workers = fetch_workers
+        self.queue_size = queue_size
+        self.stream_window = stream_window
+        self.base_url = base_url.rstrip('/')
+        self.last_page = 1
+        self.parser_backend = parsing.resolve_backend(parser_backend)
+        self.targeted_parsing = targeted_parsing
+        self.parse_workers = parse_workers
+        self.parse_pool: typing.Optional[ProcessPoolExecutor] = None
+        self.parse_pool_lock = threading.Lock()
+        self.proxy_pool = proxy_pool if proxy_pool is not None \
+            else ProxyPool(const.PAID_PROXY)
+        self.sessions: typing.Dict[str, requests.Session] = {}
+        self.sessions_lock = threading.Lock()
+        # `delay` is only the starting point now, the controller speeds up
+        # or slows down from there depending on the responses.
+        self.rate_controller = rate_controller if rate_controller is not None \
+            else AdaptiveRateController(
+                initial_rate=1 / delay if delay > 0 else const.RATE_INITIAL)
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.failed_question_ids: typing.Set[str] = set()
+        # First listing page of every filter that failed to fetch in the
+        # running crawl, see `__record_page__`.
+        self.failed_pages: typing.Dict[str, int] = {}
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.hedge = hedge
+        self.hedge_pool: typing.Optional[ThreadPoolExecutor] = None
+        self.hedge_pool_lock = threading.Lock()
+
+    def __get_parse_pool__(self) -> ProcessPoolExecutor:
+        with self.parse_pool_lock:
+            if self.parse_pool is None:
+                self.parse_pool = ProcessPoolExecutor(
+                    self.parse_workers,
+                    mp_context=multiprocessing.get_context(const.PARSE_START_METHOD))
+
+            return self.parse_pool
+
+    def __get_hedge_pool__(self) -> ThreadPoolExecutor:
+        # Both copies of every request in flight, from fetch workers and
+        # listing prefetch alike.
+        with self.hedge_pool_lock:
+            if self.hedge_pool is None:
+                self.hedge_pool = ThreadPoolExecutor(
+                    2 * (self.fetch_workers + max(self.prefetch_pages, 1)))
+
+            return self.hedge_pool
+
+    def close(self):
+        with self.parse_pool_lock:
+            if self.parse_pool is not None:
+                self.parse_pool.shutdown()
+                self.parse_pool = None
+        with self.hedge_pool_lock:
+            if self.hedge_pool is not None:
+                self.hedge_pool.shutdown()
+                self.hedge_pool = None
+
+    def __get_session__(self, proxy: str) -> requests.Session:
+        # One session per proxy keeps its connections alive between requests.
+        with self.sessions_lock:
+            if proxy not in self.sessions:
+                session = requests.Session()
+                session.proxies = {
+                    'https': f'http://{proxy}'
+                }
+                session.trust_env = False
+                self.sessions[proxy] = session
+
+            return self.sessions[proxy]
+
+    def __get_page_url_encoded__(
+            self, page: int = 0,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None) -> str:
         if page < 0:
             raise Exception("Page can't be below zero")
 
-        tags_concatenated = " ".join(map(lambda tag: tag.value, self.filter.tags))
+        filter_ = filter_ if filter_ is not None else self.filter
+        tags_concatenated = " ".join(map(lambda tag: tag.value, filter_.tags))
         tags_encoded = urllib.parse.quote(tags_concatenated)
-        rank_by_encoded = urllib.parse.quote(self.filter.rank_by.value)
+        rank_by_encoded = urllib.parse.quote(filter_.rank_by.value)
 
-        return const.STACKOVERFLOW_URL.format(
+        return self.base_url + const.STACKOVERFLOW_LISTING_PATH.format(
             tags_encoded,
             rank_by_encoded,
             page,
         )
 
     def __get_question_url_encoded__(self, question_id: str) -> str:
-        return const.STACKOVERFLOW_QUESTION_URL.format(question_id)
-
-    def __make_request__(self, url):
+        return self.base_url + const.STACKOVERFLOW_QUESTION_PATH.format(question_id)
+
+    def __classify_response__(
+            self, status_code: int, challenge: bool) -> typing.Optional[str]:
+        if challenge:
+            return 'challenge'
+        if status_code in const.THROTTLE_STATUS_CODES:
+            return f'throttled with {status_code}'
+        if status_code in const.GONE_STATUS_CODES:
+            return 'gone'
+        if status_code >= 500:
+            return f'server error {status_code}'
+        if status_code in const.PROXY_ERROR_STATUS_CODES:
+            return f'proxy error {status_code}'
+        if not 200 <= status_code < 300:
+            # Whatever this page is, it isn't the one asked for.
+            return f'unexpected status {status_code}'
+
+        return None
+
+    def __release_proxy__(
+            self, proxy: str, started: float,
+            failure: typing.Optional[str], timed_out: bool = False):
+        latency = time.monotonic() - started
+        metrics.observe('stage_seconds', latency, stage='request')
+        metrics.inc('requests_total', proxy=proxy.rpartition('@')[2],
+                    outcome=failure or 'ok')
+        if failure is None or failure == 'gone':
+            self.proxy_pool.release(proxy, latency)
+            self.rate_controller.on_success()
+            if self.hedge is not None:
+                self.hedge.observe(latency)
+            return
+
+        # Challenges and throttling are the site pushing back through a
+        # working proxy, anything else counts against the proxy.
+        challenge = failure == 'challenge'
+        throttled = failure.startswith('throttled')
+        self.proxy_pool.release(
+            proxy, latency,
+            ok=challenge or throttled,
+            challenge=challenge,
+            throttled=throttled)
+        if timed_out or challenge or throttled or failure.startswith('server error'):
+            self.rate_controller.on_throttle()
+
+    def __make_request__(
+            self, url,
+            exclude: typing.Container = (),
+            attempt: typing.Optional[HedgeAttempt] = None,
+    ) -> typing.Tuple[str, typing.Optional[requests.Response], typing.Optional[str]]:
+        with metrics.timer('rate_wait', profile=False):
+            self.rate_controller.acquire()
+        with metrics.timer('proxy_wait', profile=False):
+            proxy = self.proxy_pool.acquire(exclude)
+        if attempt is not None:
+            if attempt.cancelled.is_set():
+                self.proxy_pool.cancel(proxy)
+                return proxy, None, 'cancelled'
+            attempt.send(proxy)
+        started = time.monotonic()
         try:
-            response = self.session.get(url, timeout=3, verify=False)
-            return response
+            response = self.__get_session__(proxy).get(
+                url, timeout=const.REQUEST_TIMEOUT, verify=False)
         except Exception as e:
-            logger.error(f'Error during request: {e}')
-            return None
-
-    def __get_source_code__(self, url):
-        retries_count = 0
-        response = self.__make_request__(url)
-        while response is None or 'Just a moment...' in response.text:
-            logger.warn('No answer from stackoverflow. Retrying in 1 sec...')
-            retries_count += 1
-            time.sleep(1)
-            if retries_count >= self.proxy_switch_retries:
-                self.__switch_proxy__()
-                retries_count = 0
-                logger.warn(f'Switching proxy to {self.session.proxies}, retrying...')
+            logger.error('Error during request: %s', e)
+            self.__release_proxy__(
+                proxy, started, 'error',
+                timed_out=isinstance(e, requests.exceptions.Timeout))
+            return proxy, None, 'error'
+
+        failure = self.__classify_response__(
+            response.status_code, 'Just a moment...' in response.text)
+        self.__release_proxy__(proxy, started, failure)
+
+        return proxy, response, failure
+
+    def __make_hedged_request__(
+            self, url,
+            exclude: typing.Container = (),
+    ) -> typing.Tuple[str, typing.Optional[requests.Response], typing.Optional[str]]:
+        # Both copies run in the hedge pool, so the caller returns with the
+        # first good response. `requests` can't abort a request on the
+        # wire: a losing copy that was already sent finishes in the pool
+        # and its response is dropped, one that wasn't is never sent.
+        self.hedge.on_request()
+        delay = self.hedge.delay()
+        if delay is None:
+            return self.__make_request__(url, exclude)
+
+        pool = self.__get_hedge_pool__()
+        primary, hedge = HedgeAttempt(), HedgeAttempt()
+        primary_future = pool.submit(self.__make_request__, url, exclude, primary)
+        primary_future.add_done_callback(lambda _: primary.sent.set())
+        attempts = {primary_future: primary}
+
+        primary.sent.wait()
+        hedged = False
+        if wait([primary_future], timeout=delay).not_done and self.hedge.try_hedge():
+            metrics.inc('hedges_total', outcome='sent')
+            attempts[pool.submit(
+                self.__make_request__, url, (*exclude, primary.proxy), hedge)] = hedge
+            hedged = True
+
+        # A failed copy leaves the other one to answer, with both failed the
+        # last failure goes to the retry loop.
+        result = None
+        while attempts:
+            done, _ = wait(attempts, return_when=FIRST_COMPLETED)
+            winner = next((
+                future for future in done
+                if future.result()[2] in (None, 'gone')), None)
+            for future in done:
+                attempts.pop(future)
+                result = future.result()
+            if winner is None:
+                continue
 
-            response = self.__make_request__(url)
+            result = winner.result()
+            if hedged:
+                metrics.inc('hedges_total',
+                            outcome='lost' if winner is primary_future else 'won')
+            for future, attempt in attempts.items():
+                attempt.cancelled.set()
+                future.cancel()
+            break
+
+        return result
+
+    def __get_source_code__(self, url, raw: bool = False):
+        make_request = self.__make_hedged_request__ if self.hedge is not None \
+            else self.__make_request__
+        with metrics.timer('fetch'):
+            proxy, response, failure = make_request(url)
+            attempt = 0
+            while failure is not None:
+                if failure == 'gone':
+                    raise FetchFailedException(url, failure)
+                if attempt >= self.backoff.max_retries:
+                    raise FetchFailedException(
+                        url, f'{failure} after {attempt + 1} attempts')
+
+                # The retry goes through another proxy, a failing one is
+                # ejected by the pool once it keeps failing.
+                delay = self.backoff.delay(attempt)
+                logger.warning('No answer from stackoverflow (%s). Retrying in %.1f sec...',
+                               failure, delay)
+                metrics.inc('retries_total', reason=failure)
+                time.sleep(delay)
+                attempt += 1
+                proxy, response, failure = make_request(url, exclude=(proxy,))
+
+        if raw:
+            return response.content
 
         return response.text
 
-    def __page_soup__(self, page: int = 0) -> bs4.BeautifulSoup:
-        time.sleep(self.delay)
-        source_code = self.__get_source_code__(self.__get_page_url_encoded__(page))
-        soup = bs4.BeautifulSoup(source_code, 'html.parser')
+    def __page_soup__(
+            self, page: int = 0,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None,
+    ) -> bs4.BeautifulSoup:
+        source_code = self.__get_source_code__(
+            self.__get_page_url_encoded__(page, filter_))
+        with metrics.timer('listing_parse'):
+            soup = parsing.listing_soup(
+                source_code, self.parser_backend, self.targeted_parsing)
 
         return soup
 
-    def __question_soap__(self, question_id: str) -> bs4.BeautifulSoup:
-        time.sleep(self.delay)
-        source_code = self.__get_source_code__(self.__get_question_url_encoded__(question_id))
-        soup = bs4.BeautifulSoup(source_code, 'html.parser')
+    def __get_question_source__(self, question_id: str) -> bytes:
+        # Only question pages are cached, listing pages change all the time.
+        url = self.__get_question_url_encoded__(question_id)
+        if self.cache is not None:
+            source_code = self.cache.get(url)
+            if source_code is not None:
+                return source_code
+
+        source_code = self.__get_source_code__(url, raw=True)
+        if self.cache is not None:
+            self.cache.put(url, source_code)
+
+        return source_code
+
+    def __submit_question_parse__(self, question_id: str) -> Future:
+        # Only the download happens in the fetching thread, the bytes go to
+        # the parse processes and come back as a `StackOverflowQuestion.dict()`
+        # with the metrics the worker recorded while parsing it.
+        source_code = self.__get_question_source__(question_id)
+
+        submitted = time.perf_counter()
+        future = self.__get_parse_pool__().submit(
+            parsing.parse_question_record, question_id, source_code,
+            self.config, self.parser_backend, self.targeted_parsing)
+        future.add_done_callback(
+            lambda done: self.__parse_done__(done, submitted))
+
+        return future
+
+    def __parse_done__(self, future: Future, submitted: float):
+        metrics.observe(
+            'stage_seconds', time.perf_counter() - submitted, stage='parse_task')
+        if not future.cancelled() and future.exception() is None:
+            metrics.merge(future.result()[1])
 
-        return soup
+    def __is_question_block_suitable__(
+            self, question_block: bs4.element.Tag,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None) -> bool:
+        block = utils.prepare_block(question_block)
+        block_id = question_block.attrs['id']
+        question_id = block_id.partition('question-summary-')[2]
 
-    def __is_score_suitable__(self, score: int) -> bool:
-        if self.filter.min_score > score:
-            return False
-        if self.filter.max_score is not None \
-                and self.filter.max_score < score:
+        reason = utils.block_rejection_reason(
+            block, filter_ if filter_ is not None else self.filter)
+        if reason is not None:
+            logger.debug('%s is not suitable due to %s', question_id, reason)
+            metrics.inc('rejected_total', reason=reason)
             return False
-        return True
 
-    def __is_answers_count_suitable__(self, answers_count: int) -> bool:
-        if self.filter.min_answers_count > answers_count:
-            return False
-        if self.filter.max_answers_count is not None \
-                and self.filter.max_answers_count < answers_count:
-            return False
         return True
 
-    def __is_accepted_answer_suitable__(self, has_accepted_answer: bool) -> bool:
-        if self.filter.has_accepted_answer is None:
+    def __is_question_seen__(
+            self, question_id: str,
+            skip_ids: typing.Optional[typing.Container] = None) -> bool:
+        if self.seen_ids is not None and question_id in self.seen_ids:
+            return True
+        if skip_ids is not None and question_id in skip_ids:
             return True
 
-        return self.filter.has_accepted_answer == has_accepted_answer
+        return False
 
-    def __is_question_block_suitable__(
-            self, question_block: bs4.element.Tag) -> bool:
-        block = utils.prepare_block(question_block)
-        block_id = question_block.attrs['id']
-        question_id = block_id.partition('question-summary-')[2]
+    def __iter_page_blocks__(
+            self, soup: bs4.BeautifulSoup,
+    ) -> typing.Iterator[typing.Tuple[str, bs4.element.Tag]]:
+        questions = soup.find('div', {'id': 'questions'})
+        if not questions:
+            logger.error("questions is none")
+            return
 
-        if not self.__is_score_suitable__(block.score):
-            logger.debug(f"{question_id} is not suitable due to score")
-            return False
-        if not self.__is_answers_count_suitable__(block.answers_count):
-            logger.debug(f"{question_id} is not suitable due to answers count")
-            return False
-        if not self.__is_accepted_answer_suitable__(block.has_accepted_answer):
-            logger.debug(f"{question_id} is not suitable due to accepted answers")
-            return False
+        for question_block in questions.children:
+            question_block: typing.Union[bs4.element.NavigableString, bs4.element.Tag]
+            if isinstance(question_block, bs4.element.NavigableString):
+                continue
 
-        return True
+            block_id = question_block.attrs['id']
+            yield block_id.partition('question-summary-')[2], question_block
+
+    def __page_question_ids__(
+            self, soup: bs4.BeautifulSoup,
+            skip_ids: typing.Optional[typing.Container] = None,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None,
+    ) -> typing.List[str]:
+        question_ids = []
+
+        for question_id, question_block in self.__iter_page_blocks__(soup):
+            if not self.__is_question_block_suitable__(question_block, filter_):
+                continue
+
+            if self.__is_question_seen__(question_id, skip_ids):
+                logger.debug('Skipping question %s', question_id)
+                metrics.inc('rejected_total', reason='seen')
+                continue
+
+            question_ids.append(question_id)
+
+        return question_ids
+
+    def __iter_page_question_ids__(
+            self, page_limit,
+            skip_ids: typing.Optional[typing.Container] = None,
+            last_page: int = 1,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None,
+    ) -> typing.Iterator[typing.Tuple[int, typing.Optional[typing.List[str]]]]:
+        # Listing pages are fetched `prefetch_pages` ahead of the page being
+        # filtered, results are still yielded in page order. A page that
+        # couldn't be fetched is yielded with None instead of its ids.
+        pages = iter(range(last_page, page_limit))
+        with ThreadPoolExecutor(max(self.prefetch_pages, 1)) as executor:
+            prefetched = collections.deque()
+            for page_number in itertools.islice(pages, max(self.prefetch_pages, 1)):
+                prefetched.append((page_number, executor.submit(
+                    self.__page_soup__, page_number - 1, filter_)))
+
+            try:
+                while prefetched:
+                    page_number, future = prefetched.popleft()
+                    next_page_number = next(pages, None)
+                    if next_page_number is not None:
+                        prefetched.append((next_page_number, executor.submit(
+                            self.__page_soup__, next_page_number - 1, filter_)))
+
+                    logger.debug('Moving to page %s', page_number)
+                    try:
+                        soup = future.result()
+                    except FetchFailedException as e:
+                        logger.error('Listing page %s skipped: %s', page_number, e)
+                        yield page_number, None
+                        continue
+
+                    yield page_number, self.__page_question_ids__(soup, skip_ids, filter_)
+            finally:
+                for _, pending in prefetched:
+                    pending.cancel()
 
     def __get_question_ids_(self, count, page_limit,
-                            skip_ids: typing.Optional[typing.Set] = None,
+                            skip_ids: typing.Optional[typing.Container] = None,
                             last_page: int = 1,
     ) -> typing.Tuple[typing.List[str], int]:
         question_ids = []
         logger.info("Starting scrapping ids")
         new_last_page = last_page
 
-        for page_number in range(last_page, page_limit):
-            new_last_page = page_number
-            logger.debug(f"Moving to page {page_number}")
-            soup = self.__page_soup__(page_number - 1)
-            questions = soup.find('div', {'id': 'questions'})
-            if not questions:
-                logger.error("questions is none")
+        for page_number, page_question_ids in self.__iter_page_question_ids__(
+                page_limit, skip_ids, last_page):
+            if page_question_ids is None:
                 continue
-            for question_block in questions.children:
-                question_block: typing.Union[bs4.element.NavigableString, bs4.element.Tag]
-                if isinstance(question_block, bs4.element.NavigableString):
-                    continue
-
-                if not self.__is_question_block_suitable__(question_block):
-                    continue
-
-                block_id = question_block.attrs['id']
-                question_id = block_id.partition('question-summary-')[2]
-
-                if skip_ids and question_id in skip_ids:
-                    logger.debug(f"Skipping question {question_id}")
-                    continue
-
-                question_ids.append(question_id)
+            new_last_page = page_number
+            question_ids.extend(page_question_ids)
 
             if len(question_ids) >= count:
                 logger.info(f"Scrapper found {count} questions "
@@ -183,42 +497,244 @@ class StackOverflowScrapper:
 
         return question_ids, new_last_page
 
+    def __resume_page__(
+            self, last_page: int,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None) -> int:
+        if self.checkpoint is None:
+            return last_page
+
+        filter_ = filter_ if filter_ is not None else self.filter
+        return max(last_page, self.checkpoint.cursor(filter_.key()) + 1)
+
+    def __resumed_question_ids__(
+            self, skip_ids: typing.Optional[typing.Container] = None,
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None,
+    ) -> typing.List[str]:
+        # Ids found on already scanned pages that were never stored, plus
+        # failed ones that still have retries left.
+        if self.checkpoint is None:
+            return []
+
+        filter_ = filter_ if filter_ is not None else self.filter
+        resumed = []
+        for question_id in self.checkpoint.resumable_ids(filter_.key()):
+            if self.__is_question_seen__(question_id, skip_ids):
+                self.checkpoint.question_done(question_id)
+                continue
+            resumed.append(question_id)
+
+        if resumed:
+            logger.info(f"Resuming {len(resumed)} questions from checkpoint")
+        return resumed
+
+    def __record_page__(
+            self, page_number: int, question_ids: typing.Optional[typing.List[str]],
+            filter_: typing.Optional[models.StackOverflowParserFilter] = None) -> int:
+        # Returns the last page the crawl can resume after. Once a page of a
+        # filter failed to fetch, its cursor stays before that page, so a
+        # resumed crawl lists it again. The ids of pages read after it are
+        # still journaled as pending.
+        filter_ = filter_ if filter_ is not None else self.filter
+        if question_ids is None:
+            self.failed_pages.setdefault(filter_.key(), page_number)
+        failed_page = self.failed_pages.get(filter_.key())
+        cursor = page_number if failed_page is None else min(page_number, failed_page - 1)
+        if self.checkpoint is not None and question_ids is not None:
+            self.checkpoint.page_scanned(filter_.key(), cursor, question_ids)
+
+        return cursor
+
+    def __record_result__(
+            self, question_id: str,
+            question: typing.Optional[models.StackOverflowQuestion],
+            failed: bool = False):
+        # Scrapped questions stay pending until the caller stores them and
+        # calls `mark_stored`, only rejected and failed ones are final here.
+        if self.checkpoint is None:
+            return
+        if failed:
+            self.checkpoint.question_failed(question_id)
+        elif question is None:
+            self.checkpoint.question_done(question_id)
+
+    def mark_stored(self, question_ids: typing.Iterable[str]):
+        if self.checkpoint is None:
+            return
+        for question_id in question_ids:
+            self.checkpoint.question_done(question_id)
+
+    def __produce_question_ids__(
+            self, put: typing.Callable[[str], bool], count, page_limit,
+            skip_ids: typing.Optional[typing.Container] = None,
+            last_page: int = 1,
+    ) -> int:
+        produced = 0
+        queued = set()
+        self.failed_pages.clear()
+        logger.info("Starting scrapping ids")
+
+        for question_id in self.__resumed_question_ids__(skip_ids)[:count]:
+            if not put(question_id):
+                return last_page
+            queued.add(question_id)
+            produced += 1
+
+        last_page = self.__resume_page__(last_page)
+        new_last_page = last_page
+        if produced >= count:
+            return new_last_page
+
+        for page_number, page_question_ids in self.__iter_page_question_ids__(
+                page_limit, skip_ids, last_page):
+            new_last_page = self.__record_page__(page_number, page_question_ids)
+            for question_id in page_question_ids or ():
+                if produced >= count:
+                    break
+                if question_id in queued:
+                    continue
+                # Blocks while fetch workers are behind.
+                if not put(question_id):
+                    return new_last_page
+                queued.add(question_id)
+                produced += 1
+
+            if produced >= count:
+                logger.info(f"Scrapper found {count} questions "
+                            f"in first {page_number} pages. "
+                            f"Stopping scrapping ids")
+                break
+        else:
+            if produced < count:
+                logger.info(f"Pages limit reached. "
+                            f"Found {produced} in {page_limit} pages")
+
+        return new_last_page
+
     def get_question(
             self, question_id: str) -> typing.Optional[models.StackOverflowQuestion]:
-        soup = self.__question_soap__(question_id)
-        question = utils.format_question(question_id, soup, self.config)
+        source_code = self.__get_question_source__(question_id)
+        question = parsing.parse_question(
+            question_id, source_code, self.config,
+            self.parser_backend, self.targeted_parsing)
 
         if question is None:
             return None
 
         return question
 
-    def get_questions(self, count: int, page_limit: int = 100, skip_ids=None, last_page=1):
-        questions_ids, last_page = self.__get_question_ids_(count, page_limit, skip_ids, last_page)
-        logger.info(f"Successfully extracted {len(questions_ids)} question ids")
+    def __question_filters__(self, question_id: str) -> typing.List[str]:
+        return [self.filter.key()]
 
-        questions = []
-        answers_quantity = 0
+    def __resolve_result__(
+            self, question_id: str,
+            result: typing.Union[None, models.StackOverflowQuestion, Future],
+            error: typing.Optional[Exception],
+    ) -> typing.Optional[models.StackOverflowQuestion]:
+        try:
+            if error is not None:
+                raise error
+            if isinstance(result, Future):
+                record, _ = result.result()
+                result = None if record is None \
+                    else models.StackOverflowQuestion.from_dict(record)
+        except Exception as exc:
+            logger.error('Question id %s generated an exception: %s', question_id, exc)
+            self.failed_question_ids.add(question_id)
+            self.__record_result__(question_id, None, failed=True)
+            return None
 
-        # Создаем пул потоков
-        with ThreadPoolExecutor() as executor:
-            # Создаем future для каждого question_id
-            future_to_question_id = {executor.submit(self.get_question, question_id): question_id for question_id in
-                                     questions_ids}
+        self.__record_result__(question_id, result)
+        if result is not None:
+            result.filters = self.__question_filters__(question_id)
+            logger.debug("Question '%s' scrapped successfully", question_id)
+        else:
+            logger.debug("Question '%s' do not satisfy filters", question_id)
+
+        return result
+
+    def __question_worker__(
+            self, ids_queue: queue.Queue, results: queue.Queue,
+            stop: threading.Event):
+        while True:
+            question_id = get_until(ids_queue, stop)
+            if question_id is None:
+                put_until(results, None, stop)
+                return
+
+            # With a parse pool the future goes to the consumer, so this
+            # thread is free for the next download right away.
+            result, error = None, None
+            try:
+                if self.parse_workers > 0:
+                    result = self.__submit_question_parse__(question_id)
+                else:
+                    result = self.get_question(question_id)
+            except Exception as exc:
+                error = exc
+
+            if not put_until(results, (question_id, result, error), stop):
+                return
+
+    def iter_questions(
+            self, count: int, page_limit: int = 100, skip_ids=None, last_page=1,
+    ) -> typing.Iterator[models.StackOverflowQuestion]:
+        ids_queue = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.stream_window)
+        stop = threading.Event()
+        self.last_page = last_page
+
+        def produce():
+            try:
+                self.last_page = self.__produce_question_ids__(
+                    lambda question_id: put_until(ids_queue, question_id, stop),
+                    count, page_limit, skip_ids, last_page)
+            finally:
+                for _ in range(self.fetch_workers):
+                    put_until(ids_queue, None, stop)
+
+        questions_count = 0
+        answers_quantity = 0
 
-            for future in as_completed(future_to_question_id):
-                question_id = future_to_question_id[future]
-                try:
-                    question = future.result()
+        # Fetch workers start right away and take ids as soon as a listing
+        # page is parsed, so discovery and fetching overlap. Both queues are
+        # bounded, so a slow consumer stalls the crawl instead of piling up
+        # questions in memory.
+        metrics.gauge('queue_depth', ids_queue.qsize, queue='ids')
+        metrics.gauge('queue_depth', results.qsize, queue='results')
+        with ThreadPoolExecutor(self.fetch_workers + 1) as executor:
+            producer = executor.submit(produce)
+            for _ in range(self.fetch_workers):
+                executor.submit(self.__question_worker__, ids_queue, results, stop)
+
+            try:
+                finished = 0
+                while finished < self.fetch_workers:
+                    item = results.get()
+                    if item is None:
+                        finished += 1
+                        continue
+
+                    question = self.__resolve_result__(*item)
                     if question is not None:
-                        questions.append(question)
+                        questions_count += 1
                         answers_quantity += len(question.answers)
-                        logger.debug(f'Question \'{question_id}\' scrapped successfully')
-                    else:
-                        logger.debug(f'Question \'{question_id}\' do not satisfy filters')
-                except Exception as exc:
-                    logger.error(f'Question id {question_id} generated an exception: {exc}')
-
-        logger.info(f'Scrapping finished with total of {len(questions)} questions and {answers_quantity} answers for them')
-        return questions, last_page
+                        yield question
+
+                producer.result()
+            finally:
+                stop.set()
+                metrics.remove_gauge('queue_depth', queue='ids')
+                metrics.remove_gauge('queue_depth', queue='results')
+
+        logger.info(f'Scrapping finished with total of {questions_count} questions and {answers_quantity} answers for them')
+        logger.info(f'Proxies: {self.proxy_pool.summary()}, '
+                    f'rate {self.rate_controller.rate:.1f} req/sec, '
+                    f'{len(self.failed_question_ids)} failed questions')
+        if self.cache is not None:
+            logger.info(f'Cache: {self.cache.summary()}')
+        if self.hedge is not None:
+            logger.info(f'Hedging: {self.hedge.summary()}')
 
+    def get_questions(self, count: int, page_limit: int = 100, skip_ids=None, last_page=1):
+        questions = list(self.iter_questions(count, page_limit, skip_ids, last_page))
+        return questions, self.last_page
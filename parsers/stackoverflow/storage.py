@@ -0,0 +1,211 @@
+import codec
+import const
+from logger import logger
+from metrics import metrics
+import models
+
+import gzip
+import itertools
+import json
+import os
+import typing
+
+
+def open_shard(directory: str, shard: dict) -> typing.BinaryIO:
+    if shard['compressed']:
+        return gzip.open(os.path.join(directory, shard['name']), 'rb')
+
+    return open(os.path.join(directory, shard['name']), 'rb')
+
+
+def read_shard(directory: str, shard: dict) -> typing.Iterator[typing.Mapping]:
+    # Doesn't need the store, so worker processes can read a shard of it.
+    # Shards written before the binary codec hold one JSON dict per line.
+    with open_shard(directory, shard) as file:
+        if shard.get('format', 'jsonl') == 'jsonl':
+            for line_number, line in enumerate(file):
+                if line_number >= shard['records']:
+                    break
+                yield json.loads(line)
+            return
+
+        for record_number, (question_id, payload) in enumerate(
+                codec.read_frames(file)):
+            if record_number >= shard['records']:
+                break
+            yield codec.LazyQuestionRecord(
+                question_id, payload, shard['codec'], shard['schema'])
+
+
+class ShardedCorpusStore:
+    def __init__(
+            self, directory: str = const.CORPUS_DIR,
+            shard_size: int = const.CORPUS_SHARD_SIZE,
+            compress: bool = const.CORPUS_COMPRESS,
+            record_codec: str = const.CORPUS_CODEC,
+            compression_level: int = const.CORPUS_COMPRESSION_LEVEL,
+    ):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.compress = compress
+        self.codec = codec.resolve_codec(record_codec)
+        self.compression_level = compression_level
+        self.manifest_path = os.path.join(directory, const.CORPUS_MANIFEST)
+
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self.__load_manifest__()
+        self.__recover__()
+
+    def __len__(self) -> int:
+        return self.manifest['records']
+
+    def __load_manifest__(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {'version': 2, 'records': 0, 'shards': []}
+
+        with open(self.manifest_path, 'r') as file:
+            return json.load(file)
+
+    def __save_manifest__(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.manifest, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def __shard_path__(self, shard: dict) -> str:
+        return os.path.join(self.directory, shard['name'])
+
+    def __recover__(self):
+        # Anything past the size recorded in the manifest was written by
+        # a batch that never got committed, so it is cut off.
+        for shard in self.manifest['shards']:
+            path = self.__shard_path__(shard)
+            if not os.path.exists(path):
+                raise Exception(f"Corpus shard '{path}' is missing")
+
+            actual_size = os.path.getsize(path)
+            if actual_size > shard['size']:
+                logger.warning("Truncating uncommitted tail of '%s' (%s bytes)",
+                               path, actual_size - shard['size'])
+                with open(path, 'r+b') as file:
+                    file.truncate(shard['size'])
+
+    def __new_shard__(self) -> dict:
+        extension = '.rec.gz' if self.compress else '.rec'
+        shard = {
+            'name': f"shard-{len(self.manifest['shards']):06d}{extension}",
+            'compressed': self.compress,
+            'format': 'frames',
+            'codec': self.codec,
+            'schema': codec.SCHEMA_VERSION,
+            'records': 0,
+            'size': 0,
+        }
+        self.manifest['shards'].append(shard)
+
+        return shard
+
+    def __current_shard__(self) -> dict:
+        shards = self.manifest['shards']
+        if not shards or shards[-1]['records'] >= self.shard_size \
+                or shards[-1]['compressed'] != self.compress \
+                or shards[-1].get('codec') != self.codec \
+                or shards[-1].get('schema') != codec.SCHEMA_VERSION:
+            return self.__new_shard__()
+
+        return shards[-1]
+
+    def __write_chunk__(self, shard: dict, frames: typing.List[bytes]):
+        data = b''.join(frames)
+        if shard['compressed']:
+            # Every chunk is a separate gzip member, concatenated members
+            # are read back by gzip as one stream.
+            data = gzip.compress(data, self.compression_level)
+
+        mode = 'ab' if shard['size'] > 0 else 'wb'
+        with open(self.__shard_path__(shard), mode) as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        shard['records'] += len(frames)
+        shard['size'] += len(data)
+        self.manifest['records'] += len(frames)
+
+    def append(self, records: typing.Iterable[codec.QuestionLike]) -> int:
+        with metrics.timer('store'):
+            return self.__append__(records)
+
+    def __append__(self, records: typing.Iterable[codec.QuestionLike]) -> int:
+        # Takes question models as well as their dicts or stored records.
+        written = 0
+        frames = []
+        shard = self.__current_shard__()
+
+        for record in records:
+            frames.append(codec.encode_frame(record, self.codec))
+            if shard['records'] + len(frames) >= self.shard_size:
+                self.__write_chunk__(shard, frames)
+                written += len(frames)
+                frames = []
+                shard = self.__new_shard__()
+
+        if frames:
+            self.__write_chunk__(shard, frames)
+            written += len(frames)
+        elif shard['records'] == 0:
+            self.manifest['shards'].remove(shard)
+
+        self.__save_manifest__()
+
+        return written
+
+    def iter_shard(self, shard: dict) -> typing.Iterator[typing.Mapping]:
+        return read_shard(self.directory, shard)
+
+    def iter_questions(self) -> typing.Iterator[models.StackOverflowQuestion]:
+        for record in self.iter_latest_records():
+            if isinstance(record, codec.LazyQuestionRecord):
+                yield record.question()
+            else:
+                yield models.StackOverflowQuestion.from_dict(record)
+
+    def iter_records(self, start: int = 0) -> typing.Iterator[typing.Mapping]:
+        # Records from position `start` on, shards before it aren't opened.
+        for shard in list(self.manifest['shards']):
+            if start >= shard['records']:
+                start -= shard['records']
+                continue
+            yield from itertools.islice(self.iter_shard(shard), start, None)
+            start = 0
+
+    def repeated_positions(self) -> typing.Dict[str, int]:
+        # Last position of every id stored more than once. A refreshed
+        # question is appended again, the records before it are outdated.
+        # Only a bitmap of ids is kept for the ones that don't repeat.
+        seen = bytearray()
+        last_positions: typing.Dict[str, int] = {}
+        for position, record in enumerate(self.iter_records()):
+            number = int(record['id'])
+            offset, bit = number >> 3, 1 << (number & 7)
+            if offset >= len(seen):
+                seen.extend(bytes(offset + 1 - len(seen)))
+            if seen[offset] & bit:
+                last_positions[record['id']] = position
+            seen[offset] |= bit
+
+        return last_positions
+
+    def iter_latest_records(self) -> typing.Iterator[typing.Mapping]:
+        last_positions = self.repeated_positions()
+        for position, record in enumerate(self.iter_records()):
+            if last_positions.get(record['id'], position) == position:
+                yield record
@@ -1,10 +1,27 @@
+import const
 from exceptions import SkipQuestionException
 from logger import logger
+from metrics import metrics
 import models
 
 import bs4
+import functools
 import typing
 
+BodyPartHandler = typing.Callable[[bs4.element.Tag], str]
+
+TEXT_TAGS = (
+    'p', 'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'ol', 'ul', 'sub', 'strong',
+)
+CODE_TAGS = ('pre', 'code')
+EMPTY_TAGS = ('hr', 'img', 'br')
+COMPILED_CONFIGS: typing.Dict[tuple, 'BodyFormatter'] = {}
+
+# Raw markup `is_source_rejected` looks for.
+ANSWER_MARKUP = b'data-answerid='
+ACCEPTED_ANSWER_MARKUP = b'js-accepted-answer'
+
 
 def prepare_block(
         question_block: bs4.element.Tag,
@@ -39,9 +56,38 @@ def prepare_block(
     if block_has_accepted_answer is not None:
         block.has_accepted_answer = True
 
+    block.tags = tuple(
+        tag.text for tag in question_block.find_all('a', {'class': 'post-tag'}))
+
+    # 'asked', 'answered' or 'modified' with the time of it, depending on
+    # the last activity on the question.
+    activity = question_block.find('time', {'class': 's-user-card--time'})
+    activity_time = activity.find('span', {'class': 'relativetime'}) \
+        if activity is not None else None
+    if activity_time is not None:
+        action = activity.find(string=True, recursive=False) or ''
+        block.activity = f"{action.strip()} {activity_time.attrs.get('title', '')}".strip()
+
     return block
 
 
+def block_rejection_reason(
+        block: models.StackOverflowQuestionBlock,
+        filter_: models.StackOverflowParserFilter) -> typing.Optional[str]:
+    if filter_.min_score > block.score or (
+            filter_.max_score is not None and filter_.max_score < block.score):
+        return 'score'
+    if filter_.min_answers_count > block.answers_count or (
+            filter_.max_answers_count is not None
+            and filter_.max_answers_count < block.answers_count):
+        return 'answers_count'
+    if filter_.has_accepted_answer is not None \
+            and filter_.has_accepted_answer != block.has_accepted_answer:
+        return 'accepted'
+
+    return None
+
+
 def format_question_title(soap: bs4.BeautifulSoup) -> dict:
     header = soap.find(
         'div',
@@ -69,101 +115,190 @@ def format_body_text(tag: bs4.element.Tag) -> str:
     return tag.text
 
 
-def format_body_code(
-        tag: bs4.element.Tag, code_policy: models.StackOverflowParserPolicy,
-        code_embedding: str) -> str:
+def skip_body_part(tag: bs4.element.Tag) -> str:
+    return ""
+
+
+def drop_body_part(tag: bs4.element.Tag) -> str:
+    raise SkipQuestionException()
+
+
+def drop_unknown_body_part(tag: bs4.element.Tag) -> str:
+    # Only the start of the part, whole bodies don't belong in the log.
+    logger.warning('Unexpected body part <%s>: %.200s', tag.name, tag)
+    raise SkipQuestionException()
+
+
+def embed_body_part(embedding: str, tag: bs4.element.Tag) -> str:
+    return embedding.replace('|', tag.text)
+
+
+def parse_body_table(table_embedding: str, tag: bs4.element.Tag) -> str:
+    table_rows = tag.find_all('tr')
+    table_data = []
+
+    for table_row in table_rows:
+        cols = table_row.find_all('td')
+        cols = [ele.text.strip() for ele in cols]
+        table_data.append([ele for ele in cols if ele])
+    return table_embedding.replace('|', str(table_data))
+
+
+def unsupported_policy_body_part(
+        policy: models.StackOverflowParserPolicy, kind: str,
+        tag: bs4.element.Tag) -> str:
+    raise Exception(f"Can't process '{policy.name}' {kind} policy")
+
+
+def compile_code_handler(
+        code_policy: models.StackOverflowParserPolicy,
+        code_embedding: str) -> BodyPartHandler:
     if code_policy == models.StackOverflowParserPolicy.leave_as_is:
-        return tag.text
+        return format_body_text
     elif code_policy == models.StackOverflowParserPolicy.skip:
-        return ""
+        return skip_body_part
     elif code_policy == models.StackOverflowParserPolicy.embed:
-        return code_embedding.replace('|', tag.text)
+        return functools.partial(embed_body_part, code_embedding)
     elif code_policy == models.StackOverflowParserPolicy.drop:
-        raise SkipQuestionException()
+        return drop_body_part
 
-    raise Exception(f"Can't process '{code_policy.name}' code policy")
+    return functools.partial(unsupported_policy_body_part, code_policy, 'code')
 
 
-def format_body_table(
-        tag: bs4.element.Tag, table_policy: models.StackOverflowParserPolicy,
-        table_embedding: str) -> str:
+def compile_table_handler(
+        table_policy: models.StackOverflowParserPolicy,
+        table_embedding: str) -> BodyPartHandler:
     if table_policy == models.StackOverflowParserPolicy.parse:
-        table_rows = tag.find_all('tr')
-        table_data = []
-
-        for table_row in table_rows:
-            cols = table_row.find_all('td')
-            cols = [ele.text.strip() for ele in cols]
-            table_data.append([ele for ele in cols if ele])
-        return table_embedding.replace('|', str(table_data))
+        return functools.partial(parse_body_table, table_embedding)
     elif table_policy == models.StackOverflowParserPolicy.leave_as_is:
-        return tag.text
+        return format_body_text
     elif table_policy == models.StackOverflowParserPolicy.skip:
-        return ""
+        return skip_body_part
     elif table_policy == models.StackOverflowParserPolicy.embed:
-        return table_embedding.replace('|', tag.text)
+        return functools.partial(embed_body_part, table_embedding)
     elif table_policy == models.StackOverflowParserPolicy.drop:
-        raise SkipQuestionException()
+        return drop_body_part
+
+    return functools.partial(unsupported_policy_body_part, table_policy, 'table')
+
+
+def compile_unknown_handler(
+        unknown_tags_policy: models.StackOverflowParserPolicy) -> BodyPartHandler:
+    if unknown_tags_policy == models.StackOverflowParserPolicy.leave_as_is:
+        return format_body_text
+    elif unknown_tags_policy == models.StackOverflowParserPolicy.skip:
+        return skip_body_part
+    elif unknown_tags_policy == models.StackOverflowParserPolicy.drop:
+        return drop_unknown_body_part
+
+    return functools.partial(
+        unsupported_policy_body_part, unknown_tags_policy, 'unknown tags')
+
+
+def format_body_code(
+        tag: bs4.element.Tag, code_policy: models.StackOverflowParserPolicy,
+        code_embedding: str) -> str:
+    return compile_code_handler(code_policy, code_embedding)(tag)
+
+
+def format_body_table(
+        tag: bs4.element.Tag, table_policy: models.StackOverflowParserPolicy,
+        table_embedding: str) -> str:
+    return compile_table_handler(table_policy, table_embedding)(tag)
+
+
+def format_body_div(table_handler: BodyPartHandler, tag: bs4.element.Tag) -> str:
+    if 's-table-container' in tag.attrs.get('class', []):
+        return table_handler(tag)
 
-    raise Exception(f"Can't process '{table_policy.name}' table policy")
+    return ""
+
+
+# Tag name -> handler table of a config, so formatting a body part is a
+# single dict lookup instead of a chain of checks on the tag and the policies.
+class BodyFormatter:
+    def __init__(self, config: models.StackOverflowParserConfig):
+        code_handler = compile_code_handler(config.code_policy, config.code_embedding)
+        table_handler = compile_table_handler(
+            config.tables_policy, config.table_embedding)
+
+        self.handlers: typing.Dict[str, BodyPartHandler] = {}
+        self.handlers.update(dict.fromkeys(TEXT_TAGS, format_body_text))
+        self.handlers.update(dict.fromkeys(CODE_TAGS, code_handler))
+        self.handlers.update(dict.fromkeys(EMPTY_TAGS, skip_body_part))
+        self.handlers['div'] = functools.partial(format_body_div, table_handler)
+        self.fallback = compile_unknown_handler(config.unknown_tags_policy)
+
+    def format_part(self, body_part: bs4.element.Tag) -> str:
+        return self.handlers.get(body_part.name, self.fallback)(body_part)
+
+    def format_parts(self, body: bs4.element.Tag) -> str:
+        return "\n".join(
+            self.format_part(body_part) for body_part in body.children
+            if not isinstance(body_part, bs4.element.NavigableString))
+
+    def format(self, tag: bs4.element.Tag) -> str:
+        body = tag.find(
+            'div',
+            {
+                'class': 's-prose',
+            },
+        )
+
+        return self.format_parts(body)
+
+
+def compile_config(config: models.StackOverflowParserConfig) -> BodyFormatter:
+    # Configs are pickled into every parse task, so formatters are cached by
+    # the fields they depend on rather than by the config object.
+    key = (
+        config.code_policy, config.code_embedding,
+        config.tables_policy, config.table_embedding,
+        config.unknown_tags_policy,
+    )
+    formatter = COMPILED_CONFIGS.get(key)
+    if formatter is None:
+        formatter = COMPILED_CONFIGS[key] = BodyFormatter(config)
+
+    return formatter
 
 
 def format_any_body_part(
         body_part: bs4.element.Tag,
         config: models.StackOverflowParserConfig) -> typing.Optional[str]:
-    if body_part.name == 'p':
-        return format_body_text(body_part)
-    if body_part.name == 'blockquote':
-        return format_body_text(body_part)
-    if body_part.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-        return format_body_text(body_part)
-    if body_part.name in ['ol', 'ul', 'sub', 'strong']:
-        return format_body_text(body_part)
-    if body_part.name in ['pre', 'code']:
-        return format_body_code(
-            body_part, config.code_policy, config.code_embedding)
-    if body_part.name == 'div' and (
-            's-table-container' in body_part.attrs.get('class', [])):
-        return format_body_table(
-            body_part, config.tables_policy, config.table_embedding)
-    if body_part.name in ['hr', 'div', 'img', 'br']:
-        return ""
-
-    logger.error(f"Unexpected body part: {body_part}."
-                 f"Raw body can be seen in next debug log.")
-    logger.debug(body_part.text)
-    raise SkipQuestionException()
+    return compile_config(config).format_part(body_part)
 
 
 def format_body(tag: bs4.element.Tag,
                 config: models.StackOverflowParserConfig) -> str:
-    body = tag.find(
-        'div',
-        {
-            'class': 's-prose',
-        },
-    )
+    return compile_config(config).format(tag)
 
-    body_parts_formatted = []
 
-    for body_part in body.children:
-        body_part: typing.Union[bs4.element.NavigableString, bs4.element.Tag]
-        if isinstance(body_part, bs4.element.NavigableString):
-            continue
-        body_part_formatted = format_any_body_part(body_part, config)
-        body_parts_formatted.append(body_part_formatted)
+def format_body_html(
+        body_html: str, config: models.StackOverflowParserConfig,
+        backend: str = const.PARSER_BACKEND) -> str:
+    # A bare post body, as the Stack Exchange API returns it: what sits
+    # inside `s-prose` on the page, without the page around it.
+    soup = bs4.BeautifulSoup(body_html, backend)
+    body = soup.body if soup.body is not None else soup
 
-    return "\n".join(body_parts_formatted)
+    return compile_config(config).format_parts(body)
 
 
-def format_question_answer(
-        tag: bs4.element.Tag, config: models.StackOverflowParserConfig,
-) -> typing.Optional[models.StackOverflowAnswer]:
+def prepare_answer(tag: bs4.element.Tag) -> models.StackOverflowAnswer:
     answer = models.StackOverflowAnswer()
     answer.id = tag.attrs.get('data-answerid')
     answer.score = int(tag.attrs.get('data-score', 0))
     answer.has_accepted = 'js-accepted-answer' in tag.attrs.get('class', [])
 
+    return answer
+
+
+def format_question_answer(
+        tag: bs4.element.Tag, config: models.StackOverflowParserConfig,
+) -> typing.Optional[models.StackOverflowAnswer]:
+    answer = prepare_answer(tag)
+
     try:
         answer.body = format_body(tag, config)
     except SkipQuestionException:
@@ -199,14 +334,24 @@ def format_question_answers(
         },
     )
 
-    for answer in all_answers:
-        answer_formatted = format_question_answer(answer, config)
-        if answer_formatted is None:
+    # Score and acceptance are attributes of the answer tag, so answers are
+    # filtered by them before their bodies are formatted, and the loop stops
+    # as soon as `answers_limit` answers are collected.
+    for answer_tag in all_answers:
+        if len(answers) >= config.answers_limit:
+            break
+
+        answer = prepare_answer(answer_tag)
+        if not is_answer_fits_config(answer, config):
             continue
-        if is_answer_fits_config(answer_formatted, config):
-            answers.append(answer_formatted)
 
-    return answers[:config.answers_limit]
+        try:
+            answer.body = format_body(answer_tag, config)
+        except SkipQuestionException:
+            continue
+        answers.append(answer)
+
+    return answers
 
 
 def format_answers_count(
@@ -239,11 +384,6 @@ def format_question(
 
     question.score = format_question_score(question_tag)
 
-    try:
-        question.body = format_body(question_tag, config)
-    except SkipQuestionException:
-        return None
-
     answers_tag = soap.find(
         'div',
         {
@@ -251,11 +391,54 @@ def format_question(
         },
     )
 
+    # Answers are cheaper to reject than the question body is to format,
+    # so they go first.
     question.answers_count = format_answers_count(answers_tag)
+    if question.answers_count == 0:
+        logger.debug('Question %s has no answers', question_id)
+        metrics.inc('rejected_total', reason='no_answers')
+        return None
+
     question.answers = format_question_answers(answers_tag, config)
 
     if len(question.answers) == 0:
-        logger.debug(f'Cant find suitable answers for {question_id}')
+        logger.debug('Cant find suitable answers for %s', question_id)
+        metrics.inc('rejected_total', reason='no_suitable_answers')
+        return None
+
+    try:
+        question.body = format_body(question_tag, config)
+    except SkipQuestionException:
+        metrics.inc('rejected_total', reason='drop_policy')
         return None
 
     return question
+
+
+def source_rejection_reason(
+        source_code: typing.Union[str, bytes],
+        config: models.StackOverflowParserConfig) -> typing.Optional[str]:
+    # Checks on the raw page that let the parser skip building a tree for
+    # questions `format_question` would throw away anyway: a page without
+    # answers, or without an accepted one when only those are wanted, can't
+    # produce a question. Drop policies are left to the tree walk, which
+    # only drops code and tables at the top level of a body.
+    if isinstance(source_code, str):
+        source_code = source_code.encode('utf-8')
+
+    if ANSWER_MARKUP not in source_code:
+        return 'no_answers'
+    if config.only_accepted_answers and ACCEPTED_ANSWER_MARKUP not in source_code:
+        return 'no_accepted_answer'
+
+    return None
+
+
+def is_source_rejected(
+        source_code: typing.Union[str, bytes],
+        config: models.StackOverflowParserConfig) -> bool:
+    reason = source_rejection_reason(source_code, config)
+    if reason is not None:
+        metrics.inc('rejected_total', reason=reason)
+
+    return reason is not None
@@ -0,0 +1,206 @@
+import const
+
+import abc
+import sqlite3
+import threading
+import time
+import typing
+
+PAGE_TASK = 'page'
+QUESTION_TASK = 'question'
+
+
+class Lease:
+    __slots__ = ('kind', 'key', 'payload', 'attempts')
+
+    def __init__(self, kind: str, key: str, payload: typing.Optional[str], attempts: int):
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+
+
+# What crawl workers need from a queue of leased tasks. A task is claimed
+# for `lease` seconds and has to be heartbeat or committed before that,
+# otherwise another worker gets it. Tasks are unique by kind and key, so
+# adding one that was added before, finished or not, does nothing.
+class WorkQueue(abc.ABC):
+    @abc.abstractmethod
+    def add(self, kind: str, keys: typing.Iterable[str],
+            payload: typing.Optional[str] = None) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim(self, worker: str, kind: str, limit: int = 1,
+              lease: float = const.WORK_QUEUE_LEASE) -> typing.List[Lease]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def heartbeat(self, worker: str, kind: str, keys: typing.Iterable[str],
+                  lease: float = const.WORK_QUEUE_LEASE) -> typing.List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def commit(self, worker: str, kind: str, keys: typing.Iterable[str]) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def fail(self, worker: str, kind: str, keys: typing.Iterable[str]) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def counts(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        raise NotImplementedError
+
+    def is_drained(self) -> bool:
+        counts = self.counts()
+        return all(
+            states.get('pending', 0) == 0 and states.get('leased', 0) == 0
+            for states in counts.values()
+        )
+
+    def close(self):
+        pass
+
+
+# Tasks in one SQLite file. Claims run in an immediate transaction, so
+# processes sharing the file never get the same task; for workers on
+# several nodes the same interface can sit on a shared database server.
+class SqliteWorkQueue(WorkQueue):
+    def __init__(
+            self, path: str = const.WORK_QUEUE_PATH,
+            max_attempts: int = const.WORK_QUEUE_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, timeout=const.WORK_QUEUE_BUSY_TIMEOUT,
+            isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'kind TEXT NOT NULL, key TEXT NOT NULL, payload TEXT, '
+            "state TEXT NOT NULL DEFAULT 'pending', owner TEXT, "
+            'lease_until REAL NOT NULL DEFAULT 0, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'PRIMARY KEY (kind, key))')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS tasks_by_state '
+            'ON tasks (kind, state, lease_until)')
+
+    def __transaction__(self, run: typing.Callable[[sqlite3.Connection], typing.Any]):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = run(self.connection)
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+        return result
+
+    def add(self, kind: str, keys: typing.Iterable[str],
+            payload: typing.Optional[str] = None) -> int:
+        rows = [(kind, key, payload) for key in keys]
+
+        def run(connection: sqlite3.Connection) -> int:
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO tasks (kind, key, payload) VALUES (?, ?, ?)', rows)
+            return connection.total_changes - before
+
+        return self.__transaction__(run)
+
+    def claim(self, worker: str, kind: str, limit: int = 1,
+              lease: float = const.WORK_QUEUE_LEASE) -> typing.List[Lease]:
+        # Pending tasks and the ones whose lease ran out, oldest first. A
+        # task that keeps outliving its leases (say it crashes the worker)
+        # is given up after `max_attempts` claims.
+        def run(connection: sqlite3.Connection) -> typing.List[Lease]:
+            now = time.time()
+            connection.execute(
+                "UPDATE tasks SET state = 'failed', owner = NULL "
+                "WHERE kind = ? AND state = 'leased' AND lease_until < ? "
+                'AND attempts >= ?', (kind, now, self.max_attempts))
+            rows = connection.execute(
+                'SELECT rowid, key, payload, attempts FROM tasks '
+                "WHERE kind = ? AND (state = 'pending' "
+                "OR (state = 'leased' AND lease_until < ?)) "
+                'ORDER BY rowid LIMIT ?', (kind, now, limit)).fetchall()
+            connection.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_until = ?, "
+                'attempts = attempts + 1 WHERE rowid = ?',
+                [(worker, now + lease, rowid) for rowid, _, _, _ in rows])
+
+            return [
+                Lease(kind, key, payload, attempts + 1)
+                for _, key, payload, attempts in rows
+            ]
+
+        return self.__transaction__(run)
+
+    def heartbeat(self, worker: str, kind: str, keys: typing.Iterable[str],
+                  lease: float = const.WORK_QUEUE_LEASE) -> typing.List[str]:
+        # Returns the keys the worker still holds, a task it lost to another
+        # worker after its lease expired is not extended.
+        keys = list(keys)
+
+        def run(connection: sqlite3.Connection) -> typing.List[str]:
+            held = []
+            lease_until = time.time() + lease
+            for key in keys:
+                cursor = connection.execute(
+                    "UPDATE tasks SET lease_until = ? WHERE kind = ? AND key = ? "
+                    "AND state = 'leased' AND owner = ?",
+                    (lease_until, kind, key, worker))
+                if cursor.rowcount:
+                    held.append(key)
+            return held
+
+        return self.__transaction__(run)
+
+    def __finish__(self, worker: str, kind: str, keys: typing.Iterable[str],
+                   statement: str) -> int:
+        rows = [(kind, key, worker) for key in keys]
+
+        def run(connection: sqlite3.Connection) -> int:
+            before = connection.total_changes
+            connection.executemany(statement, rows)
+            return connection.total_changes - before
+
+        return self.__transaction__(run)
+
+    def commit(self, worker: str, kind: str, keys: typing.Iterable[str]) -> int:
+        return self.__finish__(
+            worker, kind, keys,
+            "UPDATE tasks SET state = 'done', owner = NULL "
+            "WHERE kind = ? AND key = ? AND state = 'leased' AND owner = ?")
+
+    def fail(self, worker: str, kind: str, keys: typing.Iterable[str]) -> int:
+        # Back to pending until the task used up `max_attempts` claims.
+        return self.__finish__(
+            worker, kind, keys,
+            "UPDATE tasks SET owner = NULL, lease_until = 0, state = CASE "
+            f"WHEN attempts >= {int(self.max_attempts)} THEN 'failed' "
+            "ELSE 'pending' END "
+            "WHERE kind = ? AND key = ? AND state = 'leased' AND owner = ?")
+
+    def counts(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        # Leases that ran out count as pending, they are claimable again.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT kind, CASE WHEN state = 'leased' AND lease_until < ? "
+                "THEN 'pending' ELSE state END AS current, COUNT(*) "
+                'FROM tasks GROUP BY kind, current', (time.time(),)).fetchall()
+
+        counts = {}
+        for kind, state, count in rows:
+            counts.setdefault(kind, {})[state] = count
+
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.connection.close()